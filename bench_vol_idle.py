@@ -0,0 +1,517 @@
+"""Benchmarks for vol_idle using the fake idle, volume and shutdown backends
+
+Runs on any platform (no Windows APIs, pycaw or display needed) and writes
+the results as JSON so runs can be compared:
+
+    python bench_vol_idle.py                  # writes bench_output.txt
+    python bench_vol_idle.py --compare old.txt
+
+Exits with status 1 if a one-shot command goes over its startup budget, or
+if a benchmark's event counts show it did not do the work it timed.
+"""
+import os
+import sys
+import json
+import asyncio
+import time
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+import threading
+
+from vol_idle import (
+    DEFAULT_CONFIG, DryRunShutdownBackend, FakeClock, FakeIdleSource, FakeSessionBackend, FakeVolumeBackend, FakeShutdownBackend,
+    IdleDetector, IdleReplay, IdleRule, ReportAgent, ReportCollector, RuleTable, Scheduler, SessionVolumeEnforcer, ShutdownExecutor,
+    Settings, ShutdownWatchdog,
+    StatusLog, SystemUtilitiesApp, UIEventQueue, VolumeEnforcer, VolumeWriter,
+    load_config, save_config, synthetic_activity,
+)
+
+OUTPUT_FILE = "bench_output.txt"
+# Milliseconds on top of a bare interpreter start
+IMPORT_BUDGET_MS = 60
+ONE_SHOT_BUDGET_MS = 100
+# Modules a one-shot command must never load
+HEAVY_MODULES = ('tkinter', 'asyncio', 'logging', 'subprocess', 'comtypes', 'pycaw')
+# Result fields that must be true for the timings to mean anything
+CHECKS = (('detection', 'counts_ok'), ('replay', 'counts_ok'), ('shutdown_hooks', 'counts_ok'),
+          ('one_shot', 'saved'), ('reporting', 'counts_ok'), ('enforcement', 'restored'),
+          ('app_volumes', 'counts_ok'), ('slider', 'final_level_matches'))
+
+
+def timed(fn, iterations):
+    """Run fn iterations times and return (total seconds, per-op microseconds)"""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    elapsed = time.perf_counter() - start
+    return elapsed, elapsed / iterations * 1e6
+
+
+# ==============================================
+# HARNESS
+# ==============================================
+class ManualTimers:
+    """schedule(delay, fn) for VolumeWriter, fired by advancing a FakeClock"""
+    class Timer:
+        def __init__(self, when, fn):
+            self.when = when
+            self.fn = fn
+            self.cancelled = False
+
+        def cancel(self):
+            self.cancelled = True
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.timers = []
+
+    def __call__(self, delay, fn):
+        timer = self.Timer(self.clock.now() + delay, fn)
+        self.timers.append(timer)
+        return timer
+
+    def advance(self, seconds):
+        self.clock.current += seconds
+        due = [t for t in self.timers if t.when <= self.clock.current]
+        self.timers = [t for t in self.timers if t.when > self.clock.current]
+        for timer in due:
+            if not timer.cancelled:
+                timer.fn()
+
+
+class AppHarness:
+    """The app's volume and logging handlers without a Tk window"""
+    on_slider_move = SystemUtilitiesApp.on_slider_move
+    set_volume = SystemUtilitiesApp.set_volume
+    log_status = SystemUtilitiesApp.log_status
+    schedule_status_flush = SystemUtilitiesApp.schedule_status_flush
+
+    def __init__(self, clock, log_file=None):
+        self.config = dict(DEFAULT_CONFIG)
+        self.settings = Settings.from_config(self.config)
+        self.volume_control = FakeVolumeBackend(0.5, clock=clock)
+        self.timers = ManualTimers(clock)
+        self.applied = []
+        self.volume_writer = VolumeWriter(
+            self.volume_control, self.timers,
+            max_rate=self.config['volume_write_rate'], clock=clock,
+            on_applied=self.applied.append
+        )
+        self.status_log = StatusLog(log_file)
+        self.status_flush_job = None
+        self.status_text = None
+        self.volume_slider = None
+        self.volume_label = None
+        self.ui_thread = threading.get_ident()
+
+
+# ==============================================
+# BENCHMARKS
+# ==============================================
+def bench_config(workdir, iterations):
+    path = os.path.join(workdir, "config.txt")
+    config = dict(DEFAULT_CONFIG)
+    _, save_us = timed(lambda: save_config(path, config), iterations)
+    _, load_us = timed(lambda: load_config(path), iterations)
+    return {
+        'iterations': iterations,
+        'save_us': save_us,
+        'load_us': load_us,
+    }
+
+
+def bench_detection(iterations):
+    clock = FakeClock()
+    source = FakeIdleSource(clock)
+    shutdown = FakeShutdownBackend(clock)
+    phases = []
+
+    def on_rule(phase, rule):
+        phases.append(phase)
+        if phase == RuleTable.ACT and rule.action == 'shutdown':
+            shutdown.shutdown()
+
+    detector = IdleDetector(source, clock, RuleTable.from_config(DEFAULT_CONFIG),
+                            on_rule=on_rule, on_active=lambda: None, scheduler=None)
+    _, tick_us = timed(detector.tick, iterations)
+
+    # One virtual hour of deadline-driven wakeups with input every ten minutes
+    clock.current = 0.0
+    source.touch()
+    detector.wakeups = 0
+    detector.fired = 0
+    detector.fired_keys.clear()
+    detector.warnings.clear()
+    shutdown.requests.clear()
+    phases.clear()
+    next_input = 600.0
+    while clock.current < 3600.0:
+        delay = detector.tick()
+        clock.current += delay
+        if clock.current >= next_input:
+            source.touch()
+            next_input += 600.0
+    # Lookups in a large rule table stay logarithmic
+    table = RuleTable([IdleRule(60 * (i + 1), 'lock') for i in range(1000)])
+    _, lookup_us = timed(lambda: table.crossed(30000.5), iterations)
+
+    return {
+        'iterations': iterations,
+        'tick_us': tick_us,
+        'rule_lookup_1000_us': lookup_us,
+        'virtual_hour_wakeups': detector.wakeups,
+        'virtual_hour_warnings': phases.count(RuleTable.WARN),
+        'virtual_hour_shutdowns': len(shutdown.requests),
+        # Every ten-minute episode warns once and then shuts down once
+        'counts_ok': phases.count(RuleTable.WARN) == len(shutdown.requests) == 6,
+    }
+
+
+def bench_replay(hours):
+    """Synthetic working days through tiered rules, with a user who sometimes clicks OK"""
+    rules = RuleTable([IdleRule(120, 'volume', 20), IdleRule(600, 'lock', warning=30),
+                       IdleRule(3600, 'shutdown', warning=60)])
+    active = synthetic_activity(hours)
+    replay = IdleReplay(rules, active, dismiss_after=5).run(hours * 3600)
+    actions = replay.actions
+    return {
+        'spans': len(active),
+        **replay.summary(),
+        # A warning ends in a dismissal, its action or the user coming back;
+        # the volume tier fires at most once per episode
+        'counts_ok': replay.warnings > 0
+                     and replay.dismissals + actions.get('lock', 0) + actions.get('shutdown', 0) <= replay.warnings
+                     and 0 < actions.get('volume', 0) <= replay.episodes + 1,
+    }
+
+
+def bench_watchdog(trials, delay=0.05, block=0.2):
+    """Shutdown deadline accuracy while the UI thread is stuck, e.g. in a modal dialog
+
+    Compares the watchdog with the previous path, where the deadline timer
+    fired on the scheduler but the shutdown itself ran on the UI thread.
+    """
+    shutdown = FakeShutdownBackend()
+    watchdog = ShutdownWatchdog()
+    watchdog.start()
+    scheduler = Scheduler()
+    scheduler.start()
+    ui_events = UIEventQueue()
+    watchdog_late = []
+    ui_late = []
+    for _ in range(trials):
+        deadline = time.monotonic() + delay
+        watchdog.arm(delay, shutdown.shutdown)
+        scheduler.call_later(delay, lambda: ui_events.post(lambda: ui_late.append(time.monotonic() - deadline)))
+        time.sleep(block)   # the UI thread is blocked past the deadline
+        ui_events.drain()
+        watchdog_late.append(shutdown.requests[-1][1] - deadline)
+    watchdog.stop()
+    scheduler.stop()
+    return {
+        'trials': trials,
+        'ui_block_ms': block * 1000,
+        'watchdog_max_late_ms': max(watchdog_late) * 1000,
+        'watchdog_avg_late_ms': sum(watchdog_late) / trials * 1000,
+        'ui_thread_max_late_ms': max(ui_late) * 1000,
+    }
+
+
+def bench_shutdown_hooks(hooks, hook_seconds=0.05, timeout=0.2):
+    """Pre-shutdown hooks run in parallel, one of them stuck, against a dry-run backend"""
+    backend = DryRunShutdownBackend(log=lambda message: None)
+    executor = ShutdownExecutor(
+        backend,
+        [(f"hook{i}", lambda: time.sleep(hook_seconds)) for i in range(hooks)] + [('stuck', lambda: time.sleep(10))],
+        timeout=timeout,
+        log=lambda message: None
+    )
+    start = time.monotonic()
+    executor.shutdown()
+    return {
+        'hooks': hooks,
+        'hook_ms': hook_seconds * 1000,
+        'timeout_ms': timeout * 1000,
+        'to_shutdown_ms': (backend.requests[0][1] - start) * 1000,
+        'completed': len(executor.results),
+        'counts_ok': len(executor.results) == hooks and len(backend.requests) == 1,
+    }
+
+
+ONE_SHOT_PROBE = """
+import sys, time, json
+start = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import vol_idle
+imported = time.perf_counter()
+status = vol_idle.main(['config', 'set', 'idle_threshold=45', 'control_port=0'])
+print(json.dumps({'import_ms': (imported - start) * 1000, 'status': status,
+                  'heavy': [name for name in json.loads(sys.argv[2]) if name in sys.modules]}))
+"""
+
+
+def bench_one_shot(workdir, runs):
+    """Import time and total startup of `vol_idle.py config set` in a fresh interpreter"""
+    package = os.path.dirname(os.path.abspath(__file__))
+    interpreter_ms = []
+    total_ms = []
+    probes = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'], check=True)
+        interpreter_ms.append((time.perf_counter() - start) * 1000)
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', ONE_SHOT_PROBE, package, json.dumps(HEAVY_MODULES)],
+                                cwd=workdir, check=True, capture_output=True, text=True).stdout
+        total_ms.append((time.perf_counter() - start) * 1000)
+        probes.append(json.loads(output))
+    # The fastest run is the one least disturbed by the rest of the machine
+    import_ms = min(probe['import_ms'] for probe in probes)
+    one_shot_ms = min(total_ms) - min(interpreter_ms)
+    return {
+        'runs': runs,
+        'interpreter_ms': min(interpreter_ms),
+        'import_ms': import_ms,
+        'import_budget_ms': IMPORT_BUDGET_MS,
+        'one_shot_ms': one_shot_ms,
+        'one_shot_budget_ms': ONE_SHOT_BUDGET_MS,
+        'heavy_modules': ' '.join(sorted({name for probe in probes for name in probe['heavy']})) or 'none',
+        'saved': all(probe['status'] == 0 for probe in probes)
+                 and load_config(os.path.join(workdir, "config.txt"))['idle_threshold'] == 45,
+        'within_budget': import_ms <= IMPORT_BUDGET_MS and one_shot_ms <= ONE_SHOT_BUDGET_MS
+                         and not any(probe['heavy'] for probe in probes),
+    }
+
+
+def bench_reporting(agents, snapshots=60):
+    """Agents sending their batches to one collector over loopback, all at once"""
+    async def run_agents():
+        collector = ReportCollector('127.0.0.1', 0)
+        await collector.start()
+        rng = random.Random(0)
+        senders = []
+        for i in range(agents):
+            agent = ReportAgent(f"127.0.0.1:{collector.port}", name=f"ws{i:04d}", log=lambda message: None)
+            for j in range(snapshots):
+                agent.record('sample', {'idle_detection': True, 'idle_seconds': j * 60.0, 'paused': False,
+                                        'warned': False, 'shutdown_in': max(0.0, 3600 - j * 60.0),
+                                        'volume_control': True, 'saved_volume': 50,
+                                        'volume_corrections': rng.randrange(3)})
+            senders.append(agent)
+        start = time.perf_counter()
+        sent = await asyncio.gather(*(agent.send() for agent in senders))
+        elapsed = time.perf_counter() - start
+        await collector.close()
+        return {
+            'agents': agents,
+            'snapshots_per_report': snapshots,
+            'total_ms': elapsed * 1000,
+            'per_report_us': elapsed / agents * 1e6,
+            'acknowledged': sum(sent),
+            'hosts': len(collector.hosts),
+            'rejected': collector.rejected,
+            'max_connections': collector.max_connections,
+            'compression': sum(a.raw_bytes for a in senders) / max(1, sum(a.sent_bytes for a in senders)),
+            'counts_ok': sum(sent) == len(collector.hosts) == agents and collector.rejected == 0,
+        }
+
+    return asyncio.run(run_agents())
+
+
+def bench_enforcement(changes, dispatched):
+    clock = FakeClock()
+    backend = FakeVolumeBackend(0.5, clock=clock)
+    enforcer = VolumeEnforcer(backend, target=50)
+    enforcer.start()
+    rng = random.Random(0)
+    levels = [rng.random() for _ in range(changes)]
+
+    start = time.perf_counter()
+    for level in levels:
+        backend.external_change(level)
+        clock.current += 0.001
+    elapsed = time.perf_counter() - start
+    latencies, restored = enforcement_latency(dispatched, rng)
+    return {
+        'changes': changes,
+        'per_change_us': elapsed / changes * 1e6,
+        'notifications': enforcer.notifications,
+        'corrections': enforcer.corrections,
+        'restored': restored and round(backend.level * 100) == 50,
+        'dispatched': len(latencies),
+        'avg_latency_ms': sum(latencies) / len(latencies) * 1000,
+        'max_latency_ms': max(latencies) * 1000,
+    }
+
+
+def enforcement_latency(changes, rng):
+    """Seconds from each external change to its correction, through the UI queue and a main-loop thread
+
+    The loop above runs the correction synchronously on a fake clock, so it
+    cannot see the dispatch; here notifications are posted to a UIEventQueue
+    and drained by another thread, as in the daemon, on the real clock.
+    """
+    backend = FakeVolumeBackend(0.5)
+    events = UIEventQueue()
+    corrected = threading.Event()
+
+    def correct(percent):
+        backend.set_level(percent / 100)
+        corrected.set()
+
+    enforcer = VolumeEnforcer(backend, target=50, dispatch=lambda fn: events.post(fn, key='volume'),
+                              on_correct=correct)
+    enforcer.start()
+    running = True
+
+    def main_loop():
+        while running:
+            if events.wait(0.1):
+                events.drain()
+
+    thread = threading.Thread(target=main_loop, daemon=True)
+    thread.start()
+    restored = True
+    try:
+        for _ in range(changes):
+            corrected.clear()
+            # Never the target itself, which would need no correction
+            backend.external_change(rng.choice((rng.uniform(0.0, 0.49), rng.uniform(0.51, 1.0))))
+            restored = corrected.wait(1.0) and restored
+    finally:
+        running = False
+        thread.join()
+    return backend.latencies, restored
+
+
+def bench_app_volumes(sessions, changes):
+    backend = FakeSessionBackend()
+    for i in range(sessions):
+        backend.add(f"app{i}.exe", 1.0)
+    # One application in ten has a target
+    enforcer = SessionVolumeEnforcer(backend, {f"app{i}.exe": 30 for i in range(0, sessions, 10)})
+    enforcer.start()
+    writes = sum(session.volume.writes for session in backend.sessions.values())
+    rng = random.Random(0)
+    pool = list(backend.sessions.values())
+    events = [(rng.choice(pool), rng.random()) for _ in range(changes)]
+
+    start = time.perf_counter()
+    for session, level in events:
+        backend.external_change(session, level)
+    elapsed = time.perf_counter() - start
+    return {
+        'sessions': sessions,
+        'changes': changes,
+        'per_change_us': elapsed / changes * 1e6,
+        'initial_writes': writes,
+        'corrections': enforcer.corrections,
+        'untargeted_writes': sum(session.volume.writes for session in backend.sessions.values()
+                                 if session.name not in enforcer.targets),
+        'counts_ok': writes == len(enforcer.targets) and all(
+            round(session.volume.level * 100) == 30 for session in backend.sessions.values()
+            if session.name in enforcer.targets),
+    }
+
+
+def bench_slider(moves, spacing):
+    clock = FakeClock()
+    app = AppHarness(clock)
+
+    start = time.perf_counter()
+    for i in range(moves):
+        app.on_slider_move(str(i % 101))
+        app.timers.advance(spacing)
+    app.timers.advance(1.0)
+    elapsed = time.perf_counter() - start
+    return {
+        'moves': moves,
+        'move_spacing_ms': spacing * 1000,
+        'per_move_us': elapsed / moves * 1e6,
+        'endpoint_writes': app.volume_control.calls,
+        'coalesced': app.volume_writer.coalesced,
+        'final_level_matches': round(app.volume_control.level * 100) == (moves - 1) % 101,
+    }
+
+
+def bench_log_status(workdir, messages):
+    app = AppHarness(FakeClock(), log_file=os.path.join(workdir, "vol_idle.log"))
+    message = "Volume restored to 50% " + "x" * 80
+    _, append_us = timed(lambda: app.log_status(message), messages)
+    _, tail_us = timed(lambda: app.status_log.since(0, SystemUtilitiesApp.STATUS_VISIBLE_LINES), 1000)
+    app.status_log.close()
+    return {
+        'messages': messages,
+        'append_us': append_us,
+        'visible_tail_us': tail_us,
+        'buffered_lines': len(app.status_log.lines),
+    }
+
+
+def run(quick=False):
+    scale = 10 if quick else 1
+    with tempfile.TemporaryDirectory() as workdir:
+        results = {
+            'config': bench_config(workdir, 2000 // scale),
+            'detection': bench_detection(200000 // scale),
+            'replay': bench_replay(2400 // scale),
+            'watchdog': bench_watchdog(20 // scale),
+            'shutdown_hooks': bench_shutdown_hooks(8),
+            'one_shot': bench_one_shot(workdir, 10 // scale),
+            'reporting': bench_reporting(2000 // scale),
+            'enforcement': bench_enforcement(100000 // scale, 1000 // scale),
+            'app_volumes': bench_app_volumes(200, 100000 // scale),
+            'slider': bench_slider(10000 // scale, 0.002),
+            'log_status': bench_log_status(workdir, 100000 // scale),
+        }
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'quick': quick,
+        'results': results,
+    }
+
+
+def compare(previous, current):
+    """Print per-op timings that changed between two result files"""
+    for group, values in current['results'].items():
+        before = previous.get('results', {}).get(group, {})
+        for key, value in values.items():
+            if not key.endswith('_us') or key not in before:
+                continue
+            change = (value - before[key]) / before[key] * 100 if before[key] else 0.0
+            print(f"{group}.{key}: {before[key]:.2f} -> {value:.2f} us ({change:+.1f}%)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark vol_idle with fake platform backends")
+    parser.add_argument('--output', default=OUTPUT_FILE, help="JSON results file")
+    parser.add_argument('--compare', help="previous results file to compare against")
+    parser.add_argument('--quick', action='store_true', help="run a tenth of the iterations")
+    args = parser.parse_args(argv)
+
+    report = run(args.quick)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    for group, values in report['results'].items():
+        print(f"{group}: " + ", ".join(
+            f"{key}={value:.2f}" if isinstance(value, float) else f"{key}={value}"
+            for key, value in values.items()))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+    failed = [f"{group}.{key}" for group, key in CHECKS if not report['results'][group][key]]
+    if failed:
+        print(f"Correctness checks failed: {', '.join(failed)}")
+    if not report['results']['one_shot']['within_budget']:
+        print("One-shot commands are over their startup budget")
+    if failed or not report['results']['one_shot']['within_budget']:
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
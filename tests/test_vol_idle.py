@@ -0,0 +1,1060 @@
+"""Tests for vol_idle using the fake idle, volume and shutdown backends
+
+Like the benchmarks, these run on any platform:
+
+    python -m pytest tests
+"""
+import os
+import sys
+import json
+import time
+import datetime
+import socket
+import tempfile
+import threading
+import unittest
+from contextlib import redirect_stderr, redirect_stdout
+from io import StringIO
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vol_idle import (
+    DEFAULT_CONFIG, DryRunShutdownBackend, FakeClock, FakeIdleSource, FakeSessionBackend, FakeShutdownBackend,
+    FakeVolumeBackend, ConfigStore, ConfigWatcher, ControlServer, EndpointManager, EndpointUnavailable,
+    HistoryStore, IdleDetector, IdleReplay, IdleRule, IdleVolumeBase, Metrics, Profile, ProfileSchedule,
+    ReportCollector, RuleTable, Scheduler, SessionVolumeEnforcer, Settings, ShutdownExecutor, ShutdownWatchdog,
+    StatusLog, UIEventQueue, VolumeEnforcer, VolumeWriter, arm_shutdown_watchdog, control_request,
+    control_token_file, load_config, main, save_config, session_port,
+)
+
+
+class ManualScheduler:
+    """Scheduler stand-in that runs submitted work at once and keeps its timers"""
+    class Timer:
+        def __init__(self, delay, fn):
+            self.delay = delay
+            self.fn = fn
+            self.cancelled = False
+
+        def cancel(self):
+            self.cancelled = True
+
+    def __init__(self):
+        self.timers = []
+
+    def submit(self, fn):
+        fn()
+
+    def call_later(self, delay, fn, feature=None):
+        timer = self.Timer(delay, fn)
+        self.timers.append(timer)
+        return timer
+
+
+class DetectorTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.source = FakeIdleSource(self.clock)
+        self.events = []
+        self.idle_starts = []
+        self.detector = IdleDetector(
+            self.source, self.clock, RuleTable.from_config(DEFAULT_CONFIG),
+            on_rule=lambda phase, rule: self.events.append((phase, rule.action)),
+            on_active=lambda: self.events.append(('active', None)),
+            scheduler=None, on_idle=self.idle_starts.append)
+
+    def idle_for(self, seconds):
+        self.clock.current += seconds
+        return self.detector.tick()
+
+    def test_default_rule_warns_then_shuts_down(self):
+        self.idle_for(29)
+        self.assertEqual(self.events, [])
+        self.idle_for(1)
+        self.assertEqual(self.events, [(RuleTable.WARN, 'shutdown')])
+        self.assertTrue(self.detector.warned)
+        self.idle_for(30)
+        self.assertEqual(self.events, [(RuleTable.WARN, 'shutdown'), (RuleTable.ACT, 'shutdown')])
+        self.assertFalse(self.detector.warned)
+        self.assertEqual(self.idle_starts, [30])
+
+    def test_input_ends_the_episode(self):
+        self.idle_for(35)
+        self.source.touch()
+        self.detector.tick()
+        self.assertEqual(self.events[-1], ('active', None))
+        self.assertEqual(self.detector.fired, 0)
+
+    def test_sleeps_until_the_next_threshold(self):
+        delay = self.detector.tick()
+        self.assertAlmostEqual(delay, 30 + IdleDetector.EDGE_MARGIN)
+
+    def test_crossing_several_tiers_in_one_wakeup_fires_them_in_order(self):
+        rules = RuleTable([IdleRule(60, 'volume', 20), IdleRule(120, 'lock'), IdleRule(600, 'shutdown', warning=60)])
+        self.detector.rules = rules
+        self.idle_for(600)
+        self.assertEqual(self.events, [(RuleTable.ACT, 'volume'), (RuleTable.ACT, 'lock'),
+                                       (RuleTable.WARN, 'shutdown'), (RuleTable.ACT, 'shutdown')])
+
+
+class ScheduledDetectorTest(unittest.TestCase):
+    """The detector waking itself through scheduler timers, as it does when running"""
+    def setUp(self):
+        self.clock = FakeClock()
+        self.source = FakeIdleSource(self.clock)
+        self.scheduler = ManualScheduler()
+        self.events = []
+        self.detector = IdleDetector(
+            self.source, self.clock, RuleTable.from_config(DEFAULT_CONFIG),
+            on_rule=lambda phase, rule: self.events.append((phase, rule.action)),
+            on_active=lambda: self.events.append(('active', None)),
+            scheduler=self.scheduler)
+        self.detector.start()
+
+    def next_timer(self):
+        return self.scheduler.timers[-1]
+
+    def run_next(self, input_after=None):
+        """Sleep until the pending wakeup, with input input_after seconds into the sleep, and run it"""
+        timer = self.next_timer()
+        if input_after is not None:
+            self.clock.current += input_after
+            self.source.touch()
+            self.clock.current += timer.delay - input_after
+        else:
+            self.clock.current += timer.delay
+        timer.fn()
+
+    def test_wakes_only_at_the_thresholds(self):
+        self.assertAlmostEqual(self.next_timer().delay, 30 + IdleDetector.EDGE_MARGIN)
+        self.run_next()
+        self.assertEqual(self.events, [(RuleTable.WARN, 'shutdown')])
+        self.assertEqual(self.next_timer().delay, IdleDetector.WARNING_POLL)
+        self.assertEqual(self.detector.wakeups, 2)
+
+    def test_input_during_the_sleep_moves_the_next_wakeup(self):
+        self.run_next(input_after=10)
+        self.assertEqual(self.events, [])
+        self.assertAlmostEqual(self.next_timer().delay, 10, places=1)
+
+    def test_stop_cancels_the_pending_wakeup(self):
+        timer = self.next_timer()
+        self.detector.stop()
+        self.assertTrue(timer.cancelled)
+        self.assertFalse(self.detector.running)
+
+
+class RuleSwapTest(unittest.TestCase):
+    """set_rules while the detector is running, e.g. on a profile boundary"""
+    def setUp(self):
+        self.clock = FakeClock()
+        self.source = FakeIdleSource(self.clock)
+        self.events = []
+        self.detector = IdleDetector(
+            self.source, self.clock, RuleTable([IdleRule(60, 'volume', 20), IdleRule(600, 'lock', warning=60)]),
+            on_rule=lambda phase, rule: self.events.append((phase, rule.action)),
+            on_active=lambda: self.events.append(('active', None)),
+            scheduler=ManualScheduler())
+        self.detector.start()
+
+    def idle_for(self, seconds):
+        self.clock.current += seconds
+        self.detector.tick()
+
+    def test_tiers_moved_below_the_idle_time_fire(self):
+        self.idle_for(100)
+        self.detector.set_rules(RuleTable([IdleRule(60, 'volume', 20), IdleRule(120, 'lock', warning=60)]))
+        self.assertEqual(self.events, [(RuleTable.ACT, 'volume'), (RuleTable.WARN, 'lock')])
+        self.assertTrue(self.detector.warned)
+        self.idle_for(20)
+        self.assertEqual(self.events[-1], (RuleTable.ACT, 'lock'))
+        self.assertFalse(self.detector.warned)
+
+    def test_fired_tiers_do_not_fire_again(self):
+        self.idle_for(100)
+        self.detector.set_rules(RuleTable([IdleRule(60, 'volume', 20), IdleRule(900, 'lock', warning=60)]))
+        self.idle_for(100)
+        self.assertEqual(self.events, [(RuleTable.ACT, 'volume')])
+        self.source.touch()
+        self.detector.tick()
+        self.assertEqual(self.events[-1], ('active', None))
+
+    def test_tiers_that_never_fired_are_not_counted_as_fired(self):
+        self.idle_for(100)
+        # The new warning tier is crossed but the user came back before the swap
+        self.source.touch()
+        self.detector.set_rules(RuleTable([IdleRule(60, 'volume', 20), IdleRule(90, 'lock', warning=60)]))
+        self.assertEqual(self.events, [(RuleTable.ACT, 'volume'), ('active', None)])
+        self.assertFalse(self.detector.warned)
+        self.assertEqual(self.detector.fired, 0)
+
+
+class ShutdownHarness:
+    """The app's watchdog handling for rule swaps, without a window or scheduler"""
+    on_detector_withdraw = IdleVolumeBase.on_detector_withdraw
+    on_warning_withdrawn = IdleVolumeBase.on_warning_withdrawn
+
+    def __init__(self):
+        self.watchdog = ShutdownWatchdog()
+        self.backend = FakeShutdownBackend()
+        self.dispatched = []
+
+    def dispatch(self, fn, key=None):
+        self.dispatched.append(key)
+
+    def on_rule(self, phase, rule):
+        arm_shutdown_watchdog(self.watchdog, phase, rule, self.backend.shutdown)
+
+
+class RuleSwapWatchdogTest(unittest.TestCase):
+    """A swap mid-warning must not leave the old shutdown deadline armed"""
+    def setUp(self):
+        self.harness = ShutdownHarness()
+        self.harness.watchdog.start()
+        self.clock = FakeClock()
+        self.detector = IdleDetector(
+            FakeIdleSource(self.clock), self.clock, RuleTable([IdleRule(60, 'shutdown', warning=0.3)]),
+            on_rule=self.harness.on_rule, on_active=lambda: None, scheduler=ManualScheduler(),
+            on_withdraw=self.harness.on_detector_withdraw)
+        self.detector.start()
+        self.clock.current = 59.8
+        self.detector.tick()
+        self.assertTrue(self.harness.watchdog.armed)
+
+    def tearDown(self):
+        self.harness.watchdog.stop()
+
+    def test_raising_the_threshold_disarms_the_shutdown(self):
+        self.detector.set_rules(RuleTable([IdleRule(600, 'shutdown', warning=0.3)]))
+        self.assertFalse(self.harness.watchdog.armed)
+        self.assertFalse(self.detector.warned)
+        self.assertEqual(self.harness.dispatched, ['idle_withdrawn'])
+        time.sleep(0.5)
+        self.assertEqual(self.harness.backend.requests, [])
+
+    def test_new_rule_already_in_its_warning_rearms(self):
+        self.detector.set_rules(RuleTable([IdleRule(60.05, 'shutdown', warning=0.5)]))
+        self.assertTrue(self.harness.watchdog.armed)
+        self.assertGreater(self.harness.watchdog.remaining(), 0.3)
+        self.assertTrue(self.detector.warned)
+
+    def test_unchanged_shutdown_rule_stays_armed(self):
+        self.detector.set_rules(RuleTable([IdleRule(30, 'volume', 20), IdleRule(60, 'shutdown', warning=0.3)]))
+        self.assertTrue(self.harness.watchdog.armed)
+        self.assertEqual(self.harness.dispatched, [])
+
+
+class VolumeEnforcerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def enforcer(self, notifications=True):
+        self.backend = FakeVolumeBackend(0.5, clock=self.clock, notifications=notifications)
+        enforcer = VolumeEnforcer(self.backend, target=50)
+        enforcer.start()
+        self.backend.calls = 0
+        return enforcer
+
+    def test_notified_change_is_reverted_without_waiting_for_a_poll(self):
+        enforcer = self.enforcer()
+        self.assertTrue(enforcer.event_driven)
+        self.assertEqual(enforcer.poll_interval, VolumeEnforcer.SAFETY_POLL_INTERVAL)
+        self.backend.external_change(0.8)
+        self.assertEqual(self.backend.level, 0.5)
+        self.assertEqual(self.backend.latencies, [0.0])
+
+    def test_notified_change_costs_one_endpoint_call(self):
+        enforcer = self.enforcer()
+        self.backend.external_change(0.8)
+        self.assertEqual(self.backend.calls, 1)  # the write; the level came with the notification
+        self.backend.external_change(0.5)
+        self.assertEqual(self.backend.calls, 1)
+        self.assertEqual(enforcer.corrections, 1)
+
+    def test_without_notifications_the_poll_reverts(self):
+        enforcer = self.enforcer(notifications=False)
+        self.assertFalse(enforcer.event_driven)
+        self.assertEqual(enforcer.poll_interval, VolumeEnforcer.POLL_INTERVAL)
+        self.backend.external_change(0.8)
+        self.assertEqual(self.backend.level, 0.8)
+        self.clock.current += enforcer.poll_interval
+        self.assertTrue(enforcer.check())
+        self.assertEqual(self.backend.level, 0.5)
+        self.assertEqual(self.backend.calls, 2)
+        self.assertEqual(self.backend.latencies, [VolumeEnforcer.POLL_INTERVAL])
+
+
+class CorrectionHarness:
+    """The shared volume correction path, without a window or daemon"""
+    on_volume_corrected = IdleVolumeBase.on_volume_corrected
+    setting = IdleVolumeBase.setting
+
+    def __init__(self, backend):
+        self.settings = Settings.from_config({**DEFAULT_CONFIG, 'volume_control_enabled': True, 'saved_volume': 40})
+        self.profile_overrides = {}
+        self.reports = []
+        self.volume_control = backend
+        self.volume_enforcer = VolumeEnforcer(backend, target=40, on_correct=self.on_volume_corrected)
+
+    def report(self, kind, state):
+        self.reports.append((kind, state['saved_volume']))
+
+    def set_volume(self, percent, force=False):
+        self.volume_control.set_level(percent / 100)
+
+
+class EndpointManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.scheduler = ManualScheduler()
+        self.devices = [FakeVolumeBackend(0.3, self.clock)]
+        self.activations = 0
+        self.recovered = []
+        self.logged = []
+        self.manager = EndpointManager(self.activate, self.scheduler.call_later, clock=self.clock,
+                                       log=self.logged.append, on_recovered=lambda: self.recovered.append(1))
+        self.assertTrue(self.manager.start())
+
+    def activate(self):
+        self.activations += 1
+        if not self.devices:
+            raise OSError("No audio device")
+        return self.devices[-1]
+
+    def lose_device(self):
+        self.devices[-1].disconnected = True
+        self.devices.append(FakeVolumeBackend(0.8, self.clock))
+
+    def run_timer(self):
+        timer = self.scheduler.timers.pop(0)
+        self.clock.current += timer.delay
+        timer.fn()
+
+    def test_failed_read_reacquires_once(self):
+        self.lose_device()
+        with self.assertRaises(OSError):
+            self.manager.get_level()
+        self.manager.invalidate()
+        self.assertEqual(len(self.scheduler.timers), 1)
+        self.run_timer()
+        self.assertEqual(self.manager.get_level(), 0.8)
+        self.assertEqual((self.activations, self.manager.reactivations), (2, 1))
+        self.assertAlmostEqual(self.manager.last_reactivation_latency, EndpointManager.SETTLE_DELAY)
+        self.assertEqual(self.recovered, [1])
+
+    def test_write_while_lost_is_applied_after_recovery(self):
+        self.lose_device()
+        self.manager.set_level(0.1)
+        self.assertEqual(len(self.scheduler.timers), 1)
+        self.manager.set_level(0.2)
+        self.run_timer()
+        self.assertEqual(self.devices[-1].level, 0.2)
+
+    def test_read_while_lost_raises_unavailable(self):
+        self.manager.invalidate()
+        self.run_timer()
+        self.devices.clear()
+        self.manager.invalidate()
+        self.run_timer()
+        self.assertFalse(self.manager.available)
+        with self.assertRaises(EndpointUnavailable):
+            self.manager.get_level()
+
+    def test_failed_activation_is_retried_with_backoff(self):
+        self.devices.clear()
+        self.manager.invalidate()
+        self.run_timer()
+        self.assertEqual(self.manager.failures, 1)
+        self.assertEqual(self.scheduler.timers[0].delay, EndpointManager.RETRY_DELAYS[0])
+        self.run_timer()
+        self.assertEqual(self.scheduler.timers[0].delay, EndpointManager.RETRY_DELAYS[1])
+        self.devices.append(FakeVolumeBackend(0.5, self.clock))
+        self.run_timer()
+        self.assertTrue(self.manager.available)
+        self.assertEqual(self.scheduler.timers, [])
+        self.assertAlmostEqual(self.manager.last_reactivation_latency,
+                               EndpointManager.SETTLE_DELAY + sum(EndpointManager.RETRY_DELAYS[:2]))
+
+
+class SessionVolumeEnforcerTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = FakeSessionBackend()
+        self.game = self.backend.add("Game.exe", 1.0)
+        self.browser = self.backend.add("browser.exe", 0.7)
+        self.enforcer = SessionVolumeEnforcer(self.backend, {'game.exe': 30}, log=lambda message: None)
+        self.enforcer.start()
+
+    def test_existing_sessions_get_their_target(self):
+        self.assertEqual(self.game.volume.level, 0.3)
+        self.assertEqual((self.browser.volume.level, self.browser.volume.writes), (0.7, 0))
+
+    def test_drift_of_a_targeted_app_is_corrected(self):
+        self.backend.external_change(self.game, 0.9)
+        self.assertEqual(self.game.volume.level, 0.3)
+        self.assertEqual(self.enforcer.corrections, 2)
+        # Untargeted applications are dropped before reaching the enforcer's thread
+        notifications = self.enforcer.notifications
+        self.backend.external_change(self.browser, 0.2)
+        self.assertEqual(self.browser.volume.level, 0.2)
+        self.assertEqual(self.enforcer.notifications, notifications)
+
+    def test_sessions_are_indexed_as_they_come_and_go(self):
+        second = self.backend.add("GAME.EXE", 0.5)
+        self.assertEqual(second.volume.level, 0.3)
+        self.assertEqual(self.enforcer.session_count, 3)
+        self.backend.expire(second)
+        self.backend.expire(self.game)
+        self.assertNotIn('game.exe', self.enforcer.index)
+        self.assertEqual(self.enforcer.session_count, 1)
+
+    def test_new_targets_apply_at_once(self):
+        self.enforcer.set_targets({'game.exe': 30, 'browser.exe': 50})
+        self.assertEqual(self.browser.volume.level, 0.5)
+        self.assertEqual(self.game.volume.writes, 1)
+
+
+class VolumeWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.backend = FakeVolumeBackend(0.3, self.clock)
+        self.scheduler = ManualScheduler()
+        self.applied = []
+        self.writer = VolumeWriter(self.backend, self.scheduler.call_later, max_rate=20, clock=self.clock,
+                                   on_applied=self.applied.append)
+
+    def test_burst_writes_the_first_and_last_levels(self):
+        for percent in range(40, 50):
+            self.writer.write(percent)
+            self.clock.current += 0.001
+        self.assertEqual(self.backend.level, 0.4)
+        self.assertEqual(len(self.scheduler.timers), 1)
+        self.clock.current += self.scheduler.timers[0].delay
+        self.scheduler.timers[0].fn()
+        self.assertEqual(self.backend.level, 0.49)
+        self.assertEqual((self.writer.writes, self.writer.coalesced), (2, 8))
+        self.assertEqual(self.applied, [40, 49])
+
+    def test_write_after_a_quiet_period_goes_out_at_once(self):
+        self.writer.write(40)
+        self.clock.current += self.writer.interval
+        self.writer.write(60)
+        self.assertEqual(self.backend.level, 0.6)
+        self.assertEqual(self.scheduler.timers, [])
+
+    def test_unchanged_level_is_skipped_unless_forced(self):
+        self.writer.write(40)
+        self.clock.current += 1
+        calls = self.backend.calls
+        self.writer.write(40)
+        self.assertEqual((self.backend.calls, self.writer.skipped), (calls, 1))
+        # Something else moved the volume; a forced write puts it back
+        self.backend.level = 0.9
+        self.writer.write(40, force=True)
+        self.assertEqual(self.backend.level, 0.4)
+        self.assertEqual(self.writer.writes, 2)
+
+    def test_cancel_drops_the_trailing_write(self):
+        self.writer.write(40)
+        self.writer.write(50)
+        timer = self.scheduler.timers[0]
+        self.writer.cancel()
+        self.assertTrue(timer.cancelled)
+        self.assertEqual(self.backend.level, 0.4)
+
+
+class VolumeCorrectionTest(unittest.TestCase):
+    def test_notified_drift_is_reported(self):
+        backend = FakeVolumeBackend(0.4)
+        harness = CorrectionHarness(backend)
+        harness.volume_enforcer.start()
+        backend.external_change(0.9)
+        self.assertEqual(backend.level, 0.4)
+        self.assertEqual(harness.reports, [('volume_corrected', 40)])
+
+
+class RuleTableTest(unittest.TestCase):
+    def test_entries_are_sorted_by_threshold(self):
+        table = RuleTable([IdleRule(600, 'lock', warning=30), IdleRule(120, 'volume', 20)])
+        self.assertEqual(table.thresholds, [120, 570, 600])
+        self.assertEqual(table.crossed(570), 2)
+        self.assertEqual(table.next_threshold(2), 600)
+        self.assertIsNone(table.next_threshold(3))
+
+    def test_invalid_rules_are_rejected(self):
+        with self.assertRaises(ValueError):
+            IdleRule(60, 'reboot')
+        with self.assertRaises(ValueError):
+            IdleRule(60, 'lock', warning=90)
+        with self.assertRaises(ValueError):
+            IdleRule(60, 'volume')
+
+
+class ReplayTest(unittest.TestCase):
+    def test_counts_match_the_trace(self):
+        # Busy for a minute, then away for two hours, twice
+        active = [(0, 60), (7260, 7320)]
+        rules = RuleTable([IdleRule(120, 'volume', 20), IdleRule(3600, 'shutdown', warning=60)])
+        replay = IdleReplay(rules, active).run(14400)
+        self.assertEqual(replay.warnings, 2)
+        self.assertEqual(replay.actions, {'volume': 2, 'shutdown': 2})
+        self.assertEqual(replay.episodes, 1)
+        self.assertEqual([(phase, action) for _, phase, action in replay.events][:3],
+                         [(RuleTable.ACT, 'volume'), (RuleTable.WARN, 'shutdown'), (RuleTable.ACT, 'shutdown')])
+
+    def test_dismissing_the_warning_prevents_the_action(self):
+        rules = RuleTable([IdleRule(600, 'shutdown', warning=60)])
+        replay = IdleReplay(rules, [(0, 10)], dismiss_after=5).run(3000)
+        self.assertEqual(replay.dismissals, replay.warnings)
+        self.assertNotIn('shutdown', replay.actions)
+
+
+class StatusLogTest(unittest.TestCase):
+    def test_buffer_keeps_the_last_lines(self):
+        log = StatusLog(None, capacity=3)
+        for i in range(5):
+            log.append(f"line {i}")
+        self.assertEqual(log.total, 5)
+        self.assertEqual([line.split(' - ')[1] for line in log.lines], ["line 2", "line 3", "line 4"])
+        # A reader two lines behind gets just those; one that fell off the buffer gets what is left
+        self.assertEqual(len(log.since(3, 10)), 2)
+        self.assertEqual(len(log.since(0, 10)), 3)
+        self.assertEqual(len(log.since(0, 1)), 1)
+        self.assertEqual(log.since(5, 10), [])
+
+    def test_file_sink_rotates(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, "vol_idle.log")
+            log = StatusLog(path, capacity=2, max_bytes=200, backups=2)
+            for i in range(50):
+                log.append(f"message {i}")
+            log.close()
+            self.assertTrue(os.path.exists(path + ".1"))
+            self.assertTrue(os.path.exists(path + ".2"))
+            self.assertFalse(os.path.exists(path + ".3"))
+            with open(path, encoding='utf-8') as f:
+                self.assertIn("message 49", f.read())
+
+
+class HistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.now = 10 * 86400.0
+        self.store = HistoryStore(os.path.join(self.workdir.name, "history.bin"), clock=lambda: self.now)
+
+    def tearDown(self):
+        self.store.close()
+        self.workdir.cleanup()
+
+    def test_idle_periods_are_clipped_to_the_range(self):
+        self.store.record(HistoryStore.IDLE, 60, timestamp=1000)
+        self.store.record(HistoryStore.ACTIVE, timestamp=2000)
+        self.store.record(HistoryStore.IDLE, 30, timestamp=3000)
+        self.store.record(HistoryStore.DISMISSED, timestamp=3100)
+        self.assertEqual(list(self.store.idle_periods(0, 10000)), [(940, 2000), (2970, 3100)])
+        self.assertEqual(list(self.store.idle_periods(1500, 3050)), [(1500, 2000), (2970, 3050)])
+
+    def test_period_open_for_days_is_found(self):
+        self.store.record(HistoryStore.IDLE, 60, timestamp=86400)
+        self.store.record(HistoryStore.WARNING, 30, timestamp=86400 + 10)
+        start = self.now - 3600
+        self.assertEqual(list(self.store.idle_periods(start, self.now)), [(start, self.now)])
+
+    def test_counts(self):
+        for kind in (HistoryStore.IDLE, HistoryStore.WARNING, HistoryStore.SHUTDOWN):
+            self.store.record(kind, timestamp=100)
+        counts = self.store.counts()
+        self.assertEqual((counts['idle'], counts['warning'], counts['shutdown'], counts['active']), (1, 1, 1, 0))
+
+
+class ConfigStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.workdir.name, "config.txt")
+        save_config(self.path, DEFAULT_CONFIG)
+        self.errors = []
+
+    def tearDown(self):
+        self.workdir.cleanup()
+
+    def store(self, debounce):
+        return ConfigStore(self.path, dict(DEFAULT_CONFIG), on_error=self.errors.append, debounce=debounce)
+
+    def test_changes_within_the_debounce_window_are_written_once(self):
+        store = self.store(0.05)
+        for percent in range(10, 20):
+            store.config['saved_volume'] = percent
+            store.mark_dirty()
+        deadline = time.monotonic() + 5
+        while (store.dirty or store.writes == 0) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(store.writes, 1)
+        self.assertEqual(load_config(self.path)['saved_volume'], 19)
+
+    def test_flush_writes_at_once_and_skips_unchanged_content(self):
+        store = self.store(60)
+        store.config['idle_threshold'] = 45
+        store.mark_dirty()
+        store.flush()
+        self.assertFalse(store.dirty)
+        self.assertEqual(load_config(self.path)['idle_threshold'], 45)
+        store.mark_dirty()
+        store.flush()
+        self.assertEqual((store.writes, store.skipped_writes), (1, 1))
+
+    def test_failed_write_leaves_the_old_file_whole(self):
+        store = self.store(60)
+        with open(self.path) as f:
+            before = f.read()
+        store.config['saved_volume'] = 10
+        store.mark_dirty()
+        with mock.patch('vol_idle.os.replace', side_effect=OSError("disk full")):
+            store.flush()
+        with open(self.path) as f:
+            self.assertEqual(f.read(), before)
+        self.assertEqual(os.listdir(self.workdir.name), ["config.txt"])
+        self.assertEqual(len(self.errors), 1)
+        self.assertEqual(store.written, before)
+
+
+class ConfigWatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.workdir.name, "config.txt")
+        self.current = dict(DEFAULT_CONFIG)
+        self.written = None
+        self.mtime_ns = 1_000_000_000_000_000_000
+        self.write(self.current)
+        self.reloads = []
+        self.watcher = ConfigWatcher(self.path, lambda: self.current,
+                                     lambda changes, mtime: self.reloads.append(changes),
+                                     ignore=lambda text: text == self.written)
+
+    def tearDown(self):
+        self.workdir.cleanup()
+
+    def write(self, config, ours=False):
+        save_config(self.path, config)
+        if ours:
+            with open(self.path) as f:
+                self.written = f.read()
+        # Each write gets its own mtime even on file systems with coarse timestamps
+        self.mtime_ns += 1_000_000_000
+        os.utime(self.path, ns=(self.mtime_ns, self.mtime_ns))
+
+    def test_reports_only_the_changed_keys(self):
+        self.write({**DEFAULT_CONFIG, 'idle_threshold': 45})
+        self.assertTrue(self.watcher.check())
+        self.assertEqual(self.reloads, [{'idle_threshold': 45}])
+
+    def test_unchanged_file_is_not_read(self):
+        self.assertFalse(self.watcher.check())
+        self.assertEqual((self.watcher.checks, self.watcher.parses), (1, 0))
+
+    def test_own_writes_are_not_parsed(self):
+        self.write({**DEFAULT_CONFIG, 'saved_volume': 20}, ours=True)
+        self.assertFalse(self.watcher.check())
+        self.assertEqual(self.watcher.parses, 0)
+        self.assertEqual(self.reloads, [])
+
+    def test_invalid_file_is_ignored(self):
+        with open(self.path, 'w') as f:
+            f.write("{not json")
+        with redirect_stdout(StringIO()):
+            self.assertFalse(self.watcher.check())
+        self.assertEqual(self.reloads, [])
+
+
+class SettingsTest(unittest.TestCase):
+    def test_invalid_values_fall_back_to_defaults(self):
+        settings = Settings.from_config({**DEFAULT_CONFIG, 'saved_volume': 150, 'idle_threshold': 'soon'})
+        self.assertEqual(settings.saved_volume, DEFAULT_CONFIG['saved_volume'])
+        self.assertEqual(settings.idle_threshold, DEFAULT_CONFIG['idle_threshold'])
+        self.assertEqual(len(settings.errors), 2)
+
+    def test_snapshots_are_read_only(self):
+        settings = Settings.from_config(DEFAULT_CONFIG)
+        with self.assertRaises(AttributeError):
+            settings.saved_volume = 10
+
+
+class UIEventQueueTest(unittest.TestCase):
+    def test_keyed_posts_collapse_to_the_latest(self):
+        wakeups = []
+        ran = []
+        queue = UIEventQueue(lambda: wakeups.append(1))
+        for level in range(5):
+            queue.post(lambda level=level: ran.append(('volume', level)), key='volume')
+        queue.post(lambda: ran.append('log'))
+        queue.post(lambda: ran.append('log'))
+        self.assertEqual((queue.posted, queue.collapsed), (7, 4))
+        self.assertEqual(len(wakeups), 1)
+        self.assertEqual(queue.drain(), 3)
+        self.assertEqual(ran, [('volume', 4), 'log', 'log'])
+        self.assertEqual(queue.batches, 1)
+
+    def test_each_batch_notifies_once(self):
+        wakeups = []
+        queue = UIEventQueue(lambda: wakeups.append(1))
+        queue.post(lambda: None, key='a')
+        queue.post(lambda: None, key='b')
+        queue.drain()
+        queue.post(lambda: None, key='a')
+        self.assertEqual(len(wakeups), 2)
+        self.assertTrue(queue.wait(0))
+        queue.drain()
+        self.assertFalse(queue.wait(0))
+        self.assertEqual(queue.drain(), 0)
+        self.assertEqual(queue.batches, 2)
+
+    def test_failed_notify_is_retried_on_the_next_post(self):
+        wakeups = []
+
+        def notify():
+            wakeups.append(len(wakeups))
+            if len(wakeups) == 1:
+                raise RuntimeError("main thread is not in main loop")
+
+        queue = UIEventQueue(notify)
+        with redirect_stdout(StringIO()):
+            queue.post(lambda: None)
+        queue.post(lambda: None)
+        self.assertEqual(len(wakeups), 2)
+        self.assertEqual(queue.drain(), 2)
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = Scheduler()
+        self.scheduler.start()
+        self.addCleanup(self.scheduler.stop)
+
+    def sync(self):
+        """Wait until the loop has run everything submitted so far"""
+        done = threading.Event()
+        self.scheduler.submit(done.set)
+        self.assertTrue(done.wait(5))
+
+    def test_timer_due_just_before_another_shares_its_wakeup(self):
+        ran = threading.Event()
+        order = []
+        self.scheduler.call_later(0.2, lambda: (order.append('late'), ran.set()))
+        self.scheduler.call_later(0.1, lambda: order.append('early'))
+        self.assertTrue(ran.wait(5))
+        self.sync()
+        stats = self.scheduler.stats()
+        # Both run on the later wakeup, in the order they were scheduled
+        self.assertEqual(order, ['late', 'early'])
+        self.assertEqual((stats['coalesced'], stats['wakeups'], stats['callbacks']), (1, 1, 2))
+
+    def test_paused_feature_runs_on_resume(self):
+        idle = threading.Event()
+        other = threading.Event()
+        self.scheduler.pause('idle')
+        self.scheduler.call_later(0, idle.set, feature='idle')
+        self.scheduler.call_later(0.05, other.set)
+        self.assertTrue(other.wait(5))
+        self.sync()
+        self.assertFalse(idle.is_set())
+        self.assertEqual(self.scheduler.stats()['paused_features'], ['idle'])
+        self.scheduler.resume('idle')
+        self.assertTrue(idle.wait(5))
+        self.assertEqual(self.scheduler.stats()['paused_features'], [])
+
+    def test_cancelled_timer_does_not_run(self):
+        ran = threading.Event()
+        timer = self.scheduler.call_later(0.05, lambda: self.fail("cancelled timer ran"))
+        timer.cancel()
+        self.scheduler.call_later(0.1, ran.set)
+        self.assertTrue(ran.wait(5))
+        self.sync()
+        self.assertEqual(self.scheduler.stats()['callbacks'], 1)
+
+
+class MetricsTest(unittest.TestCase):
+    class Endpoint:
+        def set_level(self, level):
+            return level
+
+    def setUp(self):
+        self.metrics = Metrics()
+        self.metrics.enabled = True
+
+    def test_nothing_is_recorded_while_disabled(self):
+        self.metrics.enabled = False
+        endpoint = self.Endpoint()
+        self.metrics.inc('idle_warnings')
+        self.metrics.instrument(endpoint, 'set_level', 'set_level_seconds')
+        self.metrics.add_collector(lambda: {'volume': 1})
+        self.assertNotIn('set_level', vars(endpoint))
+        self.assertEqual(self.metrics.snapshot()['counters'], {})
+        self.assertEqual(self.metrics.collectors, [])
+
+    def test_instrumenting_twice_times_each_call_once(self):
+        endpoint = self.Endpoint()
+        self.metrics.instrument(endpoint, 'set_level', 'set_level_seconds')
+        self.metrics.instrument(endpoint, 'set_level', 'set_level_seconds')
+        self.assertEqual(endpoint.set_level(0.5), 0.5)
+        self.assertEqual(self.metrics.histograms['set_level_seconds'].count, 1)
+        # Switched off by a reload: the wrapper stays but stops timing
+        self.metrics.enabled = False
+        endpoint.set_level(0.4)
+        self.assertEqual(self.metrics.histograms['set_level_seconds'].count, 1)
+
+    def test_prometheus_text(self):
+        self.metrics.inc('idle_warnings')
+        self.metrics.inc('idle_warnings')
+        self.metrics.add_collector(lambda: {'volume_percent': 40})
+        with self.metrics.measure('config_write_seconds'):
+            pass
+        text = self.metrics.render_prometheus()
+        self.assertIn("# TYPE volidle_idle_warnings_total counter\nvolidle_idle_warnings_total 2\n", text)
+        self.assertIn("volidle_volume_percent 40.0\n", text)
+        self.assertIn('volidle_config_write_seconds_bucket{le="+Inf"} 1\n', text)
+        self.assertIn("volidle_config_write_seconds_count 1\n", text)
+
+    def test_export_writes_both_files(self):
+        self.metrics.inc('shutdowns')
+        with tempfile.TemporaryDirectory() as workdir:
+            textfile = os.path.join(workdir, "vol_idle.prom")
+            json_file = os.path.join(workdir, "vol_idle_metrics.json")
+            self.metrics.export(textfile, json_file)
+            with open(textfile) as f:
+                self.assertIn("volidle_shutdowns_total 1", f.read())
+            with open(json_file) as f:
+                self.assertEqual(json.load(f)['counters'], {'shutdowns': 1})
+            self.assertEqual(sorted(os.listdir(workdir)), ["vol_idle.prom", "vol_idle_metrics.json"])
+
+
+class ProfileTest(unittest.TestCase):
+    def profile(self, settings):
+        log = []
+        schedule = ProfileSchedule.from_config(
+            {'profiles': [{'name': 'night', 'start': '22:00', 'end': '07:00', 'settings': settings}]}, log.append)
+        return schedule.profiles[0], log
+
+    def test_invalid_overrides_are_dropped(self):
+        profile, log = self.profile({'idle_threshold': '10', 'saved_volume': 'loud', 'shutdown_delay': 30})
+        self.assertEqual(profile.settings, {'shutdown_delay': 30})
+        self.assertEqual(len(log), 2)
+
+    def test_overrides_are_coerced(self):
+        profile, log = self.profile({'idle_threshold': 600.0})
+        self.assertIs(type(profile.settings['idle_threshold']), int)
+        self.assertEqual(log, [])
+
+
+class ProfileScheduleTest(unittest.TestCase):
+    MONDAY = datetime.date(2024, 1, 1)
+
+    def setUp(self):
+        self.now = self.at(0, 12)
+
+    def at(self, days, hour, minute=0):
+        """Local timestamp `days` after Monday 1 January 2024"""
+        day = self.MONDAY + datetime.timedelta(days=days)
+        return datetime.datetime.combine(day, datetime.time(hour, minute)).timestamp()
+
+    def schedule(self, *specs):
+        return ProfileSchedule([Profile.from_dict(spec) for spec in specs], clock=lambda: self.now)
+
+    def test_overnight_window_runs_into_the_next_day(self):
+        schedule = self.schedule({'name': 'night', 'start': '22:00', 'end': '07:00', 'days': ['Mon']})
+        active = [bool(schedule.active(when)) for when in
+                  (self.at(0, 21, 59), self.at(0, 22), self.at(1, 6, 59), self.at(1, 7), self.at(1, 23))]
+        self.assertEqual(active, [False, True, True, False, False])
+
+    def test_later_profiles_win(self):
+        schedule = self.schedule(
+            {'name': 'evening', 'start': '18:00', 'end': '23:00',
+             'settings': {'saved_volume': 30, 'idle_threshold': 60}},
+            {'name': 'late', 'start': '21:00', 'end': '23:00',
+             'settings': {'saved_volume': 10}})
+        self.assertEqual(schedule.overrides(self.at(0, 19)), {'saved_volume': 30, 'idle_threshold': 60})
+        self.assertEqual(schedule.overrides(self.at(0, 22)), {'saved_volume': 10, 'idle_threshold': 60})
+        self.assertEqual(schedule.overrides(self.at(0, 23)), {})
+
+    def test_next_transition_walks_the_boundaries(self):
+        schedule = self.schedule({'name': 'night', 'start': '22:00', 'end': '07:00'})
+        self.assertEqual(schedule.next_transition(), self.at(0, 22))
+        self.now = self.at(0, 22)
+        self.assertEqual(schedule.next_transition(), self.at(1, 7))
+        self.now = self.at(1, 8)
+        self.assertEqual(schedule.next_transition(), self.at(1, 22))
+
+    def test_next_transition_skips_to_the_listed_days(self):
+        schedule = self.schedule({'name': 'weekend', 'start': '09:00', 'end': '09:00', 'days': ['sat', 'sun']})
+        self.assertEqual(schedule.next_transition(), self.at(5, 9))
+        self.assertTrue(schedule.active(self.at(6, 8)))
+        self.assertFalse(schedule.active(self.at(7, 9)))
+
+
+class ConfigCommandTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.workdir.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.workdir.cleanup()
+
+    def test_set_merges_into_the_existing_file(self):
+        save_config("config.txt", {**DEFAULT_CONFIG, 'saved_volume': 20})
+        self.assertEqual(main(['config', 'set', 'idle_threshold=45']), 0)
+        config = load_config("config.txt")
+        self.assertEqual((config['idle_threshold'], config['saved_volume']), (45, 20))
+
+    def test_set_refuses_to_replace_a_file_that_does_not_parse(self):
+        with open("config.txt", 'w') as f:
+            f.write("{not json")
+        with redirect_stderr(StringIO()):
+            self.assertEqual(main(['config', 'set', 'idle_threshold=45']), 1)
+        with open("config.txt") as f:
+            self.assertEqual(f.read(), "{not json")
+
+    def test_set_rejects_invalid_values(self):
+        with redirect_stderr(StringIO()):
+            self.assertEqual(main(['config', 'set', 'saved_volume=150']), 1)
+        self.assertFalse(os.path.exists("config.txt"))
+
+
+class VolumeCommandTest(unittest.TestCase):
+    def test_get_reads_the_endpoint_when_the_instance_has_volume_control_off(self):
+        reply = {'ok': True, 'volume': None}
+        with mock.patch('vol_idle.instance_request', return_value=reply), \
+                mock.patch('vol_idle.open_volume_backend', return_value=FakeVolumeBackend(0.33)), \
+                redirect_stdout(StringIO()) as out:
+            self.assertEqual(main(['volume', 'get']), 0)
+        self.assertEqual(out.getvalue().strip(), "33")
+
+
+class ShutdownTest(unittest.TestCase):
+    def setUp(self):
+        self.watchdog = ShutdownWatchdog()
+        self.watchdog.start()
+        self.backend = FakeShutdownBackend()
+
+    def tearDown(self):
+        self.watchdog.stop()
+
+    def wait_for_requests(self, count, timeout=2.0):
+        deadline = time.monotonic() + timeout
+        while len(self.backend.requests) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_warned_shutdown_fires_after_the_warning(self):
+        rule = IdleRule(60, 'shutdown', warning=0.05)
+        arm_shutdown_watchdog(self.watchdog, RuleTable.WARN, rule, self.backend.shutdown)
+        arm_shutdown_watchdog(self.watchdog, RuleTable.ACT, rule, self.backend.shutdown)
+        self.wait_for_requests(1)
+        self.assertEqual(len(self.backend.requests), 1)
+        self.assertEqual(self.watchdog.fired, 1)
+
+    def test_cancel_prevents_the_shutdown(self):
+        self.watchdog.arm(0.1, self.backend.shutdown)
+        self.assertTrue(self.watchdog.cancel())
+        time.sleep(0.2)
+        self.assertEqual(self.backend.requests, [])
+
+    def test_other_actions_do_not_arm_the_watchdog(self):
+        arm_shutdown_watchdog(self.watchdog, RuleTable.WARN, IdleRule(60, 'lock', warning=30), self.backend.shutdown)
+        self.assertFalse(self.watchdog.armed)
+
+    def test_stuck_hook_does_not_hold_up_the_shutdown(self):
+        backend = DryRunShutdownBackend(log=lambda message: None)
+        executor = ShutdownExecutor(backend, [('ok', lambda: None), ('stuck', lambda: time.sleep(5))],
+                                    timeout=0.1, log=lambda message: None)
+        start = time.monotonic()
+        executor.shutdown()
+        self.assertLess(time.monotonic() - start, 1.0)
+        self.assertEqual(len(backend.requests), 1)
+        self.assertEqual([(name, status) for name, _, status in executor.results], [('ok', 'ok')])
+
+
+class CollectorTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.collector = ReportCollector(clock=lambda: self.now)
+
+    def report(self, host, *snapshots):
+        self.collector.receive({'host': host, 'snapshots': list(snapshots)})
+
+    def test_keeps_the_latest_state_of_known_fields(self):
+        self.report('ws1', {'kind': 'sample', 'idle_seconds': 5, 'secret': 'x'},
+                    {'kind': 'bogus', 'idle_seconds': 9})
+        entry = self.collector.hosts['ws1']
+        self.assertEqual(entry['state'], {'kind': 'other', 'idle_seconds': 9})
+        self.assertEqual(entry['kinds'], {'sample': 1, 'other': 1})
+
+    def test_least_recently_seen_host_is_evicted(self):
+        self.collector.MAX_HOSTS = 2
+        for host in ('a', 'b', 'a', 'c'):
+            self.report(host, {'kind': 'sample'})
+        self.assertEqual(list(self.collector.hosts), ['a', 'c'])
+        self.assertEqual(self.collector.evicted, 1)
+
+    def test_silent_hosts_expire(self):
+        self.report('old', {'kind': 'sample'})
+        self.now += ReportCollector.HOST_EXPIRY + 1
+        self.report('new', {'kind': 'sample'})
+        self.assertEqual(list(self.collector.hosts), ['new'])
+
+
+class ControlServerTest(unittest.TestCase):
+    def setUp(self):
+        self.home = tempfile.TemporaryDirectory()
+        environ = mock.patch.dict(os.environ, {'HOME': self.home.name, 'LOCALAPPDATA': self.home.name})
+        environ.start()
+        self.addCleanup(environ.stop)
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            self.port = probe.getsockname()[1]
+        self.scheduler = Scheduler()
+        self.scheduler.start()
+        self.server = ControlServer(self.port)
+        self.assertTrue(self.server.bind())
+        self.server.start(self.scheduler.loop, {'status': lambda request: {'pid': os.getpid()}},
+                          lambda fn: fn()).result(5)
+
+    def tearDown(self):
+        # Let the server see the clients hang up before its loop stops
+        deadline = time.monotonic() + 2
+        while self.server.clients and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.server.close()
+        self.scheduler.stop()
+        self.home.cleanup()
+
+    def send(self, request):
+        with socket.create_connection(('127.0.0.1', self.port), timeout=5) as sock:
+            sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+            with sock.makefile('r', encoding='utf-8') as f:
+                return json.loads(f.readline())
+
+    def test_requests_with_the_token_are_served(self):
+        self.assertEqual(control_request(self.port, {'cmd': 'status'}), {'ok': True, 'pid': os.getpid()})
+
+    def test_requests_without_the_token_are_rejected(self):
+        self.assertEqual(self.send({'cmd': 'status'}), {'ok': False, 'error': "Not authorized"})
+        self.assertEqual(self.send({'cmd': 'status', 'token': 'guess'})['ok'], False)
+        self.assertEqual(self.server.rejected, 2)
+
+    @unittest.skipIf(os.name == 'nt', "Windows protects the profile directory with ACLs instead")
+    def test_token_is_readable_by_this_user_only(self):
+        self.assertEqual(os.stat(control_token_file(self.port)).st_mode & 0o777, 0o600)
+
+    def test_close_removes_the_token(self):
+        self.server.close()
+        self.assertFalse(os.path.exists(control_token_file(self.port)))
+
+    def test_sessions_get_their_own_port(self):
+        with mock.patch('vol_idle.session_id', return_value=3):
+            self.assertEqual(session_port(47613), 47616)
+            self.assertEqual(session_port(65534), 65531)
+        with mock.patch('vol_idle.session_id', return_value=0):
+            self.assertEqual(session_port(47613), 47613)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,100 +1,4422 @@
 import ctypes
 import time
+_STARTED = time.perf_counter()
 import os
-import tkinter as tk
-from tkinter import ttk, messagebox
-from threading import Thread
+from threading import Thread, Event, Condition, Lock, get_ident as threading_ident
 import sys
 import json
-from pycaw.pycaw import AudioUtilities, IAudioEndpointVolume
-from ctypes import cast, POINTER
-from comtypes import CLSCTX_ALL
+import argparse
+import heapq
+import itertools
+import functools
+import tempfile
+import select
+import socket
+import bisect
+import math
+import random
+import datetime
+import struct
+import mmap
+import copy
+import zlib
+from collections import deque
+from contextlib import contextmanager
 
-class SystemUtilitiesApp:
-    def __init__(self, root):
+# Tk is imported on demand so daemon mode never loads it unless a warning
+# actually has to be shown. pycaw/comtypes are imported the first time
+# volume control is enabled (see open_volume_backend), and asyncio, logging
+# and subprocess where they are used, so one-shot commands load none of them.
+tk = ttk = messagebox = None
+
+CONFIG_FILE = "config.txt"
+LOG_FILE = "vol_idle.log"
+
+DEFAULT_CONFIG = {
+    'idle_threshold': 30,
+    'shutdown_delay': 30,
+    'saved_volume': 50,
+    'hide_on_startup': False,
+    'idle_detector_enabled': True,
+    'volume_control_enabled': True,
+    'volume_write_rate': 20,
+    'metrics_enabled': False,
+    'metrics_interval': 60,
+    'metrics_textfile': 'vol_idle.prom',
+    'metrics_json': 'vol_idle_metrics.json',
+    'history_file': 'vol_idle_history.bin',
+    'idle_rules': [],
+    'control_port': 47613,
+    'app_volumes': {},
+    'profiles': [],
+    'shutdown_command': [],
+    'shutdown_hooks': [],
+    'shutdown_hook_timeout': 5,
+    'shutdown_dry_run': False,
+    'report_collector': None,
+    'report_interval': 60
+}
+
+
+def load_tk():
+    """Import tkinter into the module globals"""
+    global tk, ttk, messagebox
+    if tk is None:
+        import tkinter
+        from tkinter import ttk as tk_ttk, messagebox as tk_messagebox
+        tk, ttk, messagebox = tkinter, tk_ttk, tk_messagebox
+
+
+def read_config(config_file):
+    """Configuration from file merged over the defaults; raises if the file exists but cannot be read"""
+    if not os.path.exists(config_file):
+        return dict(DEFAULT_CONFIG)
+    with open(config_file, 'r') as f:
+        loaded_config = json.load(f)
+    if not isinstance(loaded_config, dict):
+        raise ValueError("expected a JSON object")
+    # Merge with defaults to ensure all keys exist
+    return {**DEFAULT_CONFIG, **loaded_config}
+
+
+def load_config(config_file):
+    """Load configuration from file or create default"""
+    try:
+        return read_config(config_file)
+    except Exception as e:
+        print(f"Error loading config: {e}")
+        return dict(DEFAULT_CONFIG)
+
+
+def serialize_config(config):
+    return json.dumps(config, indent=4)
+
+
+def write_atomic(path, data):
+    """Replace path with data via temp file and rename, so a crash never truncates it"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def save_config(config_file, config):
+    """Atomically save configuration to file; raises on failure"""
+    write_atomic(config_file, serialize_config(config))
+
+
+def resident_memory_mb():
+    """Resident memory of this process in MB, or None if unknown"""
+    if sys.platform == 'win32':
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [
+                ('cb', ctypes.c_ulong),
+                ('PageFaultCount', ctypes.c_ulong),
+                ('PeakWorkingSetSize', ctypes.c_size_t),
+                ('WorkingSetSize', ctypes.c_size_t),
+                ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+                ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+                ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                ('PagefileUsage', ctypes.c_size_t),
+                ('PeakPagefileUsage', ctypes.c_size_t),
+            ]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return counters.WorkingSetSize / 1048576
+        return None
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1048576
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class StartupProfile:
+    """Wall-clock time spent in each startup phase"""
+    def __init__(self):
+        self.phases = {}
+
+    def record(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def report(self):
+        lines = [f"{name:<12}{seconds * 1000:8.1f} ms" for name, seconds in self.phases.items()]
+        lines.append(f"{'total':<12}{(time.perf_counter() - _STARTED) * 1000:8.1f} ms")
+        return "\n".join(lines)
+
+
+STARTUP = StartupProfile()
+
+
+def startup_report():
+    """Startup time and resident memory, for comparing GUI and daemon mode"""
+    elapsed_ms = (time.perf_counter() - _STARTED) * 1000
+    memory = resident_memory_mb()
+    memory_text = f"{memory:.1f} MB" if memory is not None else "unknown"
+    return f"Started in {elapsed_ms:.0f} ms, resident memory {memory_text}"
+
+
+def open_volume_backend():
+    """Import the audio stack and activate the default speakers; raises if unavailable"""
+    from ctypes import cast, POINTER
+    from comtypes import CLSCTX_ALL
+    from pycaw.pycaw import AudioUtilities, IAudioEndpointVolume
+    
+    devices = AudioUtilities.GetSpeakers()
+    interface = devices.Activate(
+        IAudioEndpointVolume._iid_, CLSCTX_ALL, None)
+    return PycawVolumeBackend(cast(interface, POINTER(IAudioEndpointVolume)))
+
+
+def watch_default_device(on_change):
+    """Call on_change when the default playback device changes; returns an unregister function"""
+    from pycaw.pycaw import AudioUtilities
+    
+    enumerator = AudioUtilities.GetDeviceEnumerator()
+    client = device_notification_client_class()(on_change)
+    enumerator.RegisterEndpointNotificationCallback(client)
+    return lambda: enumerator.UnregisterEndpointNotificationCallback(client)
+
+
+WARNING_VERBS = {'volume': 'lower its volume', 'lock': 'lock', 'sleep': 'go to sleep', 'shutdown': 'shutdown'}
+
+
+class WarningWindow:
+    """Idle warning window, built once and then only shown and hidden
+
+    Creating the Toplevel and its widgets costs far more than mapping an
+    existing one, so the window is built withdrawn ahead of time and show()
+    only updates its text. on_visible gets the seconds between the warning
+    being requested and the window being mapped.
+    """
+    def __init__(self, parent, on_ok, on_visible=None):
+        self.on_visible = on_visible
+        self.requested = None
+        self.shown = False
+        
+        # Create a top-level window for the warning, hidden until needed
+        self.window = tk.Toplevel(parent)
+        self.window.withdraw()
+        self.window.title("Idle Warning")
+        self.window.geometry("400x220")
+        self.window.resizable(False, False)
+        
+        # Make sure the warning window stays on top
+        self.window.attributes('-topmost', True)
+        
+        # Main message
+        self.message = ttk.Label(self.window, wraplength=380, padding=10)
+        self.message.pack(pady=(10, 0))
+        
+        # Countdown display
+        self.countdown_label = ttk.Label(self.window, font=('Arial', 10, 'bold'))
+        self.countdown_label.pack(pady=5)
+        
+        # OK button; closing the window counts as OK so it is never destroyed
+        ttk.Button(self.window, text="OK", command=on_ok).pack(pady=10)
+        self.window.protocol("WM_DELETE_WINDOW", on_ok)
+        self.window.bind('<Map>', self.on_map)
+
+    def show(self, seconds, action='shutdown', requested=None):
+        """Map the window; requested is the perf_counter() time the warning was asked for"""
+        self.message.config(
+            text=f"Idle detected! This computer will {WARNING_VERBS[action]} soon if you don't interact.")
+        self.set_remaining(seconds)
+        self.requested = requested if requested is not None else time.perf_counter()
+        self.shown = True
+        self.window.deiconify()
+        self.window.lift()
+
+    def set_remaining(self, seconds):
+        self.countdown_label.config(text=f"Time remaining: {seconds} seconds")
+
+    def hide(self):
+        self.requested = None
+        self.shown = False
+        self.window.withdraw()
+
+    def on_map(self, event):
+        # Child widgets share the toplevel's bindings; only the window itself counts
+        if event.widget is not self.window or self.requested is None:
+            return
+        latency = time.perf_counter() - self.requested
+        self.requested = None
+        if self.on_visible:
+            self.on_visible(latency)
+
+# ==============================================
+# CONFIG STORE
+# ==============================================
+class ConfigStore:
+    """Config dict with debounced, atomic background writes
+
+    UI handlers change `config` and call `mark_dirty`; a writer thread
+    saves once changes have settled for `debounce` seconds and skips the
+    write when the serialized content matches what is already on disk.
+    """
+    DEBOUNCE = 0.5
+
+    def __init__(self, config_file, config=None, on_error=None, debounce=DEBOUNCE):
+        self.config_file = config_file
+        self.config = config if config is not None else load_config(config_file)
+        self.on_error = on_error
+        self.debounce = debounce
+        self.writes = 0
+        self.skipped_writes = 0
+        self._cond = Condition()
+        # flush (UI or hook thread) and the writer thread may write at once
+        self._write_lock = Lock()
+        self._dirty = False
+        self._due = 0.0
+        self._thread = None
+        try:
+            with open(config_file, 'r') as f:
+                self._written = f.read()
+        except OSError:
+            self._written = None
+
+    @property
+    def dirty(self):
+        return self._dirty
+
+    @property
+    def written(self):
+        """Text of the last write (or load), to recognise our own changes"""
+        return self._written
+
+    def mark_dirty(self):
+        """Schedule a write; repeated calls within the debounce window coalesce"""
+        with self._cond:
+            self._dirty = True
+            self._due = time.monotonic() + self.debounce
+            if self._thread is None:
+                self._thread = Thread(target=self._writer, daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def flush(self):
+        """Write pending changes immediately on the calling thread"""
+        with self._cond:
+            if not self._dirty:
+                return
+            self._dirty = False
+        self._write()
+
+    def _writer(self):
+        while True:
+            with self._cond:
+                while not self._dirty:
+                    self._cond.wait()
+                # Restart the wait whenever another change pushes the due time out
+                while self._dirty and time.monotonic() < self._due:
+                    self._cond.wait(self._due - time.monotonic())
+                if not self._dirty:
+                    continue
+                self._dirty = False
+            self._write()
+
+    def _write(self):
+        with self._write_lock:
+            # Snapshot under the lock, so a write that starts later never
+            # loses to an older snapshot finishing after it. dict() copies
+            # atomically, so UI-thread changes can't break serialization
+            data = serialize_config(dict(self.config))
+            if data == self._written:
+                self.skipped_writes += 1
+                return
+            previous, self._written = self._written, data  # set first so watchers ignore this write
+            try:
+                write_atomic(self.config_file, data)
+                self.writes += 1
+            except Exception as e:
+                self._written = previous
+                if self.on_error:
+                    self.on_error(e)
+                else:
+                    print(f"Error saving config: {e}")
+
+
+class Win32ChangeNotifier:
+    """Directory change notifications through FindFirstChangeNotification"""
+    FILE_NOTIFY_CHANGE_FILE_NAME = 0x01
+    FILE_NOTIFY_CHANGE_SIZE = 0x08
+    FILE_NOTIFY_CHANGE_LAST_WRITE = 0x10
+    WAIT_OBJECT_0 = 0
+
+    def __init__(self, directory):
+        self._kernel32 = ctypes.windll.kernel32
+        self._kernel32.FindFirstChangeNotificationW.restype = ctypes.c_void_p
+        handle = self._kernel32.FindFirstChangeNotificationW(
+            directory, False,
+            self.FILE_NOTIFY_CHANGE_FILE_NAME | self.FILE_NOTIFY_CHANGE_SIZE | self.FILE_NOTIFY_CHANGE_LAST_WRITE
+        )
+        if handle is None or handle == ctypes.c_void_p(-1).value:
+            raise ctypes.WinError()
+        self._handle = ctypes.c_void_p(handle)
+
+    def wait(self, timeout):
+        """Block until something in the directory changes; False on timeout"""
+        result = self._kernel32.WaitForSingleObject(self._handle, int(timeout * 1000))
+        if result != self.WAIT_OBJECT_0:
+            return False
+        self._kernel32.FindNextChangeNotification(self._handle)
+        return True
+
+    def close(self):
+        self._kernel32.FindCloseChangeNotification(self._handle)
+
+
+class InotifyChangeNotifier:
+    """Directory change notifications through inotify"""
+    IN_MODIFY = 0x002
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+
+    def __init__(self, directory):
+        libc = ctypes.CDLL(None, use_errno=True)
+        self._fd = libc.inotify_init1(os.O_NONBLOCK)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        if libc.inotify_add_watch(self._fd, os.fsencode(directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(errno, "inotify_add_watch failed")
+
+    def wait(self, timeout):
+        """Block until something in the directory changes; False on timeout"""
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return False
+        try:
+            while os.read(self._fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self._fd)
+
+
+def open_change_notifier(directory):
+    """Best available directory change notifier, or None to fall back to polling"""
+    try:
+        if sys.platform == 'win32':
+            return Win32ChangeNotifier(directory)
+        if sys.platform.startswith('linux'):
+            return InotifyChangeNotifier(directory)
+    except (OSError, AttributeError):
+        pass
+    return None
+
+
+class ConfigWatcher:
+    """Reloads config.txt when another program changes it
+
+    Waits on directory change notifications where available and otherwise
+    polls a cheap stat() signature. The file is only read when its
+    mtime/size changed and only parsed when the text differs from what
+    `ignore` reports as our own last write. `on_change(changes, mtime)`
+    receives just the keys whose values differ from `current()`, on the
+    watcher thread.
+    """
+    POLL_INTERVAL = 2.0
+    NOTIFY_TIMEOUT = 30.0   # stat check now and then even with notifications
+
+    def __init__(self, config_file, current, on_change, ignore=None, poll_interval=POLL_INTERVAL):
+        self.config_file = os.path.abspath(config_file)
+        self.current = current
+        self.on_change = on_change
+        self.ignore = ignore
+        self.poll_interval = poll_interval
+        self.mode = None
+        self.checks = 0
+        self.parses = 0
+        self.reloads = 0
+        self.last_reload_latency = None
+        self.max_reload_latency = 0.0
+        self.signature = self._signature()
+        self._stop_event = None
+        self._thread = None
+
+    def _signature(self):
+        try:
+            st = os.stat(self.config_file)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def check(self):
+        """Reload the file if it changed; returns True if on_change was called"""
+        self.checks += 1
+        signature = self._signature()
+        if signature is None or signature == self.signature:
+            return False
+        self.signature = signature
+        try:
+            with open(self.config_file, 'r') as f:
+                text = f.read()
+        except OSError:
+            return False
+        if self.ignore and self.ignore(text):
+            return False
+        
+        self.parses += 1
+        try:
+            loaded = {**DEFAULT_CONFIG, **json.loads(text)}
+        except ValueError as e:
+            print(f"Ignoring invalid config: {e}")
+            return False
+        current = self.current()
+        changes = {key: value for key, value in loaded.items() if current.get(key) != value}
+        if not changes:
+            return False
+        self.on_change(changes, signature[0] / 1e9)
+        return True
+
+    def record_reload(self, mtime):
+        """Note that changes from a file written at mtime have been applied"""
+        self.reloads += 1
+        self.last_reload_latency = max(0.0, time.time() - mtime)
+        self.max_reload_latency = max(self.max_reload_latency, self.last_reload_latency)
+
+    def describe_reload(self, changes):
+        return (f"Reloaded config ({', '.join(sorted(changes))}) "
+                f"in {self.last_reload_latency * 1000:.0f} ms, {self.parses} parses")
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop_event = Event()
+        notifier = open_change_notifier(os.path.dirname(self.config_file))
+        self.mode = 'notify' if notifier else 'poll'
+        self._thread = Thread(target=self._run, args=(notifier, self._stop_event), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._stop_event is not None:
+            self._stop_event.set()
+        self._thread = None
+
+    def _run(self, notifier, stop_event):
+        try:
+            while not stop_event.is_set():
+                if notifier:
+                    notifier.wait(self.NOTIFY_TIMEOUT)
+                else:
+                    stop_event.wait(self.poll_interval)
+                if stop_event.is_set():
+                    break
+                try:
+                    self.check()
+                except Exception as e:
+                    print(f"Error reloading config: {e}")
+        finally:
+            if notifier:
+                notifier.close()
+
+
+# ==============================================
+# SETTINGS
+# ==============================================
+class Settings:
+    """Typed, validated, read-only snapshot of config.txt
+
+    The config dict is the editing buffer; every change publishes a new
+    Settings object in a single reference assignment, so worker threads and
+    hot paths read plain attributes of a consistent snapshot without locks
+    or dict lookups. Values are validated once, here: a value of the wrong
+    type or out of range is replaced by its default and listed in `errors`.
+    `version` increases with every publish.
+    """
+    __slots__ = tuple(DEFAULT_CONFIG) + ('version', 'errors')
+
+    TYPES = {
+        'idle_threshold': int, 'shutdown_delay': int, 'saved_volume': int, 'volume_write_rate': int,
+        'control_port': int, 'metrics_interval': float, 'shutdown_hook_timeout': float, 'report_interval': float,
+        'hide_on_startup': bool, 'idle_detector_enabled': bool, 'volume_control_enabled': bool,
+        'metrics_enabled': bool, 'shutdown_dry_run': bool,
+        'metrics_textfile': str, 'metrics_json': str, 'history_file': str, 'report_collector': str,
+        'idle_rules': list, 'profiles': list, 'shutdown_command': list, 'shutdown_hooks': list,
+        'app_volumes': dict,
+    }
+    RANGES = {
+        'idle_threshold': (1, None), 'shutdown_delay': (0, None), 'saved_volume': (0, 100),
+        'volume_write_rate': (1, None), 'control_port': (0, 65535), 'metrics_interval': (1, None),
+        'shutdown_hook_timeout': (0, None), 'report_interval': (1, None),
+    }
+    NULLABLE = {'saved_volume', 'control_port', 'metrics_textfile', 'metrics_json', 'history_file', 'report_collector'}
+
+    def __init__(self, values, version=0, errors=()):
+        for key in DEFAULT_CONFIG:
+            object.__setattr__(self, key, values[key])
+        object.__setattr__(self, 'version', version)
+        object.__setattr__(self, 'errors', tuple(errors))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Settings are read-only; publish a new snapshot instead")
+
+    @classmethod
+    def from_config(cls, config, version=0):
+        values = {}
+        errors = []
+        for key, default in DEFAULT_CONFIG.items():
+            value = config.get(key, default)
+            try:
+                values[key] = cls.validate(key, value)
+            except (TypeError, ValueError, OverflowError) as e:
+                errors.append(f"{key}: {e}")
+                values[key] = copy.deepcopy(default)
+        return cls(values, version, errors)
+
+    @classmethod
+    def validate(cls, key, value):
+        """value converted to the key's type, or TypeError/ValueError"""
+        if value is None and key in cls.NULLABLE:
+            return None
+        kind = cls.TYPES[key]
+        if kind in (int, float):
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise TypeError(f"expected a number, got {value!r}")
+            if kind is int:
+                if value != int(value):
+                    raise ValueError(f"expected a whole number, got {value!r}")
+                value = int(value)
+            low, high = cls.RANGES.get(key, (None, None))
+            if (low is not None and value < low) or (high is not None and value > high):
+                raise ValueError(f"{value} is out of range")
+            return value
+        if not isinstance(value, kind):
+            raise TypeError(f"expected {kind.__name__}, got {value!r}")
+        # Containers are copied so later edits of the config dict cannot reach the snapshot
+        return copy.deepcopy(value) if kind in (list, dict) else value
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in DEFAULT_CONFIG else default
+
+    def as_dict(self):
+        return {key: getattr(self, key) for key in DEFAULT_CONFIG}
+
+
+def next_settings(config, previous=None, log=print):
+    """Settings snapshot of config following `previous`, logging values that newly fail validation"""
+    settings = Settings.from_config(config, previous.version + 1 if previous else 0)
+    for error in settings.errors:
+        if not previous or error not in previous.errors:
+            log(f"Invalid config value ({error}), using the default")
+    return settings
+
+
+# ==============================================
+# STATUS LOG
+# ==============================================
+class StatusLog:
+    """Bounded in-memory status log with a size-rotated file sink
+
+    The ring buffer keeps the last `capacity` lines for display; every line
+    is also written to `log_file` so nothing is lost when the buffer wraps.
+    """
+    CAPACITY = 1000
+    MAX_BYTES = 1024 * 1024
+    BACKUPS = 3
+
+    def __init__(self, log_file=LOG_FILE, capacity=CAPACITY, max_bytes=MAX_BYTES, backups=BACKUPS):
+        self.lines = deque(maxlen=capacity)
+        self.total = 0  # lines ever appended, used as a cursor by readers
+        self._handler = None
+        if log_file:
+            import logging
+            from logging.handlers import RotatingFileHandler
+            try:
+                self._handler = RotatingFileHandler(
+                    log_file, maxBytes=max_bytes, backupCount=backups, encoding='utf-8', delay=True)
+                self._handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+            except OSError as e:
+                print(f"Error opening log file: {e}")
+
+    def append(self, message):
+        """Record a message and return the formatted display line"""
+        line = f"{time.strftime('%H:%M:%S')} - {message}"
+        self.lines.append(line)
+        self.total += 1
+        if self._handler:
+            import logging
+            self._handler.handle(logging.makeLogRecord({'msg': message, 'levelno': logging.INFO}))
+        return line
+
+    def since(self, cursor, limit):
+        """Lines appended after `cursor` (a previous `total`), at most the last `limit`"""
+        count = min(self.total - cursor, len(self.lines), limit)
+        if count <= 0:
+            return []
+        return list(itertools.islice(self.lines, len(self.lines) - count, None))
+
+    def flush(self):
+        if self._handler:
+            self._handler.flush()
+
+    def close(self):
+        if self._handler:
+            self._handler.close()
+
+
+# ==============================================
+# ACTIVITY HISTORY
+# ==============================================
+class HistoryStore:
+    """Append-only binary log of idle/activity events
+
+    Every event is a fixed-width record (wall-clock timestamp, kind, value),
+    so record i lives at offset i * RECORD.size. Queries memory-map the file
+    and binary-search the timestamps, then stream just the records in range,
+    so months of history are never loaded at once. Timestamps never
+    decrease: a clock stepping backwards is clamped to the previous record.
+    """
+    RECORD = struct.Struct('<dB3xf')   # timestamp, kind, value (16 bytes)
+    ACTIVE, IDLE, WARNING, DISMISSED, SHUTDOWN, LOCK, SLEEP, VOLUME = range(1, 9)
+    NAMES = {ACTIVE: 'active', IDLE: 'idle', WARNING: 'warning', DISMISSED: 'dismissed', SHUTDOWN: 'shutdown',
+             LOCK: 'lock', SLEEP: 'sleep', VOLUME: 'volume'}
+    ACTIONS = {'shutdown': SHUTDOWN, 'lock': LOCK, 'sleep': SLEEP, 'volume': VOLUME}
+    # Kinds that end an idle period
+    ENDS_IDLE = (ACTIVE, DISMISSED, SHUTDOWN)
+
+    class _Timestamps:
+        """Sequence view of record timestamps for bisect"""
+        def __init__(self, view, count):
+            self.view = view
+            self.count = count
+
+        def __len__(self):
+            return self.count
+
+        def __getitem__(self, index):
+            return HistoryStore.RECORD.unpack_from(self.view, index * HistoryStore.RECORD.size)[0]
+
+    def __init__(self, path, clock=time.time):
+        self.path = path
+        self.clock = clock
+        self._lock = Lock()
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        # Drop a partial record left by a crash mid-write to keep records aligned
+        if size % self.RECORD.size:
+            with open(path, 'r+b') as f:
+                f.truncate(size - size % self.RECORD.size)
+        self._file = open(path, 'ab', buffering=0)
+        self._last = self._read_last()
+
+    @property
+    def count(self):
+        """Number of complete records on disk"""
+        return os.path.getsize(self.path) // self.RECORD.size
+
+    def _read_last(self):
+        count = self.count
+        if not count:
+            return 0.0
+        with open(self.path, 'rb') as f:
+            f.seek((count - 1) * self.RECORD.size)
+            return self.RECORD.unpack(f.read(self.RECORD.size))[0]
+
+    def record(self, kind, value=0.0, timestamp=None):
+        """Append one event; safe to call from any thread"""
+        with self._lock:
+            timestamp = max(self.clock() if timestamp is None else timestamp, self._last)
+            self._file.write(self.RECORD.pack(timestamp, kind, value))
+            self._last = timestamp
+
+    @contextmanager
+    def _mapped(self):
+        count = self.count
+        if not count:
+            yield None, 0
+            return
+        with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), count * self.RECORD.size,
+                                                   access=mmap.ACCESS_READ) as view:
+            yield view, count
+
+    def records(self, start=None, end=None):
+        """Yield (timestamp, kind, value) with start <= timestamp < end"""
+        with self._mapped() as (view, count):
+            if not count:
+                return
+            first, last = self._bounds(view, count, start, end)
+            for index in range(first, last):
+                yield self.RECORD.unpack_from(view, index * self.RECORD.size)
+
+    def _bounds(self, view, count, start, end):
+        """Index range of the records with start <= timestamp < end"""
+        timestamps = self._Timestamps(view, count)
+        first = 0 if start is None else bisect.bisect_left(timestamps, start)
+        last = count if end is None else bisect.bisect_left(timestamps, end)
+        return first, last
+
+    def counts(self, start=None, end=None):
+        """Number of events of each kind in the range"""
+        totals = dict.fromkeys(self.NAMES.values(), 0)
+        for _, kind, _ in self.records(start, end):
+            if kind in self.NAMES:
+                totals[self.NAMES[kind]] += 1
+        return totals
+
+    def idle_periods(self, start, end):
+        """Yield (begin, end) idle periods clipped to [start, end)
+
+        An IDLE record is written when the threshold is crossed, with the
+        idle time so far as its value, so the period began that long before.
+        """
+        with self._mapped() as (view, count):
+            if not count:
+                return
+            first, last = self._bounds(view, count, start, end)
+            # An idle period still open at `start` began at the last IDLE
+            # record before it, however long ago (a weekend, say): scan back
+            # to the nearest transition
+            began = None
+            for index in range(first - 1, -1, -1):
+                timestamp, kind, value = self.RECORD.unpack_from(view, index * self.RECORD.size)
+                if kind == self.IDLE:
+                    began = timestamp - value
+                    break
+                if kind in self.ENDS_IDLE:
+                    break
+            for index in range(first, last):
+                timestamp, kind, value = self.RECORD.unpack_from(view, index * self.RECORD.size)
+                if kind == self.IDLE:
+                    began = timestamp - value
+                elif kind in self.ENDS_IDLE and began is not None:
+                    if timestamp > start:
+                        yield max(began, start), timestamp
+                    began = None
+        if began is not None:
+            yield max(began, start), min(end, self.clock())
+
+    def idle_minutes_by_hour(self, start, end):
+        """Idle minutes per (local date, hour), streamed over the range"""
+        totals = {}
+        for begin, finish in self.idle_periods(start, end):
+            while begin < finish:
+                local = time.localtime(begin)
+                into_hour = local.tm_min * 60 + local.tm_sec + (begin % 1)
+                boundary = min(finish, begin + 3600 - into_hour)
+                key = (time.strftime('%Y-%m-%d', local), local.tm_hour)
+                totals[key] = totals.get(key, 0.0) + (boundary - begin) / 60
+                begin = boundary
+        return totals
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def open_history(path, log=print):
+    """Open the history store at path, or None if disabled or unavailable"""
+    if not path:
+        return None
+    try:
+        return HistoryStore(path)
+    except OSError as e:
+        log(f"Activity history unavailable: {e}")
+        return None
+
+
+def history_report(store, days):
+    """Text summary of idle minutes per hour over the last `days` days"""
+    end = time.time()
+    start = end - days * 86400
+    counts = store.counts(start, end)
+    lines = [f"Last {days} day(s): " + ", ".join(f"{count} {name}" for name, count in counts.items())]
+    by_day = {}
+    for (day, hour), minutes in sorted(store.idle_minutes_by_hour(start, end).items()):
+        by_day.setdefault(day, []).append(f"{hour:02d}h {minutes:.0f}m")
+    for day, hours in by_day.items():
+        lines.append(f"{day}: " + ", ".join(hours))
+    return "\n".join(lines)
+
+
+# ==============================================
+# METRICS
+# ==============================================
+class Histogram:
+    """Latency histogram with fixed buckets (seconds), Prometheus style"""
+    BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        # Observed from the scheduler, UI and audio threads alike
+        self._lock = Lock()
+
+    def observe(self, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def snapshot(self):
+        with self._lock:
+            counts, count, total = list(self.counts), self.count, self.sum
+        return {
+            'count': count,
+            'sum': total,
+            'buckets': {str(le): n for le, n in zip(self.buckets + ('+Inf',), itertools.accumulate(counts))},
+        }
+
+
+class Metrics:
+    """Counters and latency histograms for the hot paths
+
+    Nothing is measured unless `enabled` is set: `instrument` only wraps
+    methods when enabled, so a build that never enables metrics runs the
+    original, unwrapped calls. A config reload may flip `enabled` at any
+    time; wrappers then stop timing, and instrumenting the same method
+    again when metrics come back on does not wrap it twice. Gauges from
+    components that already keep their own counters are pulled by
+    collectors at export time instead of being pushed on every call.
+    """
+    PREFIX = 'volidle_'
+    LAG_PROBE_INTERVAL = 5.0
+
+    def __init__(self):
+        self.enabled = False
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+        self._lock = Lock()
+        self._export_timer = None
+        self._probe_timer = None
+
+    def inc(self, name, amount=1):
+        """Count an event (any thread)"""
+        if self.enabled:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + amount
+
+    def histogram(self, name):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        return self.histograms[name]
+
+    def instrument(self, obj, method_name, metric):
+        """Time every call of obj.method_name into a histogram (only while enabled)"""
+        if not self.enabled:
+            return
+        original = getattr(obj, method_name)
+        if getattr(original, 'metric', None) == metric:
+            return
+        histogram = self.histogram(metric)
+        perf_counter = time.perf_counter
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            if not self.enabled:
+                return original(*args, **kwargs)
+            start = perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                histogram.observe(perf_counter() - start)
+
+        timed.metric = metric
+        setattr(obj, method_name, timed)
+
+    @contextmanager
+    def measure(self, metric):
+        """Time the body of a with block into a histogram (only while enabled)"""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.histogram(metric).observe(time.perf_counter() - start)
+
+    def add_collector(self, collect):
+        """Register a callable returning {gauge_name: value} at export time"""
+        if self.enabled and collect not in self.collectors:
+            self.collectors.append(collect)
+
+    def gauges(self):
+        values = {}
+        for collect in self.collectors:
+            try:
+                values.update(collect())
+            except Exception as e:
+                print(f"Error collecting metrics: {e}")
+        return values
+
+    def counter_values(self):
+        with self._lock:
+            return dict(self.counters)
+
+    def snapshot(self):
+        return {
+            'timestamp': time.time(),
+            'counters': self.counter_values(),
+            'gauges': self.gauges(),
+            'histograms': {name: h.snapshot() for name, h in self.histograms.items()},
+        }
+
+    def render_prometheus(self, snapshot=None):
+        """Prometheus text exposition format (for the node_exporter textfile collector)"""
+        snapshot = snapshot or self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(f"# TYPE {self.PREFIX}{name}_total counter")
+            lines.append(f"{self.PREFIX}{name}_total {value}")
+        for name, value in sorted(snapshot['gauges'].items()):
+            lines.append(f"# TYPE {self.PREFIX}{name} gauge")
+            lines.append(f"{self.PREFIX}{name} {float(value)}")
+        for name, histogram in sorted(snapshot['histograms'].items()):
+            lines.append(f"# TYPE {self.PREFIX}{name} histogram")
+            for le, count in histogram['buckets'].items():
+                lines.append(f'{self.PREFIX}{name}_bucket{{le="{le}"}} {count}')
+            lines.append(f"{self.PREFIX}{name}_sum {histogram['sum']}")
+            lines.append(f"{self.PREFIX}{name}_count {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, textfile=None, json_file=None):
+        """Write the Prometheus textfile and/or JSON snapshot atomically"""
+        snapshot = self.snapshot()
+        if textfile:
+            write_atomic(textfile, self.render_prometheus(snapshot))
+        if json_file:
+            write_atomic(json_file, json.dumps(snapshot, indent=2))
+
+    def start_export(self, scheduler, interval, textfile=None, json_file=None):
+        """Export on an interval from the scheduler thread"""
+        if not self.enabled:
+            return
+
+        def export():
+            try:
+                self.export(textfile, json_file)
+            except Exception as e:
+                print(f"Error exporting metrics: {e}")
+            self._export_timer = scheduler.call_later(interval, export, feature='metrics')
+
+        self._export_timer = scheduler.call_later(interval, export, feature='metrics')
+
+    def start_lag_probe(self, scheduler, post, metric='tk_callback_lag_seconds'):
+        """Measure how long the UI thread takes to run a posted callback"""
+        if not self.enabled:
+            return
+        histogram = self.histogram(metric)
+
+        def probe():
+            posted = time.perf_counter()
+            post(lambda: histogram.observe(time.perf_counter() - posted))
+            self._probe_timer = scheduler.call_later(self.LAG_PROBE_INTERVAL, probe, feature='metrics')
+
+        self._probe_timer = scheduler.call_later(self.LAG_PROBE_INTERVAL, probe, feature='metrics')
+
+    def stop(self):
+        for timer in (self._export_timer, self._probe_timer):
+            if timer is not None:
+                timer.cancel()
+        self._export_timer = self._probe_timer = None
+
+
+METRICS = Metrics()
+METRICS_KEYS = {'metrics_enabled', 'metrics_interval', 'metrics_textfile', 'metrics_json'}
+
+
+def gauges_from(prefix, obj, *attrs):
+    """Numeric attributes of obj as gauges named prefix_attr"""
+    if obj is None:
+        return {}
+    values = {}
+    for attr in attrs:
+        value = getattr(obj, attr, None)
+        if isinstance(value, (int, float)):
+            values[f"{prefix}_{attr}"] = value
+    return values
+
+
+def runtime_gauges(owner):
+    """Gauges for the components of a running app or daemon"""
+    values = {}
+    scheduler = getattr(owner, 'scheduler', None)
+    if scheduler is not None:
+        values.update({f"scheduler_{key}": value for key, value in scheduler.stats().items()
+                       if isinstance(value, (int, float))})
+    detector = getattr(owner, 'detector', None)
+    values.update(gauges_from('idle', detector, 'wakeups', 'threshold'))
+    if detector is not None:
+        values['idle_wakeups_per_hour'] = detector.wakeups_per_hour()
+    values.update(gauges_from('ui_events', getattr(owner, 'ui_events', None) or getattr(owner, 'events', None),
+                              'posted', 'collapsed', 'batches'))
+    values.update(gauges_from('config', getattr(owner, 'config_store', None), 'writes', 'skipped_writes'))
+    values.update(gauges_from('config_reload', getattr(owner, 'config_watcher', None),
+                              'checks', 'parses', 'reloads', 'last_reload_latency'))
+    values.update(gauges_from('endpoint', getattr(owner, 'volume_control', None),
+                              'calls', 'reactivations', 'failures', 'last_reactivation_latency'))
+    values.update(gauges_from('volume_enforcer', getattr(owner, 'volume_enforcer', None),
+                              'notifications', 'corrections'))
+    values.update(gauges_from('volume_writer', getattr(owner, 'volume_writer', None),
+                              'writes', 'skipped', 'coalesced'))
+    values.update(gauges_from('app_volume', getattr(owner, 'session_enforcer', None),
+                              'session_count', 'notifications', 'corrections'))
+    values.update(gauges_from('control', getattr(owner, 'control', None), 'clients', 'requests'))
+    values.update(gauges_from('watchdog', getattr(owner, 'watchdog', None), 'fired', 'cancelled'))
+    values.update(gauges_from('report', getattr(owner, 'report_agent', None), 'sent', 'failed', 'dropped'))
+    return values
+
+
+# ==============================================
+# SCHEDULER
+# ==============================================
+class ScheduledTimer:
+    """Handle for a callback queued on the Scheduler"""
+    __slots__ = ('when', 'seq', 'fn', 'feature', 'cancelled')
+
+    def __init__(self, when, seq, fn, feature):
+        self.when = when
+        self.seq = seq
+        self.fn = fn
+        self.feature = feature
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.when, self.seq) < (other.when, other.seq)
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler:
+    """One asyncio event loop, on its own thread, that owns all periodic work
+
+    Timers are tagged with a feature name so a feature can be paused and
+    resumed as a whole. A timer that falls due within COALESCE_WINDOW
+    before an already scheduled wakeup is pushed back to share it, so
+    independent periodic jobs end up waking the process together. Only the
+    earliest timer is armed on the asyncio loop.
+    """
+    COALESCE_WINDOW = 0.25
+
+    def __init__(self, coalesce_window=COALESCE_WINDOW):
+        import asyncio
+        self.coalesce_window = coalesce_window
+        self.loop = asyncio.new_event_loop()
+        self.wakeups = 0
+        self.callbacks = 0
+        self.total_scheduled = 0
+        self.coalesced = 0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+        self._timers = []
+        self._paused = {}
+        self._paused_lock = Lock()  # stats() reads _paused from other threads
+        self._handle = None
+        self._seq = itertools.count()
+        self._tolerance = time.get_clock_info('monotonic').resolution
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = Thread(target=self.loop.run_forever, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread = None
+
+    def _on_loop_thread(self):
+        return self._thread is not None and self._thread.ident == threading_ident()
+
+    def submit(self, fn, *args):
+        """Run fn on the scheduler thread as soon as possible"""
+        self.loop.call_soon_threadsafe(fn, *args)
+
+    def call_later(self, delay, fn, feature=None):
+        """Run fn on the scheduler thread after delay seconds; safe from any thread"""
+        timer = ScheduledTimer(self.loop.time() + max(0.0, delay), next(self._seq), fn, feature)
+        if self._on_loop_thread():
+            self._add(timer)
+        else:
+            self.loop.call_soon_threadsafe(self._add, timer)
+        return timer
+
+    def pause(self, feature):
+        """Hold back timers of a feature until resume(feature); safe from any thread"""
+        if self._on_loop_thread():
+            self._pause(feature)
+        else:
+            self.submit(self._pause, feature)
+
+    def resume(self, feature):
+        if self._on_loop_thread():
+            self._resume(feature)
+        else:
+            self.submit(self._resume, feature)
+
+    def stats(self):
+        with self._paused_lock:
+            paused = sorted(self._paused)
+        return {
+            'scheduled': sum(1 for timer in self._timers if not timer.cancelled),
+            'paused_features': paused,
+            'total_scheduled': self.total_scheduled,
+            'coalesced': self.coalesced,
+            'wakeups': self.wakeups,
+            'callbacks': self.callbacks,
+            'max_lag_ms': self.max_lag * 1000,
+            'avg_lag_ms': self.total_lag / self.callbacks * 1000 if self.callbacks else 0.0,
+        }
+
+    def describe(self):
+        stats = self.stats()
+        return (f"Scheduler: {stats['wakeups']} wakeups, {stats['callbacks']} callbacks, "
+                f"{stats['coalesced']} coalesced, lag avg {stats['avg_lag_ms']:.1f} ms / "
+                f"max {stats['max_lag_ms']:.1f} ms")
+
+    def _add(self, timer):
+        if timer.cancelled:
+            return
+        self.total_scheduled += 1
+        # Share a wakeup that is already scheduled shortly after this one
+        shared = [other.when for other in self._timers
+                  if not other.cancelled and timer.when < other.when <= timer.when + self.coalesce_window]
+        if shared:
+            timer.when = min(shared)
+            self.coalesced += 1
+        heapq.heappush(self._timers, timer)
+        self._arm()
+
+    def _pause(self, feature):
+        with self._paused_lock:
+            self._paused.setdefault(feature, [])
+
+    def _resume(self, feature):
+        now = self.loop.time()
+        with self._paused_lock:
+            held = self._paused.pop(feature, [])
+        for timer in held:
+            timer.when = max(timer.when, now)
+            heapq.heappush(self._timers, timer)
+        self._arm()
+
+    def _arm(self):
+        while self._timers and self._timers[0].cancelled:
+            heapq.heappop(self._timers)
+        if not self._timers:
+            if self._handle:
+                self._handle.cancel()
+                self._handle = None
+            return
+        when = self._timers[0].when
+        if self._handle is not None:
+            if self._handle.when() == when:
+                return
+            self._handle.cancel()
+        self._handle = self.loop.call_at(when, self._wake)
+
+    def _wake(self):
+        self._handle = None
+        self.wakeups += 1
+        now = self.loop.time()
+        while self._timers and self._timers[0].when <= now + self._tolerance:
+            timer = heapq.heappop(self._timers)
+            if timer.cancelled:
+                continue
+            with self._paused_lock:
+                held = self._paused.get(timer.feature)
+                if held is not None:
+                    held.append(timer)
+            if held is not None:
+                continue
+            lag = max(0.0, now - timer.when)
+            self.callbacks += 1
+            self.total_lag += lag
+            self.max_lag = max(self.max_lag, lag)
+            try:
+                timer.fn()
+            except Exception as e:
+                METRICS.inc('callback_errors')
+                print(f"Error in scheduled callback: {e}")
+        self._arm()
+
+
+# ==============================================
+# TIME-OF-DAY PROFILES
+# ==============================================
+class Profile:
+    """Values that replace config.txt settings during a daily time window
+
+    The window runs from `start` to `end` (local "HH:MM") on the listed
+    days; a window ending before it starts runs overnight into the next
+    day, and start == end covers the whole day.
+    """
+    DAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+    KEYS = ('saved_volume', 'idle_threshold', 'shutdown_delay', 'idle_rules', 'app_volumes')
+
+    def __init__(self, name, start, end, settings, days=None, log=print):
+        unknown = set(settings) - set(self.KEYS)
+        if unknown:
+            raise ValueError(f"Profile {name!r} cannot set {', '.join(sorted(unknown))}")
+        self.name = name
+        self.start = self.parse_time(start)
+        self.end = self.parse_time(end)
+        # Overrides bypass the config snapshot, so they get the same checks here
+        self.settings = {}
+        for key, value in settings.items():
+            try:
+                self.settings[key] = Settings.validate(key, value)
+            except (TypeError, ValueError, OverflowError) as e:
+                log(f"Profile {name!r}: invalid {key} ({e}), ignoring it")
+        self.days = {self.DAYS.index(day.lower()[:3]) for day in days} if days else set(range(7))
+
+    @staticmethod
+    def parse_time(text):
+        hours, minutes = text.split(':')
+        return datetime.time(int(hours), int(minutes))
+
+    @classmethod
+    def from_dict(cls, spec, log=print):
+        return cls(spec.get('name', 'profile'), spec['start'], spec['end'], spec.get('settings', {}), spec.get('days'), log)
+
+    @property
+    def overnight(self):
+        return self.end <= self.start
+
+    def active_at(self, moment):
+        """True if the window covers the local datetime `moment`"""
+        now = moment.time()
+        if not self.overnight:
+            return moment.weekday() in self.days and self.start <= now < self.end
+        if moment.weekday() in self.days and now >= self.start:
+            return True
+        return (moment - datetime.timedelta(days=1)).weekday() in self.days and now < self.end
+
+    def boundaries(self, day):
+        """Start and end timestamps of the window that starts on `day`"""
+        if day.weekday() not in self.days:
+            return []
+        end_day = day + datetime.timedelta(days=1) if self.overnight else day
+        return [datetime.datetime.combine(day, self.start).timestamp(),
+                datetime.datetime.combine(end_day, self.end).timestamp()]
+
+
+class ProfileSchedule:
+    """Time-of-day profiles with their upcoming transitions in a min-heap
+
+    Window boundaries for the next HORIZON_DAYS are computed once and
+    pushed on a heap, so the next transition is a heap lookup and the
+    scheduler can sleep until exactly that moment instead of checking the
+    clock on every tick. When the heap runs dry the next horizon is filled.
+    """
+    HORIZON_DAYS = 7
+
+    def __init__(self, profiles, clock=time.time):
+        self.profiles = profiles
+        self.clock = clock
+        self._heap = []
+        self._horizon = None    # boundaries up to this timestamp are on the heap
+
+    def __bool__(self):
+        return bool(self.profiles)
+
+    @classmethod
+    def from_config(cls, config, log=print):
+        return cls([Profile.from_dict(spec, log) for spec in config.get('profiles') or []])
+
+    def active(self, when=None):
+        moment = datetime.datetime.fromtimestamp(self.clock() if when is None else when)
+        return [profile for profile in self.profiles if profile.active_at(moment)]
+
+    def overrides(self, when=None):
+        """Merged settings of the active profiles; later profiles win"""
+        merged = {}
+        for profile in self.active(when):
+            merged.update(profile.settings)
+        return merged
+
+    def next_transition(self):
+        """Timestamp of the next boundary (or of the horizon end if none falls before it)"""
+        now = self.clock()
+        while self._heap and self._heap[0] <= now:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            self._fill(now)
+        return self._heap[0] if self._heap else self._horizon
+
+    def _fill(self, now):
+        begin = max(now, self._horizon or now)
+        end = now + self.HORIZON_DAYS * 86400
+        # Overnight windows that started yesterday end inside the horizon
+        day = datetime.date.fromtimestamp(begin) - datetime.timedelta(days=1)
+        while datetime.datetime.combine(day, datetime.time()).timestamp() <= end:
+            for profile in self.profiles:
+                for boundary in profile.boundaries(day):
+                    if begin < boundary <= end:
+                        heapq.heappush(self._heap, boundary)
+            day += datetime.timedelta(days=1)
+        self._horizon = end
+
+
+# ==============================================
+# CONTROL API
+# ==============================================
+class ControlServer:
+    """Local control API and single-instance lock
+
+    Clients send one JSON object per line, e.g. {"cmd": "set_volume",
+    "value": 40}, and get one JSON reply per line. The server runs on the
+    scheduler's asyncio loop, so idle clients cost nothing; each command
+    runs on the UI thread through `dispatch`. Binding the port is also the
+    single-instance check: a second launch finds it taken and hands its
+    arguments to the running instance instead.
+
+    Each logon session uses its own port (see session_port), so users of
+    one machine each get their own instance. Loopback is shared by all of
+    them, so requests must also carry the token written on bind to a file
+    only this user can read; other callers are rejected.
+    """
+    HOST = '127.0.0.1'
+    TIMEOUT = 5.0    # seconds to wait for the UI thread to answer
+    SESSION_SPAN = 1000    # ports above control_port handed out by session
+
+    def __init__(self, port):
+        self.port = port
+        self.clients = 0
+        self.requests = 0
+        self.rejected = 0
+        self.token = None
+        self._sock = None
+        self._server = None
+        self._loop = None
+
+    def bind(self):
+        """Claim the port; False if another instance (or program) holds it"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if hasattr(socket, 'SO_EXCLUSIVEADDRUSE'):
+            # Windows would otherwise let a second process bind the same port
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_EXCLUSIVEADDRUSE, 1)
+        else:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind((self.HOST, self.port))
+            sock.listen()
+            self.token = write_control_token(self.port)
+        except OSError:
+            sock.close()
+            return False
+        self._sock = sock
+        return True
+
+    def start(self, loop, commands, dispatch):
+        """Serve `commands` (name -> fn(request) -> dict) on the given loop; returns a future for the start"""
+        self._loop = loop
+        self.commands = commands
+        self.dispatch = dispatch
+        import asyncio
+        return asyncio.run_coroutine_threadsafe(self._serve(), loop)
+
+    async def _serve(self):
+        import asyncio
+        self._server = await asyncio.start_server(self._client, sock=self._sock)
+
+    async def _client(self, reader, writer):
+        self.clients += 1
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    break  # Line longer than the stream limit
+                if not line:
+                    break
+                reply = await self._handle(line)
+                writer.write((json.dumps(reply) + '\n').encode('utf-8'))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.clients -= 1
+            writer.close()
+
+    async def _handle(self, line):
+        import asyncio
+        import hmac
+        self.requests += 1
+        try:
+            request = json.loads(line)
+            token = str(request.get('token')).encode('utf-8')
+        except (ValueError, AttributeError):
+            request, token = None, b''
+        if not hmac.compare_digest(token, self.token.encode('ascii')):
+            self.rejected += 1
+            return {'ok': False, 'error': "Not authorized"}
+        try:
+            command = self.commands[request['cmd']]
+        except (KeyError, TypeError):
+            return {'ok': False, 'error': f"Unknown request; commands: {', '.join(sorted(self.commands))}"}
+        
+        future = self._loop.create_future()
+
+        def resolve(reply):
+            if not future.done():
+                future.set_result(reply)
+
+        def run():
+            try:
+                reply = {'ok': True, **(command(request) or {})}
+            except Exception as e:
+                reply = {'ok': False, 'error': str(e)}
+            self._loop.call_soon_threadsafe(resolve, reply)
+
+        self.dispatch(run)
+        try:
+            return await asyncio.wait_for(future, self.TIMEOUT)
+        except asyncio.TimeoutError:
+            return {'ok': False, 'error': "Timed out waiting for the application"}
+
+    def close(self):
+        if self._server is not None:
+            self._loop.call_soon_threadsafe(self._server.close)
+        elif self._sock is not None:
+            self._sock.close()
+        if self.token is not None:
+            try:
+                os.remove(control_token_file(self.port))
+            except OSError:
+                pass
+
+
+def session_id():
+    """Logon session of this process on Windows, the user id elsewhere"""
+    if hasattr(ctypes, 'windll'):
+        session = ctypes.c_ulong()
+        if ctypes.windll.kernel32.ProcessIdToSessionId(ctypes.c_ulong(os.getpid()), ctypes.byref(session)):
+            return session.value
+        return 0
+    return os.getuid() if hasattr(os, 'getuid') else 0
+
+
+def session_port(port):
+    """control_port moved up by the session, so each session has its own instance"""
+    offset = session_id() % ControlServer.SESSION_SPAN
+    return port + offset if port + offset <= 65535 else port - offset
+
+
+def control_token_file(port):
+    """Token file for the control port; under the user's profile, so other users cannot read it"""
+    base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    return os.path.join(base, '.vol_idle', f'control-{port}.token')
+
+
+def write_control_token(port):
+    """Write a new random token for port, readable by this user only, and return it"""
+    path = control_token_file(port)
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    token = os.urandom(16).hex()
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(token)
+    os.chmod(path, 0o600)   # The file may predate this run
+    return token
+
+
+def control_request(port, request, timeout=ControlServer.TIMEOUT + 1):
+    """Send one request to the running instance and return its reply
+
+    Raises FileNotFoundError if this user has no instance on the port.
+    """
+    with open(control_token_file(port)) as f:
+        request = {**request, 'token': f.read().strip()}
+    with socket.create_connection((ControlServer.HOST, port), timeout=timeout) as sock:
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        with sock.makefile('r', encoding='utf-8') as f:
+            line = f.readline()
+    if not line:
+        raise ConnectionError("No reply from the running instance")
+    return json.loads(line)
+
+
+def control_commands(owner):
+    """Control API commands for a running app or daemon (run on its UI thread)"""
+    def volume_control_enabled():
+        return bool(owner.volume_control) and owner.config.get('volume_control_enabled', True)
+
+    def volume_control():
+        if not volume_control_enabled():
+            raise RuntimeError("Volume control is disabled")
+        return owner.volume_control
+
+    def get_volume(request):
+        # None tells the caller to read the endpoint itself
+        if not volume_control_enabled():
+            return {'volume': None}
+        return {'volume': round(owner.volume_control.get_level() * 100)}
+
+    def set_volume(request):
+        volume_control()
+        # Enforcement would revert a plain write, so this sets the saved volume
+        percent = round(max(0, min(100, float(request['value']))))
+        owner.set_saved_volume(percent)
+        return {'volume': percent}
+
+    def idle_time(request):
+        if not owner.detector:
+            raise RuntimeError("Idle detection is disabled")
+        # Runs on the main thread, not the detector's
+        return {'idle_seconds': owner.detector.source.sample()}
+
+    def status(request):
+        detector = owner.detector
+        return {
+            'pid': os.getpid(),
+            'mode': 'daemon' if isinstance(owner, IdleDaemon) else 'window',
+            'idle_detection': bool(detector and detector.running),
+            'paused': bool(detector and detector.paused),
+            'rules': detector.rules.describe() if detector else None,
+            'profiles': owner.active_profiles or [],
+            'warning_shown': owner.warning_shown,
+            'volume_control': owner.config.get('volume_control_enabled', True),
+            'saved_volume': owner.config.get('saved_volume'),
+        }
+
+    def pause(request):
+        owner.pause_detection(request.get('seconds'))
+        return {}
+
+    def resume(request):
+        owner.resume_detection()
+        return {}
+
+    def launch(request):
+        owner.handle_launch(request.get('argv', []))
+        return {}
+
+    return {
+        'get_volume': get_volume,
+        'set_volume': set_volume,
+        'idle_time': idle_time,
+        'status': status,
+        'pause': pause,
+        'resume': resume,
+        'launch': launch,
+    }
+
+
+# ==============================================
+# REPORTING
+# ==============================================
+REPORT_PORT = 47614
+REPORT_HEADER = struct.Struct('!I')    # length of the compressed report that follows
+# config.txt keys that restart the reporting agent when they change
+REPORT_KEYS = {'report_collector', 'report_interval'}
+
+
+def parse_address(address, default_port=REPORT_PORT):
+    """(host, port) from 'host' or 'host:port'"""
+    host, sep, port = address.rpartition(':')
+    if not sep:
+        return address, default_port
+    return host.strip('[]'), int(port)
+
+
+def encode_report(report):
+    """One framed report: length header and zlib-compressed JSON"""
+    body = zlib.compress(json.dumps(report, separators=(',', ':')).encode('utf-8'))
+    return REPORT_HEADER.pack(len(body)) + body
+
+
+def decode_report(body, max_size):
+    """Report from a compressed body; raises ValueError if invalid or larger than max_size expanded"""
+    inflater = zlib.decompressobj()
+    try:
+        data = inflater.decompress(body, max_size)
+    except zlib.error as e:
+        raise ValueError(f"Corrupt report: {e}")
+    if inflater.unconsumed_tail:
+        raise ValueError("Report too large")
+    report = json.loads(data)
+    if not isinstance(report, dict) or not isinstance(report.get('snapshots'), list):
+        raise ValueError("Not a report")
+    return report
+
+
+def idle_state(owner):
+    """Idle detection state of a running app or daemon (scheduler thread, which owns the idle source)"""
+    detector = getattr(owner, 'detector', None)
+    watchdog = getattr(owner, 'watchdog', None)
+    if not detector or not detector.running:
+        return {'idle_detection': False}
+    idle_time = detector.source.idle_seconds()
+    shutdown_in = watchdog.remaining() if watchdog is not None and watchdog.armed else None
+    if shutdown_in is None:
+        thresholds = [threshold for threshold, phase, rule in detector.rules.entries
+                      if phase == RuleTable.ACT and rule.action == 'shutdown']
+        if thresholds:
+            shutdown_in = max(0.0, thresholds[0] - idle_time)
+    return {
+        'idle_detection': True,
+        'idle_seconds': round(idle_time, 1),
+        'paused': detector.paused,
+        'warned': detector.warned,
+        'shutdown_in': None if shutdown_in is None else round(shutdown_in, 1),
+    }
+
+
+def volume_state(owner):
+    """Volume enforcement state of a running app or daemon (any thread)"""
+    state = {'volume_control': owner.settings.volume_control_enabled, 'saved_volume': owner.setting('saved_volume')}
+    enforcer = getattr(owner, 'volume_enforcer', None)
+    if enforcer is not None:
+        state.update(volume_event_driven=enforcer.event_driven, volume_notifications=enforcer.notifications,
+                     volume_corrections=enforcer.corrections)
+    state.update(gauges_from('endpoint', getattr(owner, 'volume_control', None), 'failures', 'reactivations'))
+    return state
+
+
+class ReportAgent:
+    """Batches state snapshots and sends them to a ReportCollector on an interval
+
+    Snapshots are recorded from any thread into a bounded buffer; every
+    `interval` seconds the scheduler adds a state sample and sends the whole
+    batch as one compressed report over a short-lived TCP connection, on the
+    scheduler's asyncio loop. A batch the collector did not acknowledge goes
+    back into the buffer for the next attempt; when the buffer is full the
+    oldest snapshots are dropped.
+    """
+    CAPACITY = 500
+    TIMEOUT = 10.0
+
+    def __init__(self, address, interval=60, name=None, capacity=CAPACITY, log=print):
+        self.address = address
+        self.host, self.port = parse_address(address)
+        self.name = name or socket.gethostname()
+        self.interval = interval
+        self.log = log
+        self.snapshots = deque(maxlen=capacity)
+        self.seq = 0
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self.last_error = None
+        self._lock = Lock()
+        self._sample = None
+        self._timer = None
+        self._task = None
+
+    def record(self, kind, state):
+        """Queue a snapshot of `state` (any thread)"""
+        with self._lock:
+            if len(self.snapshots) == self.snapshots.maxlen:
+                self.dropped += 1
+            self.snapshots.append({'t': round(time.time(), 3), 'kind': kind, **state})
+
+    def take(self):
+        with self._lock:
+            batch = list(self.snapshots)
+            self.snapshots.clear()
+        return batch
+
+    def requeue(self, batch):
+        """Put an unsent batch back in front of newer snapshots, dropping the oldest if full"""
+        with self._lock:
+            combined = batch + list(self.snapshots)
+            self.dropped += max(0, len(combined) - self.snapshots.maxlen)
+            self.snapshots = deque(combined, maxlen=self.snapshots.maxlen)
+
+    def start(self, scheduler, sample):
+        """Send a report every interval from the scheduler; sample() returns the current state"""
+        self._sample = sample
+        self._timer = scheduler.call_later(self.interval, lambda: self._on_interval(scheduler), feature='reporting')
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _on_interval(self, scheduler):
+        try:
+            self.record('sample', self._sample())
+        except Exception as e:
+            self.record('sample', {'error': str(e)})
+        # At most one report in flight; a slow collector delays the next batch
+        if self._task is None or self._task.done():
+            self._task = scheduler.loop.create_task(self.send())
+        self._timer = scheduler.call_later(self.interval, lambda: self._on_interval(scheduler), feature='reporting')
+
+    async def send(self):
+        """Send everything buffered as one report; True once the collector acknowledged it"""
+        import asyncio
+        batch = self.take()
+        if not batch:
+            return True
+        self.seq += 1
+        report = {'host': self.name, 'pid': os.getpid(), 'seq': self.seq, 'sent': time.time(),
+                  'dropped': self.dropped, 'snapshots': batch}
+        data = encode_report(report)
+        writer = None
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.TIMEOUT)
+            writer.write(data)
+            await writer.drain()
+            reply = await asyncio.wait_for(reader.readline(), self.TIMEOUT)
+            if reply != b'ok\n':
+                raise ConnectionError(f"collector replied {reply!r}")
+        except (OSError, asyncio.TimeoutError) as e:
+            self.requeue(batch)
+            self.failed += 1
+            if self.last_error is None:
+                self.log(f"Report to {self.address} failed ({str(e) or 'timed out'}), keeping the snapshots")
+            self.last_error = str(e) or 'timed out'
+            return False
+        finally:
+            if writer is not None:
+                writer.close()
+        if self.last_error is not None:
+            self.log(f"Reporting to {self.address} again")
+            self.last_error = None
+        self.sent += 1
+        self.raw_bytes += len(json.dumps(report, separators=(',', ':')))
+        self.sent_bytes += len(data)
+        return True
+
+    def flush(self, loop):
+        """Send the buffer now and wait for the result (any thread but the loop's)"""
+        import asyncio
+        return asyncio.run_coroutine_threadsafe(self.send(), loop).result(self.TIMEOUT * 2)
+
+    def describe(self):
+        ratio = self.raw_bytes / self.sent_bytes if self.sent_bytes else 0.0
+        return (f"Reporting to {self.address}: {self.sent} reports sent ({ratio:.1f}x compressed), "
+                f"{self.failed} failed, {self.dropped} snapshots dropped")
+
+
+class ReportCollector:
+    """Receives agent reports over TCP and keeps the latest state of each host
+
+    Agents connect once per report, so each one costs a coroutine only while
+    its report is in transit, and one asyncio loop serves thousands of them.
+    Snapshots are folded into the host's latest state as they arrive; only
+    per-kind counts are kept of the history.
+
+    Reports are not authenticated, so the collector listens on loopback
+    unless given another address, and keeps only the fields and kinds
+    agents send for at most MAX_HOSTS hosts: hosts silent for HOST_EXPIRY
+    are forgotten, and the least recently seen host makes room for a new one.
+    """
+    MAX_REPORT = 1024 * 1024            # compressed bytes
+    MAX_EXPANDED = 16 * 1024 * 1024
+    TIMEOUT = 10.0
+    BACKLOG = 1024
+    SUMMARY_INTERVAL = 60
+    MAX_HOSTS = 10000
+    HOST_EXPIRY = 7 * 86400
+    MAX_NAME = 255
+    STATE_KEYS = frozenset([
+        't', 'kind', 'action', 'after', 'error', 'idle_detection', 'idle_seconds', 'paused', 'warned', 'shutdown_in',
+        'volume_control', 'saved_volume', 'volume_event_driven', 'volume_notifications', 'volume_corrections',
+        'endpoint_failures', 'endpoint_reactivations',
+    ])
+    KINDS = frozenset(['sample', 'warn', 'act', 'active', 'volume_corrected', 'shutdown'])
+
+    def __init__(self, host='127.0.0.1', port=REPORT_PORT, clock=time.time):
+        self.host = host
+        self.port = port
+        self.clock = clock
+        self.hosts = {}
+        self.connections = 0
+        self.max_connections = 0
+        self.reports = 0
+        self.snapshots = 0
+        self.rejected = 0
+        self.evicted = 0
+        self.bytes_received = 0
+        self._server = None
+
+    async def start(self):
+        """Start listening; port 0 picks a free port, stored back in self.port"""
+        import asyncio
+        self._server = await asyncio.start_server(self._client, self.host, self.port, backlog=self.BACKLOG)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _client(self, reader, writer):
+        import asyncio
+        self.connections += 1
+        self.max_connections = max(self.max_connections, self.connections)
+        try:
+            header = await asyncio.wait_for(reader.readexactly(REPORT_HEADER.size), self.TIMEOUT)
+            size, = REPORT_HEADER.unpack(header)
+            if size > self.MAX_REPORT:
+                raise ValueError(f"Report of {size} bytes is too large")
+            body = await asyncio.wait_for(reader.readexactly(size), self.TIMEOUT)
+            self.receive(decode_report(body, self.MAX_EXPANDED))
+            self.bytes_received += REPORT_HEADER.size + size
+            writer.write(b'ok\n')
+            await writer.drain()
+        except (ValueError, RecursionError, OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            self.rejected += 1
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    def receive(self, report):
+        """Fold a decoded report into the state of its host"""
+        name = str(report.get('host'))[:self.MAX_NAME]
+        now = self.clock()
+        self.expire(now)
+        # Reinserting keeps self.hosts ordered from least to most recently seen
+        entry = self.hosts.pop(name, None)
+        if entry is None:
+            if len(self.hosts) >= self.MAX_HOSTS:
+                del self.hosts[next(iter(self.hosts))]
+                self.evicted += 1
+            entry = {'reports': 0, 'snapshots': 0, 'kinds': {}, 'state': {}}
+        self.hosts[name] = entry
+        entry['reports'] += 1
+        entry['last_seen'] = now
+        dropped = report.get('dropped', 0)
+        entry['dropped'] = dropped if isinstance(dropped, int) else 0
+        for snapshot in report['snapshots']:
+            if not isinstance(snapshot, dict):
+                continue
+            kind = snapshot.get('kind')
+            kind = kind if kind in self.KINDS else 'other'
+            entry['kinds'][kind] = entry['kinds'].get(kind, 0) + 1
+            entry['state'].update((key, value[:self.MAX_NAME] if isinstance(value, str) else value)
+                                  for key, value in snapshot.items()
+                                  if key in self.STATE_KEYS and isinstance(value, (int, float, str, type(None))))
+            entry['state']['kind'] = kind
+        entry['snapshots'] += len(report['snapshots'])
+        self.reports += 1
+        self.snapshots += len(report['snapshots'])
+
+    def expire(self, now=None):
+        """Forget hosts that have not reported for HOST_EXPIRY seconds"""
+        cutoff = (self.clock() if now is None else now) - self.HOST_EXPIRY
+        while self.hosts:
+            name = next(iter(self.hosts))
+            if self.hosts[name]['last_seen'] >= cutoff:
+                break
+            del self.hosts[name]
+
+    def describe(self, limit=20):
+        """Summary line, then the hosts closest to shutdown"""
+        now = self.clock()
+        self.expire(now)
+        lines = [f"{len(self.hosts)} hosts, {self.reports} reports, {self.snapshots} snapshots, "
+                 f"{self.rejected} rejected, {self.evicted} evicted, "
+                 f"at most {self.max_connections} connections at once"]
+
+        def shutdown_in(item):
+            value = item[1]['state'].get('shutdown_in')
+            return value if isinstance(value, (int, float)) else float('inf')
+
+        for name, entry in sorted(self.hosts.items(), key=shutdown_in)[:limit]:
+            state = entry['state']
+            idle = state.get('idle_seconds')
+            shutdown = state.get('shutdown_in')
+            lines.append(
+                f"  {name}: " + ", ".join([
+                    f"idle {idle:.0f} s" if isinstance(idle, (int, float)) else "idle detection off",
+                    f"shutdown in {shutdown:.0f} s" if isinstance(shutdown, (int, float)) else "no shutdown pending",
+                    f"{state.get('volume_corrections', 0)} volume corrections",
+                    f"last {state.get('kind')}",
+                    f"last seen {now - entry['last_seen']:.0f} s ago",
+                ]))
+        return "\n".join(lines)
+
+
+async def run_collector(port, host='127.0.0.1', interval=ReportCollector.SUMMARY_INTERVAL):
+    """Collect reports until interrupted, printing a summary every interval"""
+    import asyncio
+    collector = ReportCollector(host, port)
+    await collector.start()
+    print(f"Collecting reports on {host}:{collector.port}", flush=True)
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            print(collector.describe(), flush=True)
+    finally:
+        await collector.close()
+
+
+# ==============================================
+# IDLE DETECTION BACKEND
+# ==============================================
+class MonotonicClock:
+    """Real clock used by the idle detector"""
+    def now(self):
+        return time.monotonic()
+
+
+class FakeClock:
+    """Virtual clock that advances instantly, for testing without sleeping"""
+    def __init__(self, start=0.0):
+        self.current = start
+
+    def now(self):
+        return self.current
+
+
+class IdleSource:
+    """Interface for reading the system idle time"""
+    def idle_seconds(self):
+        raise NotImplementedError
+
+    def sample(self):
+        """idle_seconds() for callers off the detector's thread"""
+        return self.idle_seconds()
+
+
+class Win32IdleSource(IdleSource):
+    """Idle time from GetLastInputInfo using a preallocated struct
+
+    The struct belongs to the detector's thread; `sample` fills one of its
+    own so the control API and the window can read the idle time too.
+    """
+    class LASTINPUTINFO(ctypes.Structure):
+        _fields_ = [
+            ('cbSize', ctypes.c_uint),
+            ('dwTime', ctypes.c_uint),
+        ]
+
+    def __init__(self):
+        self._info = self.LASTINPUTINFO()
+        self._info.cbSize = ctypes.sizeof(self._info)
+        self._info_ref = ctypes.byref(self._info)
+        self._get_last_input_info = ctypes.windll.user32.GetLastInputInfo
+        self._get_tick_count = ctypes.windll.kernel32.GetTickCount
+        self._get_tick_count.restype = ctypes.c_uint32
+
+    def idle_seconds(self):
+        return self._read(self._info, self._info_ref)
+
+    def sample(self):
+        info = self.LASTINPUTINFO()
+        info.cbSize = ctypes.sizeof(info)
+        return self._read(info, ctypes.byref(info))
+
+    def _read(self, info, info_ref):
+        if not self._get_last_input_info(info_ref):
+            return 0.0
+        # Both values are 32-bit tick counts that wrap every ~49.7 days
+        millis = (self._get_tick_count() - info.dwTime) & 0xFFFFFFFF
+        return millis / 1000.0
+
+
+class FakeIdleSource(IdleSource):
+    """Idle source driven by a clock, for testing on any platform"""
+    def __init__(self, clock):
+        self.clock = clock
+        self.last_input = clock.now()
+
+    def touch(self):
+        """Simulate user input"""
+        self.last_input = self.clock.now()
+
+    def idle_seconds(self):
+        return max(0.0, self.clock.now() - self.last_input)
+
+
+class IdleRule:
+    """One tier of the idle policy: run `action` after `after` seconds idle
+
+    A non-zero `warning` shows the countdown window that many seconds
+    before the action. `value` is the volume percent for 'volume'.
+    """
+    ACTIONS = ('volume', 'lock', 'sleep', 'shutdown')
+
+    def __init__(self, after, action, value=None, warning=0):
+        if action not in self.ACTIONS:
+            raise ValueError(f"Unknown idle action {action!r}")
+        if after <= 0 or not 0 <= warning <= after:
+            raise ValueError(f"Invalid timing for idle action {action!r}")
+        if action == 'volume' and value is None:
+            raise ValueError("The 'volume' idle action needs a value")
+        self.after = after
+        self.action = action
+        self.value = value
+        self.warning = warning
+
+    @classmethod
+    def from_dict(cls, spec):
+        return cls(spec['after'], spec['action'], spec.get('value'), spec.get('warning', 0))
+
+    def key(self):
+        return (self.after, self.action, self.value, self.warning)
+
+    def __repr__(self):
+        return f"IdleRule({self.after}s {self.action})"
+
+
+class RuleTable:
+    """Idle rules compiled into entries sorted by the idle time they fire at
+
+    A rule with a warning contributes two entries, WARN then ACT. The
+    detector remembers how many entries it has fired; the entries crossed
+    by the current idle time, and the next deadline, are found by bisect.
+    """
+    WARN, ACT = 'warn', 'act'
+
+    def __init__(self, rules):
+        entries = []
+        for rule in rules:
+            if rule.warning:
+                entries.append((rule.after - rule.warning, self.WARN, rule))
+            entries.append((rule.after, self.ACT, rule))
+        entries.sort(key=lambda entry: entry[0])
+        self.entries = entries
+        self.thresholds = [entry[0] for entry in entries]
+        self.key = tuple(rule.key() for rule in rules)
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def first(self):
+        return self.thresholds[0] if self.thresholds else None
+
+    def crossed(self, idle_time):
+        """Number of entries whose threshold idle_time has reached"""
+        return bisect.bisect_right(self.thresholds, idle_time)
+
+    def next_threshold(self, fired):
+        """Idle time of the next entry after `fired` entries, or None"""
+        return self.thresholds[fired] if fired < len(self.thresholds) else None
+
+    def describe(self):
+        return ", ".join(
+            f"{rule.action} at {rule.after}s" + (f" (warning {rule.warning}s)" if rule.warning else "")
+            for _, phase, rule in self.entries if phase == self.ACT
+        ) or "no rules"
+
+    @classmethod
+    def from_config(cls, config):
+        """Compile `idle_rules`, or the single warn-then-shutdown rule from
+        idle_threshold and shutdown_delay when no rules are configured"""
+        specs = config.get('idle_rules')
+        if not specs:
+            delay = config.get('shutdown_delay', 30)
+            specs = [{'after': config.get('idle_threshold', 30) + delay, 'action': 'shutdown', 'warning': delay}]
+        return cls([IdleRule.from_dict(spec) for spec in specs])
+
+
+def compile_idle_rules(config, log=print):
+    """RuleTable for config, falling back to the threshold/delay rule if idle_rules is invalid"""
+    try:
+        return RuleTable.from_config(config)
+    except (ValueError, KeyError, TypeError) as e:
+        log(f"Invalid idle_rules ({e}), using idle_threshold and shutdown_delay")
+        return RuleTable.from_config({**config, 'idle_rules': None})
+
+
+class IdleDetector:
+    """Deadline-driven idle detector
+
+    Instead of polling every second, the detector sleeps until the earliest
+    moment the next rule threshold could be crossed (idle time grows by at
+    most one second per second). Once a rule has fired it polls to notice
+    activity: quickly while a warning is shown, every second otherwise.
+    """
+    ACTIVE_THRESHOLD = 1.0    # idle time below this counts as user activity
+    WARNING_POLL = 0.5        # poll interval while a warning is shown
+    FIRED_POLL = 1.0          # poll interval after an action, until activity
+    EDGE_MARGIN = 0.05        # wake slightly after the predicted crossing
+    MIN_SLEEP = 0.05
+    MAX_SLEEP = 3600.0        # only reached with no rules at all
+
+    def __init__(self, source, clock, rules, on_rule, on_active, scheduler, on_idle=None, on_withdraw=None):
+        self.source = source
+        self.clock = clock
+        self.rules = rules
+        self.on_rule = on_rule        # on_rule(phase, rule) for each entry crossed
+        self.on_active = on_active    # activity after at least one entry fired
+        self.on_idle = on_idle        # on_idle(idle_time) when the first entry fires
+        self.on_withdraw = on_withdraw  # on_withdraw(rule) when new rules drop a warned rule
+        self.scheduler = scheduler
+        self.fired = 0                # entries of self.rules checked in this episode
+        self.fired_keys = set()       # (phase, rule key) of the entries that actually fired
+        self.warnings = set()         # rules whose warning fired but action has not
+        self.last_active = clock.now()
+        self.wakeups = 0
+        self.started_at = None
+        self.paused = False
+        self._active = False
+        self._timer = None
+
+    @property
+    def running(self):
+        return self._active
+
+    @property
+    def warned(self):
+        return bool(self.warnings)
+
+    @property
+    def threshold(self):
+        """Idle time at which the first rule fires"""
+        return self.rules.first
+
+    def next_delay(self, idle_time):
+        """Seconds to sleep before the next idle check"""
+        delay = self.MAX_SLEEP
+        upcoming = self.rules.next_threshold(self.fired)
+        if upcoming is not None:
+            delay = max(self.MIN_SLEEP, upcoming - idle_time + self.EDGE_MARGIN)
+        if self.warnings:
+            delay = min(delay, self.WARNING_POLL)
+        elif self.fired:
+            delay = min(delay, self.FIRED_POLL)
+        return delay
+
+    def tick(self):
+        """Run one idle check, fire callbacks and return the next delay"""
+        self.wakeups += 1
+        idle_time = self.source.idle_seconds()
+        crossed = self.rules.crossed(idle_time)
+
+        # Idle time dropping below a fired threshold also means input
+        # happened between two polls
+        if idle_time < self.ACTIVE_THRESHOLD or crossed < self.fired:
+            self.last_active = self.clock.now()
+            self.end_episode()
+        while self.fired < crossed:
+            _, phase, rule = self.rules.entries[self.fired]
+            self.fired += 1
+            key = (phase, rule.key())
+            if key in self.fired_keys:
+                continue  # Fired under the rules in force before a swap
+            if not self.fired_keys and self.on_idle:
+                self.on_idle(idle_time)
+            self.fired_keys.add(key)
+            if phase == RuleTable.WARN:
+                self.warnings.add(rule)
+            else:
+                self.warnings.discard(rule)
+            self.on_rule(phase, rule)
+
+        return self.next_delay(idle_time)
+
+    def end_episode(self):
+        """Forget the fired rules; unlike reset() this runs in the caller's thread"""
+        if self.fired_keys:
+            self.fired = 0
+            self.fired_keys.clear()
+            self.warnings.clear()
+            self.on_active()
+
+    def set_rules(self, rules):
+        """Swap in a new rule table and reschedule the pending wakeup"""
+        if self._active:
+            self.scheduler.submit(lambda: self._apply_rules(rules))
+        else:
+            self.rules = rules
+
+    def _apply_rules(self, rules):
+        # Scheduler thread only: tiers that fired in this episode are not
+        # fired again, and tiers the new rules put below the current idle
+        # time fire on the check _reschedule runs right away
+        idle_time = self.source.idle_seconds()
+        if idle_time < self.ACTIVE_THRESHOLD or self.rules.crossed(idle_time) < self.fired:
+            self.end_episode()
+        self.rules = rules
+        if self.fired_keys:
+            # A warned rule the new table no longer has will not act, so its
+            # warning (and a shutdown armed for it) must be taken back
+            keys = {rule.key() for _, _, rule in rules.entries}
+            for rule in [rule for rule in self.warnings if rule.key() not in keys]:
+                self.fired_keys.discard((RuleTable.WARN, rule.key()))
+                if self.on_withdraw:
+                    self.on_withdraw(rule)
+            self.fired = 0
+            while self.fired < len(rules) and self._entry_key(rules.entries[self.fired]) in self.fired_keys:
+                self.fired += 1
+            self.warnings = {rule for _, phase, rule in rules.entries
+                             if (RuleTable.WARN, rule.key()) in self.fired_keys
+                             and (RuleTable.ACT, rule.key()) not in self.fired_keys}
+        self._reschedule()
+
+    @staticmethod
+    def _entry_key(entry):
+        _, phase, rule = entry
+        return phase, rule.key()
+
+    def reset(self):
+        """End the idle episode, e.g. after the user dismissed the warning"""
+        if self._active:
+            self.scheduler.submit(self._acknowledge)
+
+    def _acknowledge(self):
+        # Scheduler thread only
+        self.end_episode()
+        self._reschedule()
+
+    def pause(self):
+        """Stop checking (and end the idle episode) until resume()"""
+        self.scheduler.submit(self._pause)
+
+    def _pause(self):
+        # Scheduler thread only: the scheduler holds back the pending
+        # check, so it shows up in the scheduler's paused features
+        self.paused = True
+        self.end_episode()
+        self.scheduler.pause('idle')
+
+    def resume(self):
+        self.scheduler.submit(self._resume)
+
+    def _resume(self):
+        # Scheduler thread only
+        if self.paused:
+            self.paused = False
+            self.scheduler.resume('idle')
+            self._reschedule()
+
+    def wakeups_per_hour(self):
+        if self.started_at is None:
+            return 0.0
+        elapsed = self.clock.now() - self.started_at
+        if elapsed <= 0:
+            return 0.0
+        return self.wakeups * 3600.0 / elapsed
+
+    def _run(self):
+        # Scheduler thread only
+        self._timer = None
+        if not self._active or self.paused:
+            return
+        delay = self.tick()
+        self._timer = self.scheduler.call_later(delay, self._run, feature='idle')
+
+    def _reschedule(self):
+        # Scheduler thread only: drop the pending wakeup and check right away
+        if self._timer is not None:
+            self._timer.cancel()
+        self._run()
+
+    def _cancel(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def start(self):
+        if self._active:
+            return
+        self.fired = 0
+        self.fired_keys.clear()
+        self.warnings.clear()
+        self.wakeups = 0
+        self.started_at = self.clock.now()
+        self._active = True
+        self.scheduler.submit(self._reschedule)
+
+    def stop(self):
+        self._active = False
+        self.scheduler.submit(self._cancel)
+
+
+# ==============================================
+# IDLE REPLAY
+# ==============================================
+class TraceIdleSource(IdleSource):
+    """Idle source that replays recorded activity against a (virtual) clock
+
+    `active` is a list of (begin, end) spans, in clock seconds, during which
+    the user was giving input; idle time is the time since the last span
+    ended. touch() adds input at the current time, like FakeIdleSource.
+    """
+    def __init__(self, clock, active):
+        self.clock = clock
+        self.active = sorted(active)
+        self.begins = [begin for begin, _ in self.active]
+        self.last_input = clock.now()
+
+    def touch(self):
+        self.last_input = self.clock.now()
+
+    def next_input(self, after):
+        """Start of the first span beginning after `after`, or None"""
+        index = bisect.bisect_right(self.begins, after)
+        return self.begins[index] if index < len(self.begins) else None
+
+    def active_until(self, now):
+        """End of the span under way at `now`, or None"""
+        index = bisect.bisect_right(self.begins, now)
+        if index and now < self.active[index - 1][1]:
+            return self.active[index - 1][1]
+        return None
+
+    def idle_seconds(self):
+        now = self.clock.now()
+        last_input = self.last_input
+        index = bisect.bisect_right(self.begins, now)
+        if index:
+            begin, end = self.active[index - 1]
+            last_input = max(last_input, min(now, end))
+        return max(0.0, now - last_input)
+
+
+class IdleReplay:
+    """Drive an IdleDetector through an activity trace in virtual time
+
+    The detector runs exactly as it does live, with the same rule table and
+    deadline-driven wakeups, but the clock jumps straight from one wakeup to
+    the next, so weeks of activity replay in about a second. Checks that
+    can only find the user still busy, or still away after an action, are
+    counted without being run. With `dismiss_after`, the simulated user
+    clicks OK that many seconds into each warning. Actions are only
+    counted; a shutdown does not end the trace.
+    """
+    def __init__(self, rules, active, dismiss_after=None):
+        self.clock = FakeClock()
+        self.source = TraceIdleSource(self.clock, active)
+        self.detector = IdleDetector(self.source, self.clock, rules,
+                                     on_rule=self.on_rule, on_active=self.on_active, scheduler=None)
+        self.dismiss_after = dismiss_after
+        self.dismiss_at = None
+        self.events = []    # (time, phase, action) for every rule fired
+        self.actions = {}
+        self.warnings = 0
+        self.dismissals = 0
+        self.episodes = 0
+        self.ticks = 0      # checks actually run; detector.wakeups includes skipped polls
+        self.elapsed = 0.0
+
+    def on_rule(self, phase, rule):
+        self.events.append((self.clock.current, phase, rule.action))
+        if phase == RuleTable.WARN:
+            self.warnings += 1
+            if self.dismiss_after is not None and self.dismiss_after < rule.warning:
+                self.dismiss_at = self.clock.current + self.dismiss_after
+        else:
+            self.actions[rule.action] = self.actions.get(rule.action, 0) + 1
+
+    def on_active(self):
+        self.episodes += 1
+        self.dismiss_at = None
+
+    def run(self, until):
+        """Replay up to clock time `until`; returns self"""
+        started = time.perf_counter()
+        clock = self.clock
+        detector = self.detector
+        wake = clock.current
+        while True:
+            if self.dismiss_at is not None and self.dismiss_at <= min(wake, until):
+                # Clicking OK is input, and the app ends the episode right away
+                clock.current = self.dismiss_at
+                self.dismiss_at = None
+                self.dismissals += 1
+                self.source.touch()
+                detector.end_episode()
+                wake = clock.current
+                continue
+            if wake >= until:
+                break
+            clock.current = wake
+            delay = detector.tick()
+            self.ticks += 1
+            wake += delay
+            if not detector.fired:
+                skipped = self.busy_checks(wake, delay, until)
+            elif delay == detector.FIRED_POLL and not detector.warnings:
+                skipped = self.quiet_polls(wake, delay, until)
+            else:
+                continue
+            detector.wakeups += skipped
+            wake += skipped * delay
+        clock.current = until
+        self.elapsed += time.perf_counter() - started
+        return self
+
+    def busy_checks(self, wake, delay, until):
+        """Number of checks from `wake` on that fall inside the current input span"""
+        active_until = self.source.active_until(self.clock.current)
+        if active_until is None:
+            return 0
+        return max(0, int((min(active_until, until) - wake) // delay))
+
+    def quiet_polls(self, wake, delay, until):
+        """Number of activity polls from `wake` on, before `until`, that would find nothing to do"""
+        now = self.clock.current
+        quiet_until = min(until, self.source.next_input(now) or until)
+        upcoming = self.detector.rules.next_threshold(self.detector.fired)
+        if upcoming is not None:
+            # Closer to the next threshold than one poll, the detector shortens its sleep
+            crossing = now + upcoming - self.source.idle_seconds()
+            quiet_until = min(quiet_until, crossing + self.detector.EDGE_MARGIN - delay)
+        return max(0, int((quiet_until - wake) // delay))
+
+    def summary(self):
+        return {
+            'hours': self.clock.current / 3600,
+            'wakeups': self.detector.wakeups,
+            'ticks': self.ticks,
+            'replay_ms': self.elapsed * 1000,
+            'per_tick_us': self.elapsed / self.ticks * 1e6 if self.ticks else 0.0,
+            'warnings': self.warnings,
+            'dismissals': self.dismissals,
+            'episodes': self.episodes,
+            **self.actions,
+        }
+
+    def describe(self):
+        info = self.summary()
+        actions = ", ".join(f"{count} {action}" for action, count in sorted(self.actions.items())) or "no actions"
+        return (f"Replayed {info['hours']:.1f} h in {info['replay_ms']:.1f} ms "
+                f"({info['wakeups']} wakeups, {info['ticks']} checks run, {info['per_tick_us']:.2f} us each): "
+                f"{self.warnings} warnings, {self.dismissals} dismissed, {actions}")
+
+
+def synthetic_activity(hours, seed=0):
+    """Random working days: bursts of input with short pauses, breaks and nights
+
+    Returns (begin, end) spans in seconds from 0 for TraceIdleSource.
+    """
+    rng = random.Random(seed)
+    spans = []
+    for day in range(int(hours // 24) + 1):
+        now = day * 86400 + rng.uniform(7, 10) * 3600
+        finish = min(hours * 3600, day * 86400 + rng.uniform(17, 23) * 3600)
+        while now < finish:
+            burst = rng.expovariate(1 / 90)
+            spans.append((now, min(finish, now + burst)))
+            # Mostly reading pauses; now and then a meeting or coffee break
+            pause = rng.expovariate(1 / 1800) if rng.random() < 0.05 else rng.expovariate(1 / 15)
+            now += burst + pause
+    return spans
+
+
+def recorded_activity(store, start, end):
+    """Active spans between the idle periods in the history, in seconds from `start`
+
+    Time the machine was off after a shutdown counts as active.
+    """
+    spans = []
+    previous = start
+    for begin, finish in store.idle_periods(start, end):
+        if begin > previous:
+            spans.append((previous - start, begin - start))
+        previous = finish
+    if previous < end:
+        spans.append((previous - start, end - start))
+    return spans
+
+
+# ==============================================
+# VOLUME BACKEND
+# ==============================================
+class VolumeBackend:
+    """Interface for reading and writing the master volume (scalar 0.0-1.0)
+
+    `calls` counts every round trip to the audio stack so the cost of
+    enforcement can be measured.
+    """
+    def __init__(self):
+        self.calls = 0
+
+    def get_level(self):
+        raise NotImplementedError
+
+    def set_level(self, level):
+        raise NotImplementedError
+
+    def register_callback(self, on_change):
+        """Subscribe to volume changes; returns False if unsupported"""
+        return False
+
+    def unregister_callback(self):
+        pass
+
+
+@functools.lru_cache(maxsize=None)
+def endpoint_volume_callback_class():
+    """Build the COM callback class once comtypes has been imported"""
+    from comtypes import COMObject
+    from pycaw.pycaw import IAudioEndpointVolumeCallback
+
+    class EndpointVolumeCallback(COMObject):
+        """IAudioEndpointVolumeCallback forwarding the new master level"""
+        _com_interfaces_ = [IAudioEndpointVolumeCallback]
+
+        def __init__(self, on_change):
+            super().__init__()
+            self.on_change = on_change
+
+        def OnNotify(self, pNotify):
+            self.on_change(pNotify.contents.fMasterVolume)
+
+    return EndpointVolumeCallback
+
+
+@functools.lru_cache(maxsize=None)
+def device_notification_client_class():
+    """Build the IMMNotificationClient class once comtypes has been imported"""
+    from comtypes import COMObject
+    from pycaw.pycaw import IMMNotificationClient
+
+    class DeviceNotificationClient(COMObject):
+        """IMMNotificationClient reporting default playback device changes"""
+        _com_interfaces_ = [IMMNotificationClient]
+        E_RENDER = 0
+
+        def __init__(self, on_default_changed):
+            super().__init__()
+            self.on_default_changed = on_default_changed
+
+        def OnDefaultDeviceChanged(self, flow, role, pwstrDefaultDeviceId):
+            if flow == self.E_RENDER:
+                self.on_default_changed()
+
+        def OnDeviceStateChanged(self, pwstrDeviceId, dwNewState):
+            pass
+
+        def OnDeviceAdded(self, pwstrDeviceId):
+            pass
+
+        def OnDeviceRemoved(self, pwstrDeviceId):
+            pass
+
+        def OnPropertyValueChanged(self, pwstrDeviceId, key):
+            pass
+
+    return DeviceNotificationClient
+
+
+class PycawVolumeBackend(VolumeBackend):
+    """Master volume of the default speakers through IAudioEndpointVolume"""
+    def __init__(self, endpoint):
+        super().__init__()
+        self.endpoint = endpoint
+        self._callback = None
+
+    def get_level(self):
+        self.calls += 1
+        return self.endpoint.GetMasterVolumeLevelScalar()
+
+    def set_level(self, level):
+        self.calls += 1
+        self.endpoint.SetMasterVolumeLevelScalar(level, None)
+
+    def register_callback(self, on_change):
+        if self._callback is not None:
+            self.unregister_callback()
+        callback = endpoint_volume_callback_class()(on_change)
+        self.calls += 1
+        self.endpoint.RegisterControlChangeNotify(callback)
+        self._callback = callback
+        return True
+
+    def unregister_callback(self):
+        if self._callback is None:
+            return
+        try:
+            self.calls += 1
+            self.endpoint.UnregisterControlChangeNotify(self._callback)
+        finally:
+            self._callback = None
+
+
+class FakeVolumeBackend(VolumeBackend):
+    """In-memory volume backend for testing on any platform
+
+    `external_change` simulates another program changing the volume; the
+    delay until the next `set_level` is recorded in `latencies`.
+    """
+    def __init__(self, level=0.5, clock=None, notifications=True):
+        super().__init__()
+        self.level = level
+        self.clock = clock or MonotonicClock()
+        self.notifications = notifications
+        self.disconnected = False
+        self.latencies = []
+        self._on_change = None
+        self._changed_at = None
+
+    def _check_connected(self):
+        if self.disconnected:
+            raise OSError("Fake audio device disconnected")
+
+    def get_level(self):
+        self.calls += 1
+        self._check_connected()
+        return self.level
+
+    def set_level(self, level):
+        self.calls += 1
+        self._check_connected()
+        self.level = level
+        if self._changed_at is not None:
+            self.latencies.append(self.clock.now() - self._changed_at)
+            self._changed_at = None
+        self._notify()
+
+    def register_callback(self, on_change):
+        if not self.notifications:
+            return False
+        self._on_change = on_change
+        return True
+
+    def unregister_callback(self):
+        self._on_change = None
+
+    def external_change(self, level):
+        self.level = level
+        self._changed_at = self.clock.now()
+        self._notify()
+
+    def _notify(self):
+        if self._on_change:
+            self._on_change(self.level)
+
+
+class EndpointUnavailable(Exception):
+    """The audio endpoint is lost and being re-acquired"""
+
+
+class EndpointManager(VolumeBackend):
+    """Cached audio endpoint that re-acquires itself after device changes
+
+    `activate()` returns a backend for the current default device. When the
+    default device changes (or a call fails) the cached backend is dropped
+    and activated again once, after a short settle delay so the burst of
+    per-role notifications causes a single re-activation. Writes made while
+    the endpoint is missing are kept and the latest is applied after
+    recovery. Everything except `invalidate` runs on the thread that owns
+    the endpoint; `schedule(delay, fn)` must run fn on that thread. The
+    re-activation cannot move to a worker: comtypes makes the main thread
+    a single-threaded COM apartment, and the endpoint interfaces may only
+    be called from the apartment that activated them.
+    """
+    SETTLE_DELAY = 0.5
+    RETRY_DELAYS = (1, 2, 5, 10, 30)
+
+    def __init__(self, activate, schedule, watch_default_device=None, clock=None,
+                 log=None, on_recovered=None):
+        super().__init__()
+        self.activate = activate
+        self.schedule = schedule
+        self.watch_default_device = watch_default_device
+        self.clock = clock or MonotonicClock()
+        self.log = log or print
+        self.on_recovered = on_recovered
+        self.current = None
+        self.reactivations = 0
+        self.failures = 0
+        self.last_reactivation_latency = None
+        self.max_reactivation_latency = 0.0
+        self._on_change = None
+        self._pending_level = None
+        self._lost_at = None
+        self._retry = 0
+        self._timer = None
+        self._lock = Lock()  # guards _timer and _lost_at against invalidate from audio threads
+        self._unwatch = None
+
+    @property
+    def available(self):
+        return self.current is not None
+
+    def start(self):
+        """Activate the endpoint and watch for default device changes"""
+        if self.watch_default_device and self._unwatch is None:
+            try:
+                self._unwatch = self.watch_default_device(self.invalidate)
+            except Exception as e:
+                self.log(f"Default device notifications unavailable: {e}")
+        if self.current is not None:
+            return True
+        if self._acquire():
+            return True
+        with self._lock:
+            self._lost_at = self.clock.now()
+        self._schedule_retry()
+        return False
+
+    def close(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if self._unwatch is not None:
+            try:
+                self._unwatch()
+            except Exception:
+                pass
+            self._unwatch = None
+        self._drop_current()
+
+    def invalidate(self):
+        """Mark the endpoint stale and re-acquire it shortly; safe from any thread"""
+        with self._lock:
+            if self._lost_at is None:
+                self._lost_at = self.clock.now()
+            if self._timer is None:
+                self._timer = self.schedule(self.SETTLE_DELAY, self._reacquire)
+
+    def get_level(self):
+        if self.current is None:
+            raise EndpointUnavailable("Audio endpoint is being re-acquired")
+        self.calls += 1
+        try:
+            return self.current.get_level()
+        except Exception:
+            self.invalidate()
+            raise
+
+    def set_level(self, level):
+        if self.current is not None:
+            self.calls += 1
+            try:
+                self.current.set_level(level)
+                self._pending_level = None
+                return
+            except Exception:
+                self.invalidate()
+        # Applied once the endpoint is back
+        self._pending_level = level
+
+    def register_callback(self, on_change):
+        self._on_change = on_change
+        if self.current is None:
+            return True  # registered on the endpoint once it is acquired
+        return self.current.register_callback(on_change)
+
+    def unregister_callback(self):
+        self._on_change = None
+        if self.current is not None:
+            self.current.unregister_callback()
+
+    def describe(self):
+        latency = self.last_reactivation_latency
+        latency_text = f"{latency * 1000:.0f} ms" if latency is not None else "n/a"
+        return (f"Audio endpoint: {self.reactivations} re-activations, {self.failures} failures, "
+                f"last {latency_text}, max {self.max_reactivation_latency * 1000:.0f} ms")
+
+    def _drop_current(self):
+        if self.current is not None:
+            try:
+                self.current.unregister_callback()
+            except Exception:
+                pass
+            self.current = None
+
+    def _acquire(self):
+        try:
+            backend = self.activate()
+        except Exception as e:
+            self.failures += 1
+            self.log(f"Failed to activate audio endpoint: {e}")
+            return False
+        self.current = backend
+        if self._on_change is not None:
+            try:
+                backend.register_callback(self._on_change)
+            except Exception:
+                pass
+        self._retry = 0
+        return True
+
+    def _reacquire(self):
+        with self._lock:
+            self._timer = None
+        self._drop_current()
+        if not self._acquire():
+            self._schedule_retry()
+            return
+        
+        with self._lock:
+            lost_at, self._lost_at = self._lost_at, None
+        if lost_at is not None:
+            latency = self.clock.now() - lost_at
+            self.reactivations += 1
+            self.last_reactivation_latency = latency
+            self.max_reactivation_latency = max(self.max_reactivation_latency, latency)
+            self.log(f"Audio endpoint re-acquired in {latency * 1000:.0f} ms")
+        if self._pending_level is not None:
+            level, self._pending_level = self._pending_level, None
+            self.set_level(level)
+        if self.on_recovered:
+            self.on_recovered()
+
+    def _schedule_retry(self):
+        delay = self.RETRY_DELAYS[min(self._retry, len(self.RETRY_DELAYS) - 1)]
+        self._retry += 1
+        with self._lock:
+            if self._timer is None:
+                self._timer = self.schedule(delay, self._reacquire)
+
+
+class VolumeEnforcer:
+    """Reverts external volume changes back to the saved level
+
+    Change notifications trigger enforcement right away, so polling is only
+    a slow safety net. Backends without notifications are polled at the
+    original one-second rate.
+    """
+    POLL_INTERVAL = 1.0
+    SAFETY_POLL_INTERVAL = 30.0
+
+    def __init__(self, backend, target=None, dispatch=None, on_correct=None):
+        self.backend = backend
+        self.target = target
+        # Notifications arrive on an audio thread; dispatch hands them to
+        # the thread that owns the endpoint
+        self.dispatch = dispatch or (lambda fn: fn())
+        self.on_correct = on_correct
+        self.event_driven = False
+        self.notifications = 0
+        self.corrections = 0
+
+    @property
+    def poll_interval(self):
+        return self.SAFETY_POLL_INTERVAL if self.event_driven else self.POLL_INTERVAL
+
+    def start(self):
+        """Subscribe to change notifications if the backend supports them"""
+        try:
+            self.event_driven = self.backend.register_callback(self._on_notify)
+        except Exception:
+            self.event_driven = False
+        return self.event_driven
+
+    def stop(self):
+        if self.event_driven:
+            try:
+                self.backend.unregister_callback()
+            except Exception:
+                pass
+            self.event_driven = False
+
+    def _on_notify(self, level):
+        self.notifications += 1
+        self.dispatch(lambda: self.check(level))
+
+    def check(self, level=None):
+        """Restore the target if the volume drifted; True if corrected"""
+        if self.target is None:
+            return False
+        if level is None:
+            level = self.backend.get_level()
+        # Round rather than truncate: 0.29 reads back as 0.2899... and would
+        # otherwise be "corrected" forever
+        if round(level * 100) == self.target:
+            return False
+        self.corrections += 1
+        if self.on_correct:
+            self.on_correct(self.target)
+        else:
+            self.backend.set_level(self.target / 100)
+        return True
+
+
+# ==============================================
+# APPLICATION SESSION VOLUMES
+# ==============================================
+class AudioSession:
+    """One application's audio session, indexed by lowercase process name"""
+    def __init__(self, key, name, volume):
+        self.key = key
+        self.name = name.lower()
+        self.volume = volume    # ISimpleAudioVolume or a fake with the same methods
+        self.handle = None      # backend bookkeeping (notification registration)
+
+    def get_level(self):
+        return self.volume.GetMasterVolume()
+
+    def set_level(self, level):
+        self.volume.SetMasterVolume(level, None)
+
+
+class SessionBackend:
+    """Interface for enumerating audio sessions and their notifications"""
+    def start(self, on_created, on_expired, on_volume):
+        """Subscribe to session notifications and return the current sessions
+
+        on_created(session) and on_expired(session) report sessions coming
+        and going; on_volume(session, level) reports volume changes.
+        """
+        raise NotImplementedError
+
+    def release(self, session):
+        """Drop notifications for an expired session (never from a callback)"""
+
+    def stop(self):
+        pass
+
+
+@functools.lru_cache(maxsize=None)
+def session_notification_class():
+    """Build the IAudioSessionNotification class once comtypes has been imported"""
+    from comtypes import COMObject
+    from pycaw.api.audiopolicy import IAudioSessionNotification
+
+    class SessionNotification(COMObject):
+        """IAudioSessionNotification forwarding new sessions"""
+        _com_interfaces_ = [IAudioSessionNotification]
+
+        def __init__(self, on_created):
+            super().__init__()
+            self.on_created = on_created
+
+        def OnSessionCreated(self, NewSession):
+            self.on_created(NewSession)
+
+    return SessionNotification
+
+
+@functools.lru_cache(maxsize=None)
+def session_events_class():
+    """Build the IAudioSessionEvents class once comtypes has been imported"""
+    from comtypes import COMObject
+    from pycaw.api.audiopolicy import IAudioSessionEvents
+
+    class SessionEvents(COMObject):
+        """IAudioSessionEvents reporting volume changes and expiry of one session"""
+        _com_interfaces_ = [IAudioSessionEvents]
+        STATE_EXPIRED = 2
+
+        def __init__(self, on_volume, on_expired):
+            super().__init__()
+            self.on_volume = on_volume
+            self.on_expired = on_expired
+
+        def OnSimpleVolumeChanged(self, NewVolume, NewMute, EventContext):
+            self.on_volume(NewVolume)
+
+        def OnStateChanged(self, NewState):
+            if NewState == self.STATE_EXPIRED:
+                self.on_expired()
+
+        def OnSessionDisconnected(self, DisconnectReason):
+            self.on_expired()
+
+        def OnDisplayNameChanged(self, NewDisplayName, EventContext):
+            pass
+
+        def OnIconPathChanged(self, NewIconPath, EventContext):
+            pass
+
+        def OnChannelVolumeChanged(self, ChannelCount, NewChannelVolumeArray, ChangedChannel, EventContext):
+            pass
+
+        def OnGroupingParamChanged(self, NewGroupingParam, EventContext):
+            pass
+
+    return SessionEvents
+
+
+def open_session_backend():
+    """Session manager of the default speakers; raises if unavailable"""
+    from pycaw.pycaw import AudioUtilities
+    return PycawSessionBackend(AudioUtilities.GetAudioSessionManager())
+
+
+class PycawSessionBackend(SessionBackend):
+    """Audio sessions through IAudioSessionManager2"""
+    def __init__(self, manager):
+        self.manager = manager
+        self._notification = None
+
+    def start(self, on_created, on_expired, on_volume):
+        self.on_expired = on_expired
+        self.on_volume = on_volume
+        # The manager only sends notifications after the sessions were enumerated once
+        enumerator = self.manager.GetSessionEnumerator()
+        sessions = [self._wrap(enumerator.GetSession(i)) for i in range(enumerator.GetCount())]
+
+        def created(control):
+            session = self._wrap(control)
+            if session is not None:
+                on_created(session)
+
+        self._notification = session_notification_class()(created)
+        self.manager.RegisterSessionNotification(self._notification)
+        return [session for session in sessions if session is not None]
+
+    def _wrap(self, control):
+        import psutil
+        from pycaw.pycaw import IAudioSessionControl2, ISimpleAudioVolume
+
+        control = control.QueryInterface(IAudioSessionControl2)
+        pid = control.GetProcessId()
+        if not pid:
+            return None  # System sounds
+        try:
+            name = psutil.Process(pid).name()
+        except psutil.Error:
+            return None
+        session = AudioSession(control.GetSessionInstanceIdentifier(), name,
+                               control.QueryInterface(ISimpleAudioVolume))
+        events = session_events_class()(
+            lambda level: self.on_volume(session, level),
+            lambda: self.on_expired(session)
+        )
+        control.RegisterAudioSessionNotification(events)
+        session.handle = (control, events)
+        return session
+
+    def release(self, session):
+        if session.handle is None:
+            return
+        control, events = session.handle
+        session.handle = None
+        try:
+            control.UnregisterAudioSessionNotification(events)
+        except Exception:
+            pass
+
+    def stop(self):
+        if self._notification is not None:
+            try:
+                self.manager.UnregisterSessionNotification(self._notification)
+            except Exception:
+                pass
+            self._notification = None
+
+
+class FakeSimpleVolume:
+    """In-memory ISimpleAudioVolume"""
+    def __init__(self, level, on_change=None):
+        self.level = level
+        self.on_change = on_change
+        self.writes = 0
+
+    def GetMasterVolume(self):
+        return self.level
+
+    def SetMasterVolume(self, level, context):
+        self.writes += 1
+        self.level = level
+        if self.on_change:
+            self.on_change(level)
+
+
+class FakeSessionBackend(SessionBackend):
+    """In-memory sessions for testing on any platform"""
+    def __init__(self):
+        self.sessions = {}
+        self._keys = itertools.count()
+        self._callbacks = None
+
+    def start(self, on_created, on_expired, on_volume):
+        self._callbacks = (on_created, on_expired, on_volume)
+        return list(self.sessions.values())
+
+    def add(self, name, level=1.0):
+        """Simulate an application opening a session"""
+        key = next(self._keys)
+        session = AudioSession(key, name, FakeSimpleVolume(level))
+        session.volume.on_change = lambda level: self._callbacks and self._callbacks[2](session, level)
+        self.sessions[key] = session
+        if self._callbacks:
+            self._callbacks[0](session)
+        return session
+
+    def expire(self, session):
+        """Simulate an application closing its session"""
+        self.sessions.pop(session.key, None)
+        if self._callbacks:
+            self._callbacks[1](session)
+
+    def external_change(self, session, level):
+        """Simulate the user changing an application's volume in the mixer"""
+        session.volume.level = level
+        if self._callbacks:
+            self._callbacks[2](session, level)
+
+    def stop(self):
+        self._callbacks = None
+
+
+class SessionVolumeEnforcer:
+    """Holds per-application volumes at their targets
+
+    Sessions are indexed by process name as they are created and dropped
+    when they expire, so sessions are never rescanned. A volume change
+    notification only causes a write when that session has drifted from its
+    application's target, and sessions of untargeted applications are
+    never read or written.
+    """
+    def __init__(self, backend, targets=None, dispatch=None, log=None):
+        self.backend = backend
+        self.targets = self.normalize(targets)
+        # Notifications arrive on audio threads; dispatch(fn, key) hands them
+        # to the thread that owns the sessions
+        self.dispatch = dispatch or (lambda fn, key=None: fn())
+        self.log = log or print
+        self.index = {}   # process name -> {session key: AudioSession}
+        self.notifications = 0
+        self.corrections = 0
+        self.started = False
+
+    @staticmethod
+    def normalize(targets):
+        return {name.lower(): round(percent) for name, percent in (targets or {}).items()}
+
+    @property
+    def session_count(self):
+        return sum(len(sessions) for sessions in self.index.values())
+
+    def start(self):
+        sessions = self.backend.start(
+            on_created=lambda session: self.dispatch(lambda: self._add(session), None),
+            on_expired=lambda session: self.dispatch(lambda: self._remove(session), None),
+            on_volume=self._on_volume
+        )
+        self.started = True
+        for session in sessions:
+            self._add(session)
+
+    def stop(self):
+        self.started = False
+        self.backend.stop()
+        for sessions in self.index.values():
+            for session in sessions.values():
+                self.backend.release(session)
+        self.index.clear()
+
+    def set_targets(self, targets):
+        """Replace the per-application targets and enforce the ones that changed"""
+        previous, self.targets = self.targets, self.normalize(targets)
+        for name, target in self.targets.items():
+            if previous.get(name) != target:
+                self.check_app(name)
+
+    def check_app(self, name):
+        for session in list(self.index.get(name, {}).values()):
+            self.check(session)
+
+    def check_all(self):
+        """Safety-net pass over the sessions of targeted applications only"""
+        for name in self.targets:
+            self.check_app(name)
+
+    def check(self, session, level=None):
+        """Restore the application's target if this session drifted; True if corrected"""
+        target = self.targets.get(session.name)
+        if target is None:
+            return False
+        try:
+            if level is None:
+                level = session.get_level()
+            if round(level * 100) == target:
+                return False
+            self.corrections += 1
+            session.set_level(target / 100)
+            return True
+        except Exception as e:
+            self.log(f"Could not set {session.name} volume: {e}")
+            return False
+
+    def describe(self):
+        return (f"App volumes: {self.session_count} sessions indexed, {len(self.targets)} targets, "
+                f"{self.notifications} notifications, {self.corrections} corrections")
+
+    def _on_volume(self, session, level):
+        # Audio thread: changes to untargeted applications are dropped here
+        if session.name in self.targets:
+            self.notifications += 1
+            self.dispatch(lambda: self.check(session, level), ('session', session.key))
+
+    def _add(self, session):
+        if not self.started:
+            return
+        self.index.setdefault(session.name, {})[session.key] = session
+        self.check(session)
+
+    def _remove(self, session):
+        sessions = self.index.get(session.name)
+        if sessions and sessions.pop(session.key, None) is not None:
+            if not sessions:
+                del self.index[session.name]
+        self.backend.release(session)
+
+
+# ==============================================
+# SHUTDOWN BACKEND
+# ==============================================
+class ShutdownBackend:
+    """Interface for the power actions idle rules can take"""
+    def lock(self):
+        raise NotImplementedError
+
+    def sleep(self):
+        raise NotImplementedError
+
+    def shutdown(self):
+        raise NotImplementedError
+
+
+class SystemShutdownBackend(ShutdownBackend):
+    """Windows power actions
+
+    Shutdown calls ExitWindowsEx directly, or starts `command` (an argv
+    list) when one is configured; neither goes through a shell.
+    """
+    EWX_POWEROFF = 0x00000008
+    EWX_FORCE = 0x00000004      # like `shutdown /s /t 1`: applications cannot veto it
+    SHTDN_REASON_FLAG_PLANNED = 0x80000000
+    TOKEN_ADJUST_PRIVILEGES = 0x0020
+    TOKEN_QUERY = 0x0008
+    SE_PRIVILEGE_ENABLED = 0x00000002
+    ERROR_NOT_ALL_ASSIGNED = 1300
+
+    def __init__(self, command=None):
+        self.command = command
+
+    def lock(self):
+        ctypes.windll.user32.LockWorkStation()
+
+    def sleep(self):
+        # hibernate=False, force=True, disable wake events=False
+        ctypes.windll.powrprof.SetSuspendState(False, True, False)
+
+    def shutdown(self):
+        if self.command:
+            import subprocess
+            subprocess.Popen(self.command, creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0))
+            return
+        self._enable_shutdown_privilege()
+        if not ctypes.windll.user32.ExitWindowsEx(self.EWX_POWEROFF | self.EWX_FORCE, self.SHTDN_REASON_FLAG_PLANNED):
+            raise ctypes.WinError()
+
+    def _enable_shutdown_privilege(self):
+        # ExitWindowsEx needs SeShutdownPrivilege enabled on the process token
+        from ctypes import wintypes
+
+        class LUID(ctypes.Structure):
+            _fields_ = [('LowPart', wintypes.DWORD), ('HighPart', wintypes.LONG)]
+
+        class TOKEN_PRIVILEGES(ctypes.Structure):
+            _fields_ = [('PrivilegeCount', wintypes.DWORD), ('Luid', LUID), ('Attributes', wintypes.DWORD)]
+
+        kernel32 = ctypes.windll.kernel32
+        advapi32 = ctypes.WinDLL('advapi32', use_last_error=True)
+        kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+        token = wintypes.HANDLE()
+        if not advapi32.OpenProcessToken(kernel32.GetCurrentProcess(),
+                                         self.TOKEN_ADJUST_PRIVILEGES | self.TOKEN_QUERY, ctypes.byref(token)):
+            raise ctypes.WinError(ctypes.get_last_error())
+        try:
+            privileges = TOKEN_PRIVILEGES(1, LUID(), self.SE_PRIVILEGE_ENABLED)
+            if not advapi32.LookupPrivilegeValueW(None, "SeShutdownPrivilege", ctypes.byref(privileges.Luid)):
+                raise ctypes.WinError(ctypes.get_last_error())
+            if not advapi32.AdjustTokenPrivileges(token, False, ctypes.byref(privileges), 0, None, None):
+                raise ctypes.WinError(ctypes.get_last_error())
+            # Success only means the call ran; the privilege may still be missing from the token
+            if ctypes.get_last_error() == self.ERROR_NOT_ALL_ASSIGNED:
+                raise ctypes.WinError(self.ERROR_NOT_ALL_ASSIGNED)
+        finally:
+            kernel32.CloseHandle(token)
+
+
+class FakeShutdownBackend(ShutdownBackend):
+    """Records power actions as (action, time) instead of acting on them"""
+    def __init__(self, clock=None):
+        self.clock = clock or MonotonicClock()
+        self.requests = []
+
+    def _request(self, action):
+        self.requests.append((action, self.clock.now()))
+
+    def lock(self):
+        self._request('lock')
+
+    def sleep(self):
+        self._request('sleep')
+
+    def shutdown(self):
+        self._request('shutdown')
+
+
+class DryRunShutdownBackend(FakeShutdownBackend):
+    """Logs power actions instead of taking them (shutdown_dry_run in config.txt)"""
+    def __init__(self, log=print, clock=None):
+        super().__init__(clock)
+        self.log = log
+
+    def _request(self, action):
+        super()._request(action)
+        self.log(f"Dry run: {action} skipped")
+
+
+def argv_list(value):
+    """value if it is an argv list of strings, else None"""
+    if isinstance(value, list) and value and all(isinstance(arg, str) for arg in value):
+        return value
+    return None
+
+
+# config.txt keys that rebuild the shutdown executor when they change
+SHUTDOWN_KEYS = {'shutdown_command', 'shutdown_hooks', 'shutdown_hook_timeout', 'shutdown_dry_run'}
+
+
+def open_shutdown_backend(config, log=print):
+    """Power actions per config.txt: a dry run, a shutdown command or the Windows API"""
+    if config.get('shutdown_dry_run', False):
+        return DryRunShutdownBackend(log)
+    command = config.get('shutdown_command')
+    if command and not argv_list(command):
+        log("Invalid shutdown_command (expected a list of arguments), using the Windows API")
+    return SystemShutdownBackend(argv_list(command))
+
+
+class ShutdownExecutor:
+    """Pre-shutdown hooks run in parallel under one timeout, then the shutdown
+
+    `hooks` are (name, fn) pairs and `commands` argv lists from config.txt,
+    started directly without a shell; each runs on its own thread. Hooks
+    still running when `timeout` expires are left behind (commands are
+    killed) so they never hold the shutdown up. `results` keeps
+    (name, seconds, outcome) from the last run, in completion order.
+    """
+    def __init__(self, backend, hooks=(), commands=(), timeout=5.0, log=print):
+        self.backend = backend
+        self.hooks = list(hooks)
+        for command in commands:
+            if argv_list(command):
+                self.hooks.append((" ".join(command), functools.partial(self._run_command, command)))
+            else:
+                log(f"Invalid shutdown hook {command!r} (expected a list of arguments), skipping it")
+        self.timeout = timeout
+        self.log = log
+        self.results = []
+
+    def _run_command(self, argv):
+        import subprocess
+        code = subprocess.run(argv, timeout=self.timeout,
+                              stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                              creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0)).returncode
+        if code:
+            raise RuntimeError(f"exit status {code}")
+
+    def run_hooks(self):
+        """Run every hook at once and wait for them, at most `timeout` seconds"""
+        results = []
+        lock = Lock()
+
+        def run_hook(name, fn):
+            began = time.monotonic()
+            try:
+                fn()
+                outcome = 'ok'
+            except Exception as e:
+                outcome = f"failed ({e})"
+            with lock:
+                results.append((name, time.monotonic() - began, outcome))
+
+        started = time.monotonic()
+        deadline = started + self.timeout
+        threads = [Thread(target=run_hook, args=hook, name=f"hook-{hook[0]}", daemon=True) for hook in self.hooks]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        with lock:
+            self.results = list(results)
+        finished = {name for name, _, _ in self.results}
+        late = [name for name, _ in self.hooks if name not in finished]
+        failed = [f"{name} {outcome}" for name, _, outcome in self.results if outcome != 'ok']
+        if self.hooks:
+            self.log(f"Pre-shutdown hooks: {len(self.results) - len(failed)} done in "
+                     f"{(time.monotonic() - started) * 1000:.0f} ms"
+                     + (f", failed: {', '.join(failed)}" if failed else "")
+                     + (f", timed out: {', '.join(late)}" if late else ""))
+
+    def shutdown(self):
+        self.run_hooks()
+        self.backend.shutdown()
+
+
+# ==============================================
+# SHUTDOWN WATCHDOG
+# ==============================================
+class ShutdownWatchdog:
+    """Keeps the shutdown deadline on its own thread, away from the UI loop
+
+    arm() sets a deadline on a monotonic clock and, unless cancel() comes
+    first, the watchdog thread runs the action at the deadline itself. A
+    modal dialog or any other stall of the UI thread can delay the
+    countdown display, but neither the shutdown nor its cancellation by
+    the detector. `lateness` keeps how far past the deadline recent
+    actions started.
+    """
+    def __init__(self, clock=None):
+        self.clock = clock or MonotonicClock()
+        self.fired = 0
+        self.cancelled = 0
+        self.lateness = deque(maxlen=100)
+        self._cond = Condition()
+        self._deadline = None
+        self._action = None
+        self._stopped = False
+        self._thread = None
+
+    @property
+    def armed(self):
+        return self._action is not None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name='shutdown-watchdog', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def arm(self, seconds, action):
+        """Run action() on the watchdog thread in `seconds` unless cancelled; safe from any thread"""
+        with self._cond:
+            self._deadline = self.clock.now() + seconds
+            self._action = action
+            self._cond.notify()
+
+    def cancel(self):
+        """Drop the pending action; returns whether one was armed"""
+        with self._cond:
+            armed = self._action is not None
+            if armed:
+                self.cancelled += 1
+            self._deadline = self._action = None
+            self._cond.notify()
+        return armed
+
+    def remaining(self):
+        """Seconds left before the action, or None if not armed"""
+        deadline = self._deadline
+        return None if deadline is None else max(0.0, deadline - self.clock.now())
+
+    def describe(self):
+        late = max(self.lateness, default=0.0) * 1000
+        return f"Shutdown watchdog: {self.fired} fired, {self.cancelled} cancelled, max lateness {late:.1f} ms"
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if self._deadline is None:
+                        self._cond.wait()
+                        continue
+                    timeout = self._deadline - self.clock.now()
+                    if timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+                if self._stopped:
+                    return
+                action, late = self._action, self.clock.now() - self._deadline
+                self._deadline = self._action = None
+                self.fired += 1
+                self.lateness.append(late)
+            if METRICS.enabled:
+                METRICS.histogram('shutdown_lateness_seconds').observe(late)
+            try:
+                action()
+            except Exception as e:
+                print(f"Error in shutdown watchdog: {e}")
+
+
+def arm_shutdown_watchdog(watchdog, phase, rule, shutdown):
+    """Hand a shutdown rule's deadline to the watchdog as soon as the detector fires"""
+    if rule.action != 'shutdown':
+        return
+    if phase == RuleTable.WARN:
+        watchdog.arm(rule.warning, shutdown)
+    elif not rule.warning:
+        watchdog.arm(0, shutdown)
+
+
+def warning_deadline(watchdog, rule, requested=None):
+    """time.monotonic() at which a warned rule acts, for the countdown display"""
+    remaining = watchdog.remaining() if rule.action == 'shutdown' else None
+    if remaining is None:
+        # Count from when the detector fired, not from when the warning got shown
+        remaining = rule.warning - (time.perf_counter() - requested if requested is not None else 0.0)
+    return time.monotonic() + remaining
+
+
+# ==============================================
+# UI EVENT QUEUE
+# ==============================================
+class TkTimer:
+    """Cancellable one-shot Tk `after` callback, in seconds"""
+    def __init__(self, root, delay, fn):
+        self.root = root
+        self.id = root.after(max(0, int(delay * 1000)), fn)
+
+    def cancel(self):
+        try:
+            self.root.after_cancel(self.id)
+        except Exception:
+            pass
+
+
+class UIEventQueue:
+    """Channel from worker threads to the UI thread
+
+    Workers `post` callables from any thread; the UI thread runs everything
+    pending in one `drain`. Posting with a `key` replaces a pending event
+    with the same key, so bursts of show/hide transitions or volume
+    notifications collapse to the latest one. `notify` is called once per
+    batch (on the first post after a drain) to wake the UI thread; if it
+    raises, the failure is logged and the next post calls it again.
+    """
+    def __init__(self, notify=None):
+        self.notify = notify
+        self.posted = 0
+        self.collapsed = 0
+        self.batches = 0
+        self._lock = Lock()
+        self._pending = {}
+        self._ready = Event()
+        self._ids = itertools.count()
+
+    def post(self, fn, key=None):
+        """Queue fn for the UI thread; safe to call from any thread"""
+        with self._lock:
+            self.posted += 1
+            if key is None:
+                key = next(self._ids)
+            elif self._pending.pop(key, None) is not None:
+                self.collapsed += 1
+            self._pending[key] = fn
+            wake = not self._ready.is_set()
+            self._ready.set()
+        if wake and self.notify:
+            try:
+                self.notify()
+            except Exception as e:
+                # Leave the queue unwoken so the next post tries again
+                with self._lock:
+                    self._ready.clear()
+                print(f"Error waking the UI thread: {e}")
+
+    def wait(self, timeout=None):
+        """Block until something is pending; False on timeout"""
+        return self._ready.wait(timeout)
+
+    def drain(self):
+        """Run all pending events on the calling (UI) thread"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._ready.clear()
+        if pending:
+            self.batches += 1
+        for fn in pending.values():
+            try:
+                fn()
+            except Exception:
+                # One failing handler must not drop the rest of the batch
+                METRICS.inc('callback_errors')
+                import traceback
+                traceback.print_exc()
+        return len(pending)
+
+
+class VolumeWriter:
+    """Rate-limited pipeline for volume writes from the slider and buttons
+
+    At most `max_rate` endpoint writes per second: the first write after a
+    quiet period goes out immediately (leading edge) and the latest value of
+    a burst is written when the interval ends (trailing edge). Writes equal
+    to the last applied level are dropped, and `on_applied` receives the
+    level that was written so callers never need to read it back.
+    """
+    def __init__(self, backend, schedule, max_rate=20, clock=None, on_applied=None, on_error=None):
+        self.backend = backend
+        self.schedule = schedule    # schedule(delay_seconds, fn) -> cancellable
+        self.interval = 1.0 / max_rate
+        self.clock = clock or MonotonicClock()
+        self.on_applied = on_applied
+        self.on_error = on_error
+        self.applied = None
+        self.writes = 0
+        self.skipped = 0
+        self.coalesced = 0
+        self._pending = None
+        self._force = False
+        self._timer = None
+        self._last_write = None
+
+    def write(self, percent, force=False):
+        """Request a volume level; force skips the no-op check (e.g. after drift)"""
+        percent = round(max(0, min(100, float(percent))))
+        if self._timer is not None:
+            if self._pending is not None:
+                self.coalesced += 1
+            self._pending = percent
+            self._force = self._force or force
+            return
+        if percent == self.applied and not force:
+            self.skipped += 1
+            if self.on_applied:
+                self.on_applied(percent)
+            return
+        
+        now = self.clock.now()
+        if self._last_write is None or now - self._last_write >= self.interval:
+            self._apply(percent)
+        else:
+            self._pending = percent
+            self._force = force
+            self._timer = self.schedule(self.interval - (now - self._last_write), self._flush)
+
+    def cancel(self):
+        """Drop a pending trailing write"""
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = None
+        self._pending = None
+        self._force = False
+
+    def _flush(self):
+        percent, force = self._pending, self._force
+        self._timer = None
+        self._pending = None
+        self._force = False
+        if percent is None:
+            return
+        if percent == self.applied and not force:
+            self.skipped += 1
+            return
+        self._apply(percent)
+
+    def _apply(self, percent):
+        self._last_write = self.clock.now()
+        try:
+            self.backend.set_level(percent / 100)
+        except Exception as e:
+            self.applied = None
+            if self.on_error:
+                self.on_error(e)
+                return
+            raise
+        self.applied = percent
+        self.writes += 1
+        if self.on_applied:
+            self.on_applied(percent)
+
+
+# ==============================================
+# SHARED APP AND DAEMON LOGIC
+# ==============================================
+class IdleVolumeBase:
+    """Idle rules, profiles, volume enforcement and reporting shared by the window and the daemon
+
+    Subclasses provide dispatch() and after() to run work on their main
+    thread, plus log_status, set_volume, set_saved_volume, show_warning,
+    hide_warning and apply_setting_changes. State is created in their
+    __init__.
+    """
+
+    def cancel(self, timer):
+        if timer is not None:
+            timer.cancel()
+
+    def setting(self, key, default=None):
+        """Setting with the active time-of-day profile applied"""
+        return self.profile_overrides.get(key, getattr(self.settings, key, default))
+
+    def current_rules(self):
+        """Idle rules from the settings with the active profile applied"""
+        return compile_idle_rules({**self.settings.as_dict(), **self.profile_overrides}, self.log_status)
+
+    def apply_idle_rules(self):
+        """Hand the detector new rules if settings or profiles changed them"""
+        if self.detector:
+            rules = self.current_rules()
+            if rules.key != self.detector.rules.key:
+                self.detector.set_rules(rules)
+
+    def publish_settings(self):
+        """Publish a new settings snapshot after changing self.config"""
+        self.settings = next_settings(self.config, self.settings, self.log_status)
+        self.apply_idle_rules()
+
+    def apply_config_changes(self, changes, mtime):
+        """Apply keys that changed in config.txt to the running features"""
+        self.config.update(changes)
+        self.publish_settings()
+        self.apply_setting_changes(changes)
+        if 'app_volumes' in changes and self.settings.volume_control_enabled and self.volume_enforcer:
+            self.start_app_volumes()
+        if 'profiles' in changes:
+            self.start_profiles()
+        if changes.keys() & SHUTDOWN_KEYS:
+            self.shutdown_executor = self.build_shutdown_executor()
+        if changes.keys() & REPORT_KEYS:
+            self.start_reporting()
+        if changes.keys() & METRICS_KEYS:
+            self.start_metrics()
+        self.config_watcher.record_reload(mtime)
+        self.log_status(self.config_watcher.describe_reload(changes))
+
+    # ==============================================
+    # PROFILES
+    # ==============================================
+    def start_profiles(self):
+        """(Re)build the profile schedule from config.txt and apply the active profiles"""
+        try:
+            self.profiles = ProfileSchedule.from_config(self.config, self.log_status)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self.log_status(f"Invalid profiles ({e}), ignoring them")
+            self.profiles = ProfileSchedule([])
+        self.active_profiles = None
+        self.on_profile_boundary()
+
+    def on_profile_boundary(self):
+        """Apply the profiles active now and sleep until the next boundary"""
+        self.cancel(self.profile_timer)
+        self.profile_timer = None
+        names = [profile.name for profile in self.profiles.active()]
+        if names != self.active_profiles:
+            if self.profiles:
+                self.log_status(f"Profile active: {', '.join(names)}" if names else "No profile active")
+            self.active_profiles = names
+            self.apply_profile(self.profiles.overrides())
+        if self.profiles:
+            delay = max(0.0, self.profiles.next_transition() - time.time())
+            self.profile_timer = self.after(delay, self.on_profile_boundary, 'profiles', key='profiles')
+
+    def apply_profile(self, overrides):
+        """Apply profile values over config.txt to the detector and enforcers"""
+        self.profile_overrides = overrides
+        self.apply_idle_rules()
+        target = self.setting('saved_volume')
+        if self.volume_ducked_from is not None:
+            self.volume_ducked_from = target  # Restored once the user is back
+        elif self.volume_enforcer and self.settings.volume_control_enabled \
+                and target != self.volume_enforcer.target:
+            self.volume_enforcer.target = target
+            if target is not None:
+                self.set_volume(target)
+        if self.session_enforcer and self.session_enforcer.started:
+            self.session_enforcer.set_targets(self.setting('app_volumes'))
+
+    # ==============================================
+    # SHUTDOWN AND REPORTING
+    # ==============================================
+    def shutdown_hooks(self):
+        """Built-in pre-shutdown hooks as (name, fn) pairs"""
+        # export_metrics checks METRICS.enabled itself, which a reload may change
+        return [('log', self.status_log.flush), ('report', self.flush_report), ('metrics', self.export_metrics)]
+
+    def build_shutdown_executor(self):
+        """Shutdown action and pre-shutdown hooks from config.txt"""
+        return ShutdownExecutor(
+            open_shutdown_backend(self.config, self.log_status),
+            self.shutdown_hooks(),
+            self.settings.shutdown_hooks,
+            timeout=self.settings.shutdown_hook_timeout,
+            log=self.log_status
+        )
+
+    @property
+    def shutdown_backend(self):
+        return self.shutdown_executor.backend
+
+    def shutdown_computer(self):
+        """Run the pre-shutdown hooks and shut down (watchdog thread)"""
+        self.log_status("Shutting down computer...")
+        METRICS.inc('shutdowns')
+        if self.history:
+            self.history.record(HistoryStore.SHUTDOWN)
+        self.shutdown_executor.shutdown()
+
+    def start_metrics(self):
+        """(Re)start collecting and exporting metrics as set in config.txt"""
+        METRICS.stop()
+        METRICS.enabled = self.settings.metrics_enabled
+        if not METRICS.enabled:
+            return
+        self.instrument_metrics()
+        METRICS.add_collector(self.collect_metrics)
+        METRICS.start_lag_probe(self.scheduler, lambda fn: self.dispatch(fn, 'lag_probe'))
+        METRICS.start_export(
+            self.scheduler,
+            self.settings.metrics_interval,
+            self.settings.metrics_textfile,
+            self.settings.metrics_json
+        )
+
+    def instrument_metrics(self):
+        """Time the hot paths of the components that exist so far"""
+        if self.detector:
+            METRICS.instrument(self.detector.source, 'idle_seconds', 'idle_probe_seconds')
+        if self.volume_control:
+            METRICS.instrument(self.volume_control, 'get_level', 'volume_get_seconds')
+            METRICS.instrument(self.volume_control, 'set_level', 'volume_set_seconds')
+
+    def collect_metrics(self):
+        return runtime_gauges(self)
+
+    def export_metrics(self):
+        """Write a final metrics snapshot"""
+        if not METRICS.enabled:
+            return
+        try:
+            METRICS.export(self.settings.metrics_textfile, self.settings.metrics_json)
+        except Exception as e:
+            self.log_status(f"Failed to export metrics: {e}")
+
+    def start_reporting(self):
+        """(Re)start sending state reports to the collector set in config.txt, if any"""
+        self.stop_reporting()
+        if not self.settings.report_collector:
+            return
+        try:
+            self.report_agent = ReportAgent(self.settings.report_collector, self.settings.report_interval,
+                                            log=self.log_status)
+        except ValueError as e:
+            self.log_status(f"Invalid report_collector ({e}), not reporting")
+            return
+        self.report_agent.start(self.scheduler, lambda: {**idle_state(self), **volume_state(self)})
+
+    def stop_reporting(self):
+        if self.report_agent:
+            self.report_agent.stop()
+            self.log_status(self.report_agent.describe())
+            self.report_agent = None
+
+    def report(self, kind, state):
+        """Queue a snapshot for the collector, if reporting is on (any thread)"""
+        if self.report_agent:
+            self.report_agent.record(kind, state)
+
+    def flush_report(self):
+        """Tell the collector about the shutdown (pre-shutdown hook thread)"""
+        agent = self.report_agent
+        if agent:
+            agent.record('shutdown', {})
+            agent.flush(self.scheduler.loop)
+
+    # ==============================================
+    # IDLE DETECTION
+    # ==============================================
+    def build_detector(self, idle_source):
+        """Idle detector that reports to this object; it runs on the scheduler and never touches Tk"""
+        return IdleDetector(
+            idle_source,
+            MonotonicClock(),
+            self.current_rules(),
+            on_rule=self.on_detector_rule,
+            on_active=self.on_detector_active,
+            scheduler=self.scheduler,
+            on_idle=self.on_idle_start,
+            on_withdraw=self.on_detector_withdraw
+        )
+
+    def start_detection(self):
+        """Start the idle detection"""
+        if self.detector is None:
+            idle_source = Win32IdleSource()
+            METRICS.instrument(idle_source, 'idle_seconds', 'idle_probe_seconds')
+            self.detector = self.build_detector(idle_source)
+        if self.detector.running:
+            return
+        self.detector.set_rules(self.current_rules())
+        self.detector.start()
+        self.log_status(f"Idle detection running ({self.detector.rules.describe()})")
+
+    def stop_detection(self):
+        """Stop the idle detection"""
+        if self.detector and self.detector.running:
+            self.detector.stop()
+            # log_status buffers the line even before the Idle tab is built
+            self.log_status(f"Idle detection stopped ({self.detector.wakeups_per_hour():.1f} wakeups/hour)")
+        self.watchdog.cancel()
+        if self.warning_shown:
+            self.hide_warning()
+        self.restore_volume()
+
+    def pause_detection(self, seconds=None):
+        """Hold back idle actions, resuming automatically after `seconds` if given"""
+        if not self.detector:
+            raise RuntimeError("Idle detection is disabled")
+        self.cancel(self.pause_timer)
+        self.detector.pause()
+        self.pause_timer = self.after(seconds, self.resume_detection, 'control', key='resume') if seconds else None
+        self.log_status(f"Idle actions paused for {seconds}s" if seconds else "Idle actions paused")
+
+    def resume_detection(self):
+        """Undo pause_detection"""
+        self.cancel(self.pause_timer)
+        self.pause_timer = None
+        if self.detector:
+            self.detector.resume()
+            self.log_status("Idle actions resumed")
+
+    def on_detector_rule(self, phase, rule):
+        """Arm the watchdog for shutdowns, then hand the rule to the main thread (scheduler thread)"""
+        arm_shutdown_watchdog(self.watchdog, phase, rule, self.shutdown_computer)
+        METRICS.inc('idle_warnings' if phase == RuleTable.WARN else 'idle_actions')
+        self.report(phase, {'action': rule.action, 'after': rule.after, **idle_state(self)})
+        self.dispatch(functools.partial(self.on_idle_rule, phase, rule, time.perf_counter()))
+
+    def on_detector_active(self):
+        """Cancel a pending shutdown right away, even if the main thread is busy (scheduler thread)"""
+        self.watchdog.cancel()
+        self.report('active', idle_state(self))
+        self.dispatch(self.on_user_active, 'idle_active')
+
+    def on_detector_withdraw(self, rule):
+        """Disarm a shutdown whose rule was swapped out mid-warning (scheduler thread)"""
+        if rule.action == 'shutdown':
+            self.watchdog.cancel()
+        self.dispatch(self.on_warning_withdrawn, 'idle_withdrawn')
+
+    def on_warning_withdrawn(self):
+        """Hide the warning of a rule the new rules dropped, unless another rule is warning"""
+        if self.warning_shown and not self.detector.warned:
+            self.hide_warning(announce=False)
+            self.log_status("Warning withdrawn: idle rules changed")
+
+    def on_idle_start(self, idle_time):
+        """Record the start of an idle period (scheduler thread)"""
+        if self.history:
+            self.history.record(HistoryStore.IDLE, idle_time)
+
+    def on_idle_rule(self, phase, rule, requested=None):
+        """Show a rule's warning or carry out its action; requested is when the detector fired"""
+        if phase == RuleTable.WARN:
+            self.show_warning(rule, requested)
+        else:
+            self.run_idle_action(rule)
+
+    def on_user_active(self):
+        """Undo what lasts only while idle once the user is back"""
+        self.hide_warning()
+        self.restore_volume()
+        if self.history:
+            self.history.record(HistoryStore.ACTIVE)
+
+    def on_warning_visible(self, latency):
+        """Record how long the warning took to appear"""
+        self.log_status(f"Warning visible after {latency * 1000:.0f} ms")
+        if METRICS.enabled:
+            METRICS.histogram('warning_visible_seconds').observe(latency)
+
+    def on_warning_response(self):
+        """Handle user response to the warning"""
+        self.watchdog.cancel()
+        self.hide_warning()
+        if self.detector:
+            self.detector.reset()
+        self.log_status("User manually dismissed warning")
+        METRICS.inc('warnings_dismissed')
+        if self.history:
+            self.history.record(HistoryStore.DISMISSED)
+
+    def run_idle_action(self, rule):
+        """Carry out an idle rule's action"""
+        if rule.warning and not self.warning_shown:
+            return  # Warning was dismissed in the meantime
+        self.hide_warning(announce=False)
+        if rule.action == 'shutdown':
+            return  # The watchdog runs it on time even if this thread was held up
+        if self.history:
+            self.history.record(HistoryStore.ACTIONS[rule.action], rule.value or 0)
+        try:
+            if rule.action == 'volume':
+                self.duck_volume(rule.value)
+            elif rule.action == 'lock':
+                self.log_status("Locking the workstation...")
+                self.shutdown_backend.lock()
+            elif rule.action == 'sleep':
+                self.log_status("Putting the computer to sleep...")
+                self.shutdown_backend.sleep()
+        except Exception as e:
+            self.log_status(f"Idle action '{rule.action}' failed: {e}")
+
+    def duck_volume(self, percent):
+        """Lower the volume while idle; restore_volume brings it back"""
+        if not self.volume_enforcer or not self.settings.volume_control_enabled:
+            return
+        if self.volume_ducked_from is None:
+            saved = self.setting('saved_volume')
+            self.volume_ducked_from = saved if saved is not None else round(self.volume_control.get_level() * 100)
+        self.log_status(f"Idle: lowering volume to {percent}%")
+        self.volume_enforcer.target = percent
+        self.set_volume(percent)
+
+    def restore_volume(self):
+        """Undo duck_volume"""
+        if self.volume_ducked_from is None:
+            return
+        percent, self.volume_ducked_from = self.volume_ducked_from, None
+        if self.volume_enforcer:
+            self.volume_enforcer.target = self.setting('saved_volume')
+        self.log_status(f"Volume restored to {percent}%")
+        self.set_volume(percent)
+
+    # ==============================================
+    # VOLUME ENFORCEMENT
+    # ==============================================
+    def monitor_volume_changes(self):
+        """Safety-net check that reverts external volume changes"""
+        self.cancel(self.volume_monitor_timer)
+        self.volume_monitor_timer = None
+        if not self.volume_enforcer or not self.settings.volume_control_enabled:
+            return
+        try:
+            self.volume_enforcer.check()
+        except Exception:
+            pass
+        if self.session_enforcer and self.session_enforcer.started:
+            self.session_enforcer.check_all()
+        # Safety net only; notifications normally catch changes immediately
+        self.volume_monitor_timer = self.after(
+            self.volume_enforcer.poll_interval, self.monitor_volume_changes, 'volume', key='volume_monitor')
+
+    def on_volume_corrected(self, percent):
+        """Put the saved volume back after drift (enforcer callback on the main thread)"""
+        self.report('volume_corrected', volume_state(self))
+        # Drift was observed, so the write must not be skipped as a no-op
+        self.set_volume(percent, force=True)
+
+    def on_endpoint_recovered(self):
+        """Re-check the saved volume on a newly acquired endpoint"""
+        if self.volume_enforcer and self.settings.volume_control_enabled:
+            try:
+                self.volume_enforcer.check()
+            except Exception:
+                pass
+            self.restart_app_volumes()
+
+    def start_app_volumes(self):
+        """Enforce per-application volumes from app_volumes, if any are configured"""
+        targets = self.setting('app_volumes')
+        if self.session_enforcer is None:
+            if not targets:
+                return
+            try:
+                backend = open_session_backend()
+            except Exception as e:
+                self.log_status(f"Per-application volumes unavailable: {e}")
+                return
+            self.session_enforcer = SessionVolumeEnforcer(
+                backend, targets, dispatch=self.dispatch, log=self.log_status)
+        else:
+            self.session_enforcer.set_targets(targets)
+        if not self.session_enforcer.started:
+            try:
+                self.session_enforcer.start()
+            except Exception as e:
+                self.log_status(f"Per-application volumes unavailable: {e}")
+
+    def stop_app_volumes(self):
+        if self.session_enforcer and self.session_enforcer.started:
+            self.session_enforcer.stop()
+
+    def restart_app_volumes(self):
+        """Re-open the sessions of a new default device"""
+        if self.session_enforcer is not None:
+            self.stop_app_volumes()
+            self.session_enforcer = None
+            self.start_app_volumes()
+
+
+class SystemUtilitiesApp(IdleVolumeBase):
+    STATUS_FLUSH_MS = 250        # widget refresh interval for status messages
+    STATUS_VISIBLE_LINES = 200   # lines kept in the status widget
+    UI_EVENT_POLL_MS = 100       # only used when Tcl is built without threads
+
+    def __init__(self, root, control=None):
         self.root = root
+        self.ui_thread = threading_ident()
         self.root.title("System Utilities")
         self.root.geometry("450x500")
         self.root.resizable(False, False)
         
         # Configuration file
-        self.config_file = "config.txt"
+        self.config_file = CONFIG_FILE
         
         # Initialize states
-        self.is_running = False
         self.warning_shown = False
-        self.last_slider_update = None
-        self.ignore_volume_change = False
+        self.volume_monitor_timer = None
+        self.countdown_timer = None
+        self.volume_ducked_from = None
+        self.pause_timer = None
+        self.profiles = None
+        self.profile_overrides = {}
+        self.active_profiles = None
+        self.profile_timer = None
+        self.volume_control = None
+        self.volume_writer = None
+        self.volume_enforcer = None
+        self.session_enforcer = None
+        self.config_watcher = None
+        self.control = None
+        self.history = None
+        self.status_log = StatusLog(LOG_FILE)
+        self.status_flush_job = None
+        self.status_shown = 0
+        self.countdown_remaining = 0
+        self.warning_deadline = None
+        self.warning_window = None
+        
+        # Widgets other code updates; None until their tab is first viewed
+        self.status_text = None
+        self.volume_label = None
+        self.saved_volume_label = None
+        self.volume_slider = None
+        self.custom_entry = None
+        self.toggle_window_button = None
+        self.volume_tab = None
+        self.setting_vars = {}
+        self.report_agent = None
+        
+        # Worker threads never call Tk directly; they post into this queue
+        self.ui_events = UIEventQueue(notify=self.wake_ui)
+        self.root.bind('<<UIEvents>>', lambda event: self.ui_events.drain())
+        self.ui_threaded = self.root.tk.eval('set tcl_platform(threaded)') == '1'
+        if not self.ui_threaded:
+            self.poll_ui_events()
+        
+        # All periodic work (idle checks, countdown, volume safety net) runs on one scheduler
+        self.scheduler = Scheduler()
+        self.scheduler.start()
+        self.watchdog = ShutdownWatchdog()
+        self.watchdog.start()
         
         # Load or initialize configuration
-        self.config = self.load_config()
+        with STARTUP.phase('config'):
+            self.config_store = ConfigStore(
+                self.config_file,
+                on_error=lambda e: self.ui_events.post(lambda: self.show_config_error(e), key='config_error')
+            )
+            self.config = self.config_store.config
+            self.settings = next_settings(self.config, log=self.log_status)
+        METRICS.enabled = self.settings.metrics_enabled
+        self.shutdown_executor = self.build_shutdown_executor()
+        self.history = open_history(self.settings.history_file, self.log_status)
         
-        # Create notebook (tabbed interface)
-        self.notebook = ttk.Notebook(root)
-        self.notebook.pack(fill=tk.BOTH, expand=True)
+        # Idle detector runs on its own thread and never touches Tk variables
+        self.idle_source = Win32IdleSource()
+        self.detector = self.build_detector(self.idle_source)
+        self.publish_settings()
+        self.start_profiles()
         
-        # Create tabs
-        self.create_settings_tab()
-        self.create_idle_detector_tab()
-        self.create_volume_control_tab()
+        with STARTUP.phase('ui build'):
+            # Create notebook (tabbed interface); tab contents are built on first view
+            self.notebook = ttk.Notebook(root)
+            self.notebook.pack(fill=tk.BOTH, expand=True)
+            self.create_tabs()
         
-        # Initialize volume control
-        self.volume_control = self.init_volume_control()
+        # Audio stack is only imported and activated once volume control is enabled
+        if self.settings.volume_control_enabled:
+            with STARTUP.phase('audio init'):
+                self.ensure_volume_control()
         
         # Set initial states based on config
-        if self.config.get('volume_control_enabled', True) and self.volume_control:
-            if self.config.get('saved_volume') is not None:
-                self.set_volume(self.config['saved_volume'])
-            self.monitor_volume_changes()
+        if self.settings.volume_control_enabled and self.volume_control:
+            if self.setting('saved_volume') is not None:
+                self.set_volume(self.setting('saved_volume'))
+            self.start_volume_enforcement()
         
-        if self.config.get('idle_detector_enabled', True):
+        if self.settings.idle_detector_enabled:
             self.start_detection()
         
         # Hide window if configured to do so
-        if self.config.get('hide_on_startup', False):
+        if self.settings.hide_on_startup:
             self.root.withdraw()
         
+        # Build the warning window once the first frame is up, so showing it is only a map
+        if self.settings.idle_detector_enabled:
+            self.root.after_idle(self.ensure_warning_window)
+        
+        # Pick up config.txt changes pushed to the machine while running
+        self.config_watcher = ConfigWatcher(
+            self.config_file,
+            lambda: self.settings,
+            # Diffs are taken against the published snapshot, so the latest
+            # pending reload always contains every earlier one
+            lambda changes, mtime: self.ui_events.post(
+                lambda: self.apply_config_changes(changes, mtime), key='config_reload'),
+            ignore=lambda text: text == self.config_store.written
+        )
+        self.config_watcher.start()
+        
+        # Scripts and later launches talk to this instance over the control port
+        self.control = control
+        if self.control:
+            self.control.start(self.scheduler.loop, control_commands(self), self.ui_events.post)
+        
+        self.start_metrics()
+        self.start_reporting()
+        self.log_status(startup_report())
+        
         # Handle window close
         self.root.protocol("WM_DELETE_WINDOW", self.on_close)
 
     def load_config(self):
         """Load configuration from file or create default"""
-        default_config = {
-            'idle_threshold': 30,
-            'shutdown_delay': 30,
-            'saved_volume': 50,
-            'hide_on_startup': False,
-            'idle_detector_enabled': True,
-            'volume_control_enabled': True
-        }
-        
-        try:
-            if os.path.exists(self.config_file):
-                with open(self.config_file, 'r') as f:
-                    loaded_config = json.load(f)
-                    # Merge with defaults to ensure all keys exist
-                    return {**default_config, **loaded_config}
-            return default_config
-        except Exception as e:
-            print(f"Error loading config: {e}")
-            return default_config
+        return load_config(self.config_file)
 
     def save_config(self):
-        """Save current configuration to file"""
+        """Queue a save of the current configuration (debounced, written in the background)"""
+        self.publish_settings()
+        self.config_store.mark_dirty()
+
+    def publish_settings(self):
+        """Publish a new settings snapshot and bring the Tk views and idle rules in line with it"""
+        super().publish_settings()
+        self.sync_setting_vars()
+
+    def setting_var(self, var_class, key):
+        """Tk variable showing a setting; publish_settings keeps it in step with the snapshot"""
+        var = var_class(value=getattr(self.settings, key))
+        self.setting_vars[key] = var
+        return var
+
+    def sync_setting_vars(self):
+        for key, var in self.setting_vars.items():
+            value = getattr(self.settings, key)
+            try:
+                current = var.get()
+            except (tk.TclError, ValueError):
+                current = None  # A spinbox holding text that is not a number
+            if current != value:
+                var.set(value)
+
+    def commit_setting_var(self, key):
+        """Save a value typed into a spinbox, or put back the saved one if it is invalid"""
         try:
-            with open(self.config_file, 'w') as f:
-                json.dump(self.config, f, indent=4)
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to save config:\n{str(e)}")
+            value = Settings.validate(key, self.setting_vars[key].get())
+        except (tk.TclError, TypeError, ValueError):
+            self.setting_vars[key].set(getattr(self.settings, key))
+            return
+        if value != getattr(self.settings, key):
+            self.update_config(key, value)
+
+    def wake_ui(self):
+        """Ask the Tk thread to drain the UI event queue (called from workers)"""
+        # Threaded Tcl marshals this call to the Tk thread; it is the only
+        # Tk call workers make, and only once per batch
+        if self.ui_threaded:
+            self.root.event_generate('<<UIEvents>>', when='tail')
+
+    def dispatch(self, fn, key=None):
+        """Run fn on the Tk thread; safe to call from any thread"""
+        self.ui_events.post(fn, key)
+
+    def after(self, delay, fn, feature, key=None):
+        """Run fn on the Tk thread after delay seconds via the shared scheduler"""
+        return self.scheduler.call_later(delay, lambda: self.dispatch(fn, key), feature)
+
+    def poll_ui_events(self):
+        """Fallback drain loop for Tcl builds without thread support"""
+        self.ui_events.drain()
+        self.ui_events_job = self.root.after(self.UI_EVENT_POLL_MS, self.poll_ui_events)
+
+    def apply_setting_changes(self, changes):
+        """Bring the window and the toggled features in line with reloaded settings"""
+        if 'hide_on_startup' in changes and self.toggle_window_button is not None:
+            self.toggle_window_button.config(text="Show Window" if self.settings.hide_on_startup else "Hide Window")
+        if 'saved_volume' in changes:
+            if self.saved_volume_label is not None:
+                self.saved_volume_label.config(text=f"Saved Volume: {self.settings.saved_volume}%")
+            if self.volume_enforcer:
+                self.volume_enforcer.target = self.setting('saved_volume')
+        
+        # Reloaded values are already in config.txt, so they are not written back
+        if 'idle_detector_enabled' in changes:
+            self.toggle_idle_detector(persist=False)
+        if 'volume_control_enabled' in changes:
+            self.toggle_volume_control(persist=False)
+        elif 'saved_volume' in changes and self.settings.volume_control_enabled:
+            self.set_volume(self.setting('saved_volume'))
+
+    def shutdown_hooks(self):
+        """Built-in pre-shutdown hooks; unsaved settings are written first"""
+        return [('config', self.config_store.flush)] + super().shutdown_hooks()
+
+    def instrument_metrics(self):
+        """Time the hot paths, including the background config writes"""
+        super().instrument_metrics()
+        METRICS.instrument(self.config_store, '_write', 'config_write_seconds')
+
+    def show_config_error(self, error):
+        """Report a failed background config write"""
+        messagebox.showerror("Error", f"Failed to save config:\n{str(error)}")
+
+    # ==============================================
+    # TABS
+    # ==============================================
+    def create_tabs(self):
+        """Add empty tabs and the variables config reloads update; contents are built on first view"""
+        self.idle_detector_enabled = self.setting_var(tk.BooleanVar, 'idle_detector_enabled')
+        self.volume_control_enabled = self.setting_var(tk.BooleanVar, 'volume_control_enabled')
+        self.idle_threshold = self.setting_var(tk.IntVar, 'idle_threshold')
+        self.shutdown_delay = self.setting_var(tk.IntVar, 'shutdown_delay')
+        self.hide_var = self.setting_var(tk.BooleanVar, 'hide_on_startup')
+        
+        self.tab_builders = {}
+        self.settings_tab = self.add_tab("Settings", self.create_settings_tab)
+        self.idle_tab = self.add_tab("Idle Detector", self.create_idle_detector_tab)
+        self.volume_tab = self.add_tab("Volume Control", self.create_volume_control_tab)
+        
+        # Set initial tab states based on config
+        self.notebook.tab(1, state=tk.NORMAL if self.settings.idle_detector_enabled else tk.DISABLED)
+        self.notebook.tab(2, state=tk.NORMAL if self.settings.volume_control_enabled else tk.DISABLED)
+        
+        # A window hidden on startup builds nothing until it is first shown
+        self.notebook.bind('<<NotebookTabChanged>>', self.build_current_tab)
+        self.notebook.bind('<Map>', self.build_current_tab)
+
+    def add_tab(self, text, builder):
+        """Add an empty tab whose contents builder() fills in when it is first viewed"""
+        frame = ttk.Frame(self.notebook)
+        self.notebook.add(frame, text=text)
+        self.tab_builders[str(frame)] = builder
+        return frame
+
+    def build_current_tab(self, event=None):
+        """Build the selected tab's contents if this is its first view"""
+        builder = self.tab_builders.pop(self.notebook.select(), None)
+        if builder:
+            builder()
 
     # ==============================================
     # SETTINGS TAB
     # ==============================================
     def create_settings_tab(self):
         """Create the settings tab for enabling/disabling features"""
-        self.settings_tab = ttk.Frame(self.notebook)
-        self.notebook.add(self.settings_tab, text="Settings")
-        
         # Main frame
         main_frame = ttk.Frame(self.settings_tab, padding="20")
         main_frame.pack(fill=tk.BOTH, expand=True)
@@ -104,7 +4426,6 @@ class SystemUtilitiesApp:
         toggles_frame.pack(fill=tk.X, pady=(0, 10))
         
         # Idle detector toggle
-        self.idle_detector_enabled = tk.BooleanVar(value=self.config.get('idle_detector_enabled', True))
         idle_toggle = ttk.Checkbutton(
             toggles_frame,
             text="Enable Idle Detector",
@@ -114,7 +4435,6 @@ class SystemUtilitiesApp:
         idle_toggle.pack(anchor=tk.W, pady=5)
         
         # Volume control toggle
-        self.volume_control_enabled = tk.BooleanVar(value=self.config.get('volume_control_enabled', True))
         volume_toggle = ttk.Checkbutton(
             toggles_frame,
             text="Enable Volume Control",
@@ -130,11 +4450,12 @@ class SystemUtilitiesApp:
             font=('Segoe UI', 9)
         ).pack(pady=10)
 
-    def toggle_idle_detector(self):
-        """Toggle idle detector on/off"""
+    def toggle_idle_detector(self, persist=True):
+        """Toggle idle detector on/off; persist=False applies a value config.txt already holds"""
         enabled = self.idle_detector_enabled.get()
-        self.config['idle_detector_enabled'] = enabled
-        self.save_config()
+        if persist:
+            self.config['idle_detector_enabled'] = enabled
+            self.save_config()
         
         if enabled:
             self.start_detection()
@@ -144,19 +4465,21 @@ class SystemUtilitiesApp:
         # Update tab state
         self.notebook.tab(1, state=tk.NORMAL if enabled else tk.DISABLED)
 
-    def toggle_volume_control(self):
-        """Toggle volume control on/off"""
+    def toggle_volume_control(self, persist=True):
+        """Toggle volume control on/off; persist=False applies a value config.txt already holds"""
         enabled = self.volume_control_enabled.get()
-        self.config['volume_control_enabled'] = enabled
-        self.save_config()
+        if persist:
+            self.config['volume_control_enabled'] = enabled
+            self.save_config()
         
-        if enabled and self.volume_control:
-            self.monitor_volume_changes()
-            if self.config.get('saved_volume') is not None:
-                self.set_volume(self.config['saved_volume'])
+        if enabled and self.ensure_volume_control():
+            if self.setting('saved_volume') is not None:
+                self.set_volume(self.setting('saved_volume'))
+            self.start_volume_enforcement()
         else:
-            if hasattr(self, 'last_slider_update') and self.last_slider_update:
-                self.root.after_cancel(self.last_slider_update)
+            if self.volume_writer:
+                self.volume_writer.cancel()
+            self.stop_volume_enforcement()
         
         # Update tab state and controls
         self.notebook.tab(2, state=tk.NORMAL if enabled else tk.DISABLED)
@@ -164,13 +4487,10 @@ class SystemUtilitiesApp:
 
     def update_volume_controls_state(self, enabled):
         """Enable/disable all volume controls"""
-        if not hasattr(self, 'volume_tab'):
-            return
-            
         state = tk.NORMAL if enabled else tk.DISABLED
-        if hasattr(self, 'volume_slider'):
+        if self.volume_slider is not None:
             self.volume_slider.config(state=state)
-        if hasattr(self, 'custom_entry'):
+        if self.custom_entry is not None:
             self.custom_entry.config(state=state)
         
         # Update button states in volume tab
@@ -180,7 +4500,7 @@ class SystemUtilitiesApp:
                     widget.config(state=state)
         
         # Update label
-        if hasattr(self, 'volume_label'):
+        if self.volume_label is not None:
             self.volume_label.config(
                 text="Current Volume: Checking..." if enabled else "Volume Control Disabled"
             )
@@ -190,16 +4510,6 @@ class SystemUtilitiesApp:
     # ==============================================
     def create_idle_detector_tab(self):
         """Create the idle detector tab"""
-        self.idle_tab = ttk.Frame(self.notebook)
-        self.notebook.add(self.idle_tab, text="Idle Detector")
-        
-        # Variables for idle detector
-        self.idle_threshold = tk.IntVar(value=self.config.get('idle_threshold', 30))
-        self.shutdown_delay = tk.IntVar(value=self.config.get('shutdown_delay', 30))
-        self.last_active_time = time.time()
-        self.countdown_remaining = 0
-        self.warning_window = None
-        
         # Main frame
         main_frame = ttk.Frame(self.idle_tab, padding="20")
         main_frame.pack(fill=tk.BOTH, expand=True)
@@ -208,13 +4518,15 @@ class SystemUtilitiesApp:
         settings_frame = ttk.LabelFrame(main_frame, text="Settings", padding="10")
         settings_frame.pack(fill=tk.X, pady=(0, 10))
         
-        ttk.Label(settings_frame, text="Idle Threshold (seconds):").grid(row=0, column=0, sticky=tk.W)
-        ttk.Spinbox(settings_frame, from_=5, to=300, textvariable=self.idle_threshold, width=5,
-                   command=lambda: self.update_config('idle_threshold', self.idle_threshold.get())).grid(row=0, column=1, sticky=tk.W)
-        
-        ttk.Label(settings_frame, text="Shutdown Delay (seconds):").grid(row=1, column=0, sticky=tk.W)
-        ttk.Spinbox(settings_frame, from_=5, to=300, textvariable=self.shutdown_delay, width=5,
-                   command=lambda: self.update_config('shutdown_delay', self.shutdown_delay.get())).grid(row=1, column=1, sticky=tk.W)
+        for row, (text, key) in enumerate([("Idle Threshold (seconds):", 'idle_threshold'),
+                                           ("Shutdown Delay (seconds):", 'shutdown_delay')]):
+            ttk.Label(settings_frame, text=text).grid(row=row, column=0, sticky=tk.W)
+            spinbox = ttk.Spinbox(settings_frame, from_=5, to=300, textvariable=self.setting_vars[key], width=5,
+                                  command=lambda key=key: self.commit_setting_var(key))
+            spinbox.grid(row=row, column=1, sticky=tk.W)
+            # Typed values are saved once editing is done
+            spinbox.bind('<Return>', lambda event, key=key: self.commit_setting_var(key))
+            spinbox.bind('<FocusOut>', lambda event, key=key: self.commit_setting_var(key))
         
         # Status frame
         status_frame = ttk.LabelFrame(main_frame, text="Status", padding="10")
@@ -230,8 +4542,8 @@ class SystemUtilitiesApp:
         self.stop_button = ttk.Button(button_frame, text="Stop", command=self.stop_detection)
         self.stop_button.pack(side=tk.LEFT, padx=5)
         
-        # Set initial tab state based on config
-        self.notebook.tab(1, state=tk.NORMAL if self.config.get('idle_detector_enabled', True) else tk.DISABLED)
+        # Show what was logged before the tab existed
+        self.flush_status()
 
     def update_config(self, key, value):
         """Update a config value and save to file"""
@@ -239,137 +4551,104 @@ class SystemUtilitiesApp:
         self.save_config()
 
     def log_status(self, message):
-        """Log messages to the status text box"""
-        if hasattr(self, 'status_text'):
-            self.status_text.config(state=tk.NORMAL)
-            self.status_text.insert(tk.END, f"{time.strftime('%H:%M:%S')} - {message}\n")
-            self.status_text.see(tk.END)
-            self.status_text.config(state=tk.DISABLED)
+        """Log messages to the status log; the text box is refreshed in batches (any thread)"""
+        self.status_log.append(message)
+        if threading_ident() != self.ui_thread:
+            # Tk is only called from its own thread
+            self.ui_events.post(self.schedule_status_flush, key='status_flush')
+        else:
+            self.schedule_status_flush()
+
+    def schedule_status_flush(self):
+        if self.status_flush_job is None and self.status_text is not None:
+            self.status_flush_job = self.root.after(self.STATUS_FLUSH_MS, self.flush_status)
+
+    def flush_status(self):
+        """Append new status lines to the text box, keeping only the visible tail"""
+        self.status_flush_job = None
+        lines = self.status_log.since(self.status_shown, self.STATUS_VISIBLE_LINES)
+        self.status_shown = self.status_log.total
+        if not lines:
+            return
+        
+        self.status_text.config(state=tk.NORMAL)
+        self.status_text.insert(tk.END, "\n".join(lines) + "\n")
+        line_count = int(self.status_text.index('end-1c').split('.')[0]) - 1
+        if line_count > self.STATUS_VISIBLE_LINES:
+            self.status_text.delete('1.0', f'{line_count - self.STATUS_VISIBLE_LINES + 1}.0')
+        self.status_text.see(tk.END)
+        self.status_text.config(state=tk.DISABLED)
         
     def get_idle_time(self):
         """Get the system idle time in seconds"""
-        class LASTINPUTINFO(ctypes.Structure):
-            _fields_ = [
-                ('cbSize', ctypes.c_uint),
-                ('dwTime', ctypes.c_uint),
-            ]
-        
-        lastInputInfo = LASTINPUTINFO()
-        lastInputInfo.cbSize = ctypes.sizeof(lastInputInfo)
-        ctypes.windll.user32.GetLastInputInfo(ctypes.byref(lastInputInfo))
-        
-        millis = ctypes.windll.kernel32.GetTickCount() - lastInputInfo.dwTime
-        return millis / 1000.0
+        return self.idle_source.sample()
     
-    def update_countdown(self, window, countdown_label):
-        """Update the countdown display every second"""
-        if hasattr(self, 'countdown_remaining') and hasattr(self, 'warning_shown'):
-            if self.countdown_remaining > 0 and self.warning_shown:
-                countdown_label.config(text=f"Time remaining: {self.countdown_remaining} seconds")
-                self.countdown_remaining -= 1
-                window.after(1000, self.update_countdown, window, countdown_label)
+    def update_countdown(self):
+        """Show the seconds left before the warned action; only the display runs here"""
+        if not self.warning_shown:
+            return
+        remaining = max(0.0, self.warning_deadline - time.monotonic())
+        self.countdown_remaining = math.ceil(remaining)
+        self.warning_window.set_remaining(self.countdown_remaining)
+        if self.countdown_remaining > 0:
+            # Wake when the shown second changes, so late wakeups never add up
+            self.countdown_timer = self.after(
+                remaining - (self.countdown_remaining - 1), self.update_countdown, 'countdown', key='countdown')
     
-    def hide_warning(self):
-        """Hide the warning window if it exists"""
-        if hasattr(self, 'warning_window') and self.warning_window:
+    def ensure_warning_window(self):
+        """Build the (hidden) warning window the first time it is needed"""
+        if self.warning_window is None:
+            self.warning_window = WarningWindow(
+                self.root,
+                self.on_warning_response,
+                on_visible=self.on_warning_visible
+            )
+        return self.warning_window
+
+    def hide_warning(self, announce=True):
+        """Hide the warning window if it is shown; it is kept for the next warning"""
+        if self.countdown_timer:
+            self.countdown_timer.cancel()
+        self.countdown_timer = None
+        if self.warning_window and self.warning_window.shown:
             try:
-                self.warning_window.destroy()
-                self.log_status("Warning dismissed due to user activity")
-            except:
+                self.warning_window.hide()
+                if announce:
+                    self.log_status("Warning dismissed due to user activity")
+            except Exception:
                 pass
-            finally:
-                self.warning_window = None
-                self.warning_shown = False
+        self.warning_shown = False
     
-    def show_warning(self):
-        """Show a warning popup with an OK button and countdown"""
+    def show_warning(self, rule, requested=None):
+        """Show the warning popup with a countdown to the rule's action"""
+        self.hide_warning(announce=False)
         self.warning_shown = True
-        self.countdown_remaining = self.shutdown_delay.get()
+        self.countdown_remaining = rule.warning
         self.log_status("Idle detected! Showing warning...")
+        if self.history:
+            self.history.record(HistoryStore.WARNING, rule.warning)
         
-        # Create a top-level window for the warning
-        self.warning_window = tk.Toplevel(self.root)
-        self.warning_window.title("Idle Warning")
-        self.warning_window.geometry("400x220")
-        self.warning_window.resizable(False, False)
-        
-        # Make sure the warning window stays on top
-        self.warning_window.attributes('-topmost', True)
-        
-        # Main message
-        message = "Idle detected! This computer will shutdown soon if you don't interact."
-        ttk.Label(self.warning_window, text=message, wraplength=380, padding=10).pack(pady=(10, 0))
-        
-        # Countdown display
-        self.countdown_label = ttk.Label(self.warning_window, 
-                                       text=f"Time remaining: {self.countdown_remaining} seconds", 
-                                       font=('Arial', 10, 'bold'))
-        self.countdown_label.pack(pady=5)
-        
-        # OK button
-        ttk.Button(self.warning_window, text="OK", 
-                  command=lambda: self.on_warning_response(self.warning_window)).pack(pady=10)
+        self.warning_deadline = warning_deadline(self.watchdog, rule, requested)
+        self.ensure_warning_window().show(self.countdown_remaining, rule.action, requested)
         
-        # Start the countdown updates
-        self.update_countdown(self.warning_window, self.countdown_label)
-        
-        # Schedule shutdown if no response
-        self.warning_window.after(self.shutdown_delay.get() * 1000, self.shutdown_computer)
-        
-    def on_warning_response(self, window):
-        """Handle user response to the warning"""
-        self.hide_warning()
-        self.last_active_time = time.time()
-        self.log_status("User manually dismissed warning")
-        
-    def shutdown_computer(self):
-        """Shutdown the computer"""
-        if hasattr(self, 'warning_shown') and self.warning_shown:  # Only shutdown if warning is still active
-            self.log_status("Shutting down computer...")
-            os.system("shutdown /s /t 1")
-        
-    def detection_loop(self):
-        """Main detection loop"""
-        while hasattr(self, 'is_running') and self.is_running:
-            idle_time = self.get_idle_time()
-            
-            if idle_time >= self.idle_threshold.get() and not self.warning_shown:
-                self.root.after(0, self.show_warning)
-            elif idle_time < 1:  # User was active
-                if hasattr(self, 'warning_shown') and self.warning_shown:
-                    self.root.after(0, self.hide_warning)
-                self.last_active_time = time.time()
-            
-            time.sleep(1)
-        
-    def start_detection(self):
-        """Start the idle detection"""
-        if hasattr(self, 'is_running') and self.is_running:
-            return
-            
-        self.is_running = True
-        self.log_status(f"Idle detection running (Threshold: {self.idle_threshold.get()}s)")
-        
-        # Start detection in a separate thread
-        self.detection_thread = Thread(target=self.detection_loop, daemon=True)
-        self.detection_thread.start()
-        
-    def stop_detection(self):
-        """Stop the idle detection"""
-        if hasattr(self, 'is_running'):
-            self.is_running = False
-        if hasattr(self, 'warning_shown') and self.warning_shown:
-            self.hide_warning()
-        if hasattr(self, 'status_text'):
-            self.log_status("Idle detection stopped")
+        # Start the countdown updates; the watchdog or detector fires the action itself
+        self.update_countdown()
+
+    def handle_launch(self, argv):
+        """Another launch handed over to this instance: bring the window up"""
+        self.log_status(f"Second launch handed over ({' '.join(argv) or 'no arguments'})")
+        self.root.deiconify()
+        self.root.lift()
+        if self.toggle_window_button is not None:
+            self.toggle_window_button.config(text="Hide Window")
 
     # ==============================================
     # VOLUME CONTROL TAB
     # ==============================================
     def create_volume_control_tab(self):
         """Create the volume control tab"""
-        self.volume_tab = ttk.Frame(self.notebook)
-        self.notebook.add(self.volume_tab, text="Volume Control")
+        enabled = self.settings.volume_control_enabled
+        applied = self.volume_writer.applied if self.volume_writer else None
         
         # Main frame
         main_frame = ttk.Frame(self.volume_tab, padding="20")
@@ -385,7 +4664,8 @@ class SystemUtilitiesApp:
         # Current volume display
         self.volume_label = ttk.Label(
             main_frame,
-            text="Current Volume: Checking..." if self.config.get('volume_control_enabled', True) else "Volume Control Disabled",
+            text=("Current Volume: Checking..." if applied is None else f"Current Volume: {applied}%")
+            if enabled else "Volume Control Disabled",
             font=('Segoe UI', 10)
         )
         self.volume_label.pack(pady=5)
@@ -393,7 +4673,7 @@ class SystemUtilitiesApp:
         # Saved volume display
         self.saved_volume_label = ttk.Label(
             main_frame,
-            text=f"Saved Volume: {self.config.get('saved_volume', 50)}%",
+            text=f"Saved Volume: {self.settings.saved_volume}%",
             font=('Segoe UI', 10)
         )
         self.saved_volume_label.pack(pady=5)
@@ -403,8 +4683,9 @@ class SystemUtilitiesApp:
             main_frame,
             from_=0,
             to=100,
+            value=applied or 0,
             command=self.on_slider_move,
-            state=tk.NORMAL if self.config.get('volume_control_enabled', True) else tk.DISABLED
+            state=tk.NORMAL if enabled else tk.DISABLED
         )
         self.volume_slider.pack(fill=tk.X, pady=10)
         
@@ -418,7 +4699,7 @@ class SystemUtilitiesApp:
                 text=f"{percent}%",
                 command=lambda p=percent: self.set_volume(p),
                 width=5,
-                state=tk.NORMAL if self.config.get('volume_control_enabled', True) else tk.DISABLED
+                state=tk.NORMAL if enabled else tk.DISABLED
             )
             btn.pack(side=tk.LEFT, padx=5)
         
@@ -433,7 +4714,7 @@ class SystemUtilitiesApp:
             width=5,
             validate='key',
             validatecommand=(self.root.register(self.validate_percent), '%P'),
-            state=tk.NORMAL if self.config.get('volume_control_enabled', True) else tk.DISABLED
+            state=tk.NORMAL if enabled else tk.DISABLED
         )
         self.custom_entry.pack(side=tk.LEFT, padx=5)
         
@@ -442,11 +4723,10 @@ class SystemUtilitiesApp:
             text="Set",
             command=self.set_custom_volume,
             width=5,
-            state=tk.NORMAL if self.config.get('volume_control_enabled', True) else tk.DISABLED
+            state=tk.NORMAL if enabled else tk.DISABLED
         ).pack(side=tk.LEFT)
         
         # Hide on startup checkbox
-        self.hide_var = tk.BooleanVar(value=self.config.get('hide_on_startup', False))
         hide_checkbox = ttk.Checkbutton(
             main_frame,
             text="Hide program when run",
@@ -461,49 +4741,69 @@ class SystemUtilitiesApp:
             text="Save Current Volume",
             command=self.save_current_volume,
             width=20,
-            state=tk.NORMAL if self.config.get('volume_control_enabled', True) else tk.DISABLED
+            state=tk.NORMAL if enabled else tk.DISABLED
         ).pack(pady=5)
         
         # Show/Hide window button
         self.toggle_window_button = ttk.Button(
             main_frame,
-            text="Show Window" if self.config.get('hide_on_startup', False) else "Hide Window",
+            text="Show Window" if self.settings.hide_on_startup else "Hide Window",
             command=self.toggle_window_visibility,
             width=20
         )
         self.toggle_window_button.pack(pady=5)
-        
-        # Set initial tab state based on config
-        self.notebook.tab(2, state=tk.NORMAL if self.config.get('volume_control_enabled', True) else tk.DISABLED)
+
+    def ensure_volume_control(self):
+        """Activate the audio endpoint the first time volume control is needed"""
+        if self.volume_control is None:
+            self.volume_control = self.init_volume_control()
+            self.volume_writer = VolumeWriter(
+                self.volume_control,
+                schedule=lambda delay, fn: TkTimer(self.root, delay, fn),
+                max_rate=self.settings.volume_write_rate,
+                on_applied=self.on_volume_applied,
+                on_error=lambda e: self.log_status(f"Volume control failed: {e}")
+            )
+            self.volume_enforcer = VolumeEnforcer(
+                self.volume_control,
+                target=self.setting('saved_volume'),
+                dispatch=lambda fn: self.ui_events.post(fn, key='volume'),
+                on_correct=self.on_volume_corrected
+            )
+            METRICS.instrument(self.volume_control, 'get_level', 'volume_get_seconds')
+            METRICS.instrument(self.volume_control, 'set_level', 'volume_set_seconds')
+        return self.volume_control
 
     def init_volume_control(self):
         """Initialize the volume control interface"""
-        try:
-            devices = AudioUtilities.GetSpeakers()
-            interface = devices.Activate(
-                IAudioEndpointVolume._iid_, CLSCTX_ALL, None)
-            return cast(interface, POINTER(IAudioEndpointVolume))
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to initialize audio control:\n{str(e)}")
-            return None
+        manager = EndpointManager(
+            open_volume_backend,
+            schedule=lambda delay, fn: self.after(delay, fn, 'audio', key='endpoint'),
+            watch_default_device=watch_default_device,
+            log=self.log_status,
+            on_recovered=self.on_endpoint_recovered
+        )
+        if not manager.start():
+            self.log_status("Audio endpoint unavailable, retrying in the background")
+        return manager
 
     def toggle_hide_setting(self):
         """Toggle the hide on startup setting"""
         self.config['hide_on_startup'] = self.hide_var.get()
         self.save_config()
         # Update the toggle button text
-        if hasattr(self, 'toggle_window_button'):
+        if self.toggle_window_button is not None:
             self.toggle_window_button.config(text="Show Window" if self.config['hide_on_startup'] else "Hide Window")
 
     def toggle_window_visibility(self):
         """Toggle window visibility"""
         if self.root.state() == 'withdrawn':
             self.root.deiconify()
-            if hasattr(self, 'toggle_window_button'):
+            if self.toggle_window_button is not None:
                 self.toggle_window_button.config(text="Hide Window")
         else:
             self.root.withdraw()
-            if hasattr(self, 'toggle_window_button'):
+            if self.toggle_window_button is not None:
                 self.toggle_window_button.config(text="Show Window")
 
     def validate_percent(self, text):
@@ -529,103 +4829,561 @@ class SystemUtilitiesApp:
             return
             
         try:
-            current_vol = self.volume_control.GetMasterVolumeLevelScalar()
-            percent = int(current_vol * 100)
+            current_vol = self.volume_control.get_level()
+            percent = round(current_vol * 100)
             self.config['saved_volume'] = percent
             self.save_config()
-            if hasattr(self, 'saved_volume_label'):
+            if self.volume_enforcer:
+                self.volume_enforcer.target = percent
+            if self.saved_volume_label is not None:
                 self.saved_volume_label.config(text=f"Saved Volume: {percent}%")
             messagebox.showinfo("Saved", f"Volume setting {percent}% has been saved.")
         except Exception as e:
             messagebox.showerror("Error", f"Failed to save volume:\n{str(e)}")
 
+    def set_saved_volume(self, percent):
+        """Apply and save a volume level without the confirmation dialog"""
+        self.config['saved_volume'] = percent
+        self.save_config()
+        if self.volume_enforcer:
+            self.volume_enforcer.target = percent
+        if self.saved_volume_label is not None:
+            self.saved_volume_label.config(text=f"Saved Volume: {percent}%")
+        self.set_volume(percent)
+
     def on_slider_move(self, value):
-        """Handle slider movement with debounce"""
-        if not self.config.get('volume_control_enabled', True):
+        """Handle slider movement; the volume writer rate-limits the writes"""
+        if not self.settings.volume_control_enabled:
+            return
+        self.set_volume(float(value), update_slider=False)
+
+    def set_volume(self, percent, update_slider=True, force=False):
+        """Set system volume through the rate-limited writer"""
+        if not self.volume_control or not self.settings.volume_control_enabled:
             return
             
-        if hasattr(self, 'last_slider_update') and self.last_slider_update:
-            self.root.after_cancel(self.last_slider_update)
+        percent = max(0, min(100, float(percent)))
+        if update_slider and self.volume_slider is not None:
+            self.volume_slider.set(percent)
+        self.volume_writer.write(percent, force=force)
+
+    def on_volume_applied(self, percent):
+        """Update displayed volume from the level that was just written"""
+        if self.volume_label is not None:
+            self.volume_label.config(text=f"Current Volume: {percent}%")
+
+    def start_volume_enforcement(self):
+        """Enforce the saved volume via change notifications plus a safety-net poll"""
+        if not self.volume_enforcer:
+            return
+        self.volume_enforcer.target = self.setting('saved_volume')
+        if not self.volume_enforcer.event_driven and not self.volume_enforcer.start():
+            self.log_status("Volume change notifications unavailable, polling every second")
+        self.start_app_volumes()
+        self.monitor_volume_changes()
+
+    def stop_volume_enforcement(self):
+        """Stop enforcing the saved volume"""
+        self.cancel(self.volume_monitor_timer)
+        self.volume_monitor_timer = None
+        if self.volume_enforcer:
+            self.volume_enforcer.stop()
+        self.stop_app_volumes()
+
+    def on_close(self):
+        """Clean up on window close"""
+        self.restore_volume()
+        self.cancel(self.profile_timer)
+        if self.volume_writer:
+            self.volume_writer.cancel()
+        if self.config_watcher:
+            self.config_watcher.stop()
+        if self.control:
+            self.control.close()
+        self.config_store.flush()
+        if self.session_enforcer:
+            self.log_status(self.session_enforcer.describe())
+        self.stop_volume_enforcement()
+        self.detector.stop()
+        self.watchdog.stop()
+        self.log_status(self.watchdog.describe())
+        if self.warning_shown:
+            self.hide_warning()
+        if self.volume_control:
+            self.log_status(self.volume_control.describe())
+            self.volume_control.close()
+        if METRICS.enabled:
+            METRICS.stop()
+            self.export_metrics()
+        self.stop_reporting()
+        self.log_status(self.scheduler.describe())
+        self.scheduler.stop()
+        if self.history:
+            self.history.close()
+        self.status_log.close()
+        self.root.destroy()
+
+# ==============================================
+# HEADLESS DAEMON
+# ==============================================
+class IdleDaemon(IdleVolumeBase):
+    """Idle detection and volume enforcement without the main window
+
+    Tk is only imported, and the warning window only built, on the first
+    idle warning; the window is then kept withdrawn for later warnings and
+    Tk is only pumped while it is on screen. Timers run on the shared
+    Scheduler and hand their work to the main thread through the event queue.
+    """
+    MAX_WAIT = 5.0      # keeps Ctrl+C responsive while nothing is pending
+    TK_PUMP = 0.05      # event-processing interval while the warning is shown
+
+    def __init__(self, config_file=CONFIG_FILE, control=None):
+        self.config_file = config_file
+        with STARTUP.phase('config'):
+            self.config = load_config(config_file)
+        self.status_log = StatusLog(LOG_FILE)
+        self.settings = next_settings(self.config, log=self.log_status)
+        METRICS.enabled = self.settings.metrics_enabled
+        self.running = False
+        self.root = None
+        self.warning_shown = False
+        self.warning_generation = 0
+        self.countdown_remaining = 0
+        self.warning_deadline = None
+        self.warning_window = None
+        self.volume_ducked_from = None
+        self.pause_timer = None
+        self.profiles = None
+        self.profile_overrides = {}
+        self.active_profiles = None
+        self.profile_timer = None
+        self.control = control
+        self.detector = None
+        self.volume_control = None
+        self.volume_enforcer = None
+        self.session_enforcer = None
+        self.volume_monitor_timer = None
+        self.config_watcher = None
+        self.report_agent = None
+        self.shutdown_executor = self.build_shutdown_executor()
+        self.show_startup_profile = False
+        self.events = UIEventQueue()
+        self.scheduler = Scheduler()
+        self.watchdog = ShutdownWatchdog()
+        self.history = open_history(self.settings.history_file, self.log_status)
+
+    def log_status(self, message):
+        """Log messages to stdout and the log file"""
+        print(self.status_log.append(message), flush=True)
+
+    def dispatch(self, fn, key=None):
+        """Run fn on the daemon's main thread; safe to call from any thread"""
+        self.events.post(fn, key)
+
+    def after(self, delay, fn, feature, key=None):
+        """Run fn on the main thread after delay seconds; returns a cancellable timer"""
+        return self.scheduler.call_later(delay, lambda: self.dispatch(fn, key), feature)
+
+    def run(self):
+        """Start the enabled features and process events until stopped"""
+        self.running = True
+        self.scheduler.start()
+        self.watchdog.start()
+        self.start_profiles()
+        
+        if self.settings.volume_control_enabled:
+            with STARTUP.phase('audio init'):
+                self.start_volume_control()
+        if self.settings.idle_detector_enabled:
+            self.start_detection()
         
-        percent = float(value)
-        self.last_slider_update = self.root.after(
-            100, 
-            lambda: self.set_volume(percent, update_slider=False)
+        self.config_watcher = ConfigWatcher(
+            self.config_file,
+            lambda: self.settings,
+            lambda changes, mtime: self.dispatch(lambda: self.apply_config_changes(changes, mtime), 'config_reload')
         )
+        self.config_watcher.start()
+        if self.control:
+            self.control.start(self.scheduler.loop, control_commands(self), self.dispatch)
+        
+        self.start_metrics()
+        self.start_reporting()
+        self.log_status(startup_report())
+        if self.show_startup_profile:
+            print(STARTUP.report(), flush=True)
+        try:
+            while self.running:
+                self.run_once()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
 
-    def set_volume(self, percent, update_slider=True):
-        """Set system volume with error handling"""
-        if not self.volume_control or not self.config.get('volume_control_enabled', True):
-            return
-            
+    def run_once(self):
+        """Wait for dispatched calls and run them on the main thread"""
+        timeout = self.TK_PUMP if self.warning_shown and self.root is not None else self.MAX_WAIT
+        if self.events.wait(timeout):
+            self.events.drain()
+        
+        if self.warning_shown and self.root is not None:
+            self.root.update()
+
+    def stop(self):
+        """Make run() return after the current batch"""
+        self.running = False
+
+    def close(self):
+        """Stop all features and release resources"""
+        self.running = False
+        self.cancel(self.profile_timer)
+        if self.config_watcher:
+            self.config_watcher.stop()
+        if self.control:
+            self.control.close()
+        self.stop_detection()
+        self.watchdog.stop()
+        self.log_status(self.watchdog.describe())
+        if self.session_enforcer:
+            self.log_status(self.session_enforcer.describe())
+        self.stop_volume_control()
+        if self.volume_control:
+            self.log_status(self.volume_control.describe())
+            self.volume_control.close()
+        if METRICS.enabled:
+            METRICS.stop()
+            self.export_metrics()
+        self.stop_reporting()
+        self.log_status(self.scheduler.describe())
+        self.scheduler.stop()
+        if self.root is not None:
+            try:
+                self.root.destroy()
+            except Exception:
+                pass
+            self.root = None
+        if self.history:
+            self.history.close()
+        self.status_log.close()
+
+    def handle_launch(self, argv):
+        """Another launch handed over to this instance"""
+        self.log_status(f"Second launch handed over ({' '.join(argv) or 'no arguments'})")
+
+    def start_volume_control(self):
+        """Activate the endpoint if needed and start enforcing the saved volume"""
+        if self.volume_control is None:
+            self.volume_control = EndpointManager(
+                open_volume_backend,
+                schedule=lambda delay, fn: self.after(delay, fn, 'audio', key='endpoint'),
+                watch_default_device=watch_default_device,
+                log=self.log_status,
+                on_recovered=self.on_endpoint_recovered
+            )
+            METRICS.instrument(self.volume_control, 'get_level', 'volume_get_seconds')
+            METRICS.instrument(self.volume_control, 'set_level', 'volume_set_seconds')
+            if not self.volume_control.start():
+                self.log_status("Audio endpoint unavailable, retrying in the background")
+            self.volume_enforcer = VolumeEnforcer(
+                self.volume_control,
+                dispatch=lambda fn: self.dispatch(fn, 'volume'),
+                on_correct=self.on_volume_corrected
+            )
+        self.volume_enforcer.target = self.setting('saved_volume')
+        if self.setting('saved_volume') is not None:
+            self.set_volume(self.setting('saved_volume'))
+        if not self.volume_enforcer.event_driven and not self.volume_enforcer.start():
+            self.log_status("Volume change notifications unavailable, polling every second")
+        self.start_app_volumes()
+        self.monitor_volume_changes()
+
+    def stop_volume_control(self):
+        """Stop enforcing the saved volume"""
+        self.cancel(self.volume_monitor_timer)
+        self.volume_monitor_timer = None
+        if self.volume_enforcer:
+            self.volume_enforcer.stop()
+        self.stop_app_volumes()
+
+    def set_saved_volume(self, percent):
+        """Apply a volume level and save it to config.txt"""
+        self.config['saved_volume'] = percent
+        self.publish_settings()
         try:
-            self.ignore_volume_change = True
-            percent = max(0, min(100, float(percent)))
-            self.volume_control.SetMasterVolumeLevelScalar(percent/100, None)
-            
-            if update_slider and hasattr(self, 'volume_slider'):
-                self.volume_slider.set(percent)
-            self.update_current_volume()
-            self.ignore_volume_change = False
+            with METRICS.measure('config_write_seconds'):
+                save_config(self.config_file, self.config)
+        except OSError as e:
+            self.log_status(f"Error saving config: {e}")
+        if self.volume_enforcer:
+            self.volume_enforcer.target = percent
+        self.set_volume(percent)
+
+    def set_volume(self, percent, force=False):
+        """Set system volume, logging failures (every write goes out, so force changes nothing)"""
+        try:
+            self.volume_control.set_level(max(0, min(100, float(percent))) / 100)
         except Exception as e:
-            self.ignore_volume_change = False
-            messagebox.showerror("Error", f"Volume control failed:\n{str(e)}")
+            self.log_status(f"Volume control failed: {e}")
 
-    def update_current_volume(self):
-        """Update displayed volume"""
-        if not self.volume_control or not self.config.get('volume_control_enabled', True):
-            if hasattr(self, 'volume_label'):
-                self.volume_label.config(text="Current Volume: Unavailable")
-            return
-            
+    def apply_setting_changes(self, changes):
+        """Start or stop the features toggled in config.txt"""
+        if 'idle_detector_enabled' in changes:
+            if changes['idle_detector_enabled']:
+                self.start_detection()
+            else:
+                self.stop_detection()
+        if 'volume_control_enabled' in changes:
+            if changes['volume_control_enabled']:
+                self.start_volume_control()
+            else:
+                self.stop_volume_control()
+        elif 'saved_volume' in changes and self.settings.volume_control_enabled and self.volume_enforcer:
+            self.volume_enforcer.target = self.setting('saved_volume')
+            self.set_volume(self.setting('saved_volume'))
+
+    def show_warning(self, rule, requested=None):
+        """Show the warning window, building it on first use, and start the countdown to the rule's action"""
+        self.hide_warning(announce=False)
+        self.warning_shown = True
+        self.warning_generation += 1
+        self.countdown_remaining = rule.warning
+        self.log_status("Idle detected! Showing warning...")
+        if self.history:
+            self.history.record(HistoryStore.WARNING, rule.warning)
+        
         try:
-            current_vol = self.volume_control.GetMasterVolumeLevelScalar()
-            percent = int(current_vol * 100)
-            if hasattr(self, 'volume_label'):
-                self.volume_label.config(text=f"Current Volume: {percent}%")
-            if hasattr(self, 'volume_slider'):
-                self.volume_slider.set(percent)
-        except:
-            if hasattr(self, 'volume_label'):
-                self.volume_label.config(text="Current Volume: Unknown")
+            if self.warning_window is None:
+                load_tk()
+                self.root = tk.Tk()
+                self.root.withdraw()
+                self.warning_window = WarningWindow(
+                    self.root, self.on_warning_response, on_visible=self.on_warning_visible)
+            self.warning_window.show(self.countdown_remaining, rule.action, requested)
+        except Exception as e:
+            self.log_status(f"Could not show warning window: {e}")
+        
+        # The watchdog or detector fires the action itself when the countdown runs out
+        self.warning_deadline = warning_deadline(self.watchdog, rule, requested)
+        self.update_countdown(self.warning_generation)
 
-    def monitor_volume_changes(self):
-        """Check for volume changes and revert to saved setting if changed externally"""
-        if not self.volume_control or not self.config.get('volume_control_enabled', True):
+    def update_countdown(self, generation):
+        """Show the seconds left before the warned action; only the display runs here"""
+        if not self.warning_shown or generation != self.warning_generation:
             return
-            
+        remaining = max(0.0, self.warning_deadline - time.monotonic())
+        self.countdown_remaining = math.ceil(remaining)
+        if self.warning_window is not None:
+            self.warning_window.set_remaining(self.countdown_remaining)
+        if self.countdown_remaining > 0:
+            self.after(remaining - (self.countdown_remaining - 1), lambda: self.update_countdown(generation),
+                       'countdown', key='countdown')
+
+    def hide_warning(self, announce=True):
+        """Withdraw the warning window; it is kept for the next warning"""
+        if self.warning_window is not None and self.warning_window.shown:
+            try:
+                self.warning_window.hide()
+                self.root.update()  # Tk is not pumped again until the next warning
+            except Exception:
+                pass
+        if self.warning_shown:
+            self.warning_shown = False
+            if announce:
+                self.log_status("Warning dismissed due to user activity")
+
+# ==============================================
+# ONE-SHOT COMMANDS
+# ==============================================
+def instance_request(config, request):
+    """Reply from the running instance, or None if there is none"""
+    port = config.get('control_port')
+    if not port:
+        return None
+    try:
+        return control_request(session_port(port), request)
+    except (FileNotFoundError, ConnectionRefusedError):
+        return None
+
+
+def volume_command(args):
+    """`volume get` / `volume set PERCENT`, through the running instance if there is one"""
+    config = load_config(CONFIG_FILE)
+    if args.action == 'set':
+        # A running instance would revert a plain write, so it sets its saved volume
+        reply = instance_request(config, {'cmd': 'set_volume', 'value': args.percent})
+    else:
+        reply = instance_request(config, {'cmd': 'get_volume'})
+    if reply is not None:
+        if not reply.get('ok'):
+            raise RuntimeError(reply.get('error'))
+        if args.action == 'set':
+            return
+        if reply['volume'] is not None:
+            print(reply['volume'])
+            return
+        # The instance has volume control off and no endpoint open; read it here
+    volume_control = open_volume_backend()
+    if args.action == 'set':
+        volume_control.set_level(args.percent / 100)
+    else:
+        print(round(volume_control.get_level() * 100))
+
+
+def idle_time_command(args):
+    if not hasattr(ctypes, 'windll'):
+        raise RuntimeError("Idle time is only available on Windows")
+    print(f"{Win32IdleSource().idle_seconds():.1f}")
+
+
+def config_command(args):
+    """`config set key=value ...`; values are JSON, or plain text for strings"""
+    changes = {}
+    for assignment in args.assignments:
+        key, sep, text = assignment.partition('=')
+        if not sep or key not in DEFAULT_CONFIG:
+            raise ValueError(f"Expected key=value with one of: {', '.join(DEFAULT_CONFIG)}; got {assignment!r}")
         try:
-            current_vol = self.volume_control.GetMasterVolumeLevelScalar()
-            current_percent = int(current_vol * 100)
-            
-            if (not self.ignore_volume_change and 
-                hasattr(self, 'config') and 
-                self.config.get('saved_volume') is not None):
-                if current_percent != self.config['saved_volume']:
-                    self.set_volume(self.config['saved_volume'])
-        except:
-            pass
-            
-        # Check again after 1 second
-        if hasattr(self, 'root'):
-            self.root.after(1000, self.monitor_volume_changes)
+            value = json.loads(text)
+        except ValueError:
+            value = text
+        try:
+            changes[key] = Settings.validate(key, value)
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"{key}: {e}")
+    # Never replace a config.txt that does not parse with the defaults
+    try:
+        config = read_config(CONFIG_FILE)
+    except (OSError, ValueError) as e:
+        raise ValueError(f"{CONFIG_FILE} cannot be read ({e}); fix or remove it first")
+    # A running instance reloads config.txt when it changes
+    save_config(CONFIG_FILE, {**config, **changes})
 
-    def on_close(self):
-        """Clean up on window close"""
-        if hasattr(self, 'last_slider_update') and self.last_slider_update:
-            self.root.after_cancel(self.last_slider_update)
-        if hasattr(self, 'is_running') and self.is_running:
-            self.is_running = False
-        if hasattr(self, 'warning_shown') and self.warning_shown:
-            self.hide_warning()
-        if hasattr(self, 'root'):
-            self.root.destroy()
 
-if __name__ == "__main__":
+def percent(text):
+    value = float(text)
+    if not 0 <= value <= 100:
+        raise argparse.ArgumentTypeError(f"{text} is not between 0 and 100")
+    return value
+
+
+def add_one_shot_commands(parser):
+    """Subcommands that do one thing and exit, without Tk or the background workers"""
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+    volume = commands.add_parser('volume', help="get or set the system volume")
+    volume.set_defaults(run=volume_command)
+    volume_actions = volume.add_subparsers(dest='action', metavar='ACTION', required=True)
+    volume_actions.add_parser('get', help="print the volume in percent")
+    volume_actions.add_parser('set', help="set the volume; a running instance also saves it").add_argument(
+        'percent', type=percent)
+    commands.add_parser('idle-time', help="print the seconds since the last input").set_defaults(
+        run=idle_time_command)
+    config = commands.add_parser('config', help="change config.txt")
+    config.set_defaults(run=config_command)
+    config_actions = config.add_subparsers(dest='action', metavar='ACTION', required=True)
+    config_actions.add_parser('set', help="set one or more values").add_argument(
+        'assignments', nargs='+', metavar='KEY=VALUE')
+
+
+def run_one_shot(args):
+    """Run a subcommand; returns the process exit status"""
+    try:
+        args.run(args)
+    except Exception as e:
+        print(f"{args.command}: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Idle shutdown and volume control utility")
+    parser.add_argument('--daemon', action='store_true',
+                        help="run headless from config.txt without the main window")
+    parser.add_argument('--startup-profile', action='store_true',
+                        help="print time spent in each startup phase")
+    parser.add_argument('--history', type=int, metavar='DAYS',
+                        help="print idle minutes per hour from the activity history and exit")
+    parser.add_argument('--replay', type=float, metavar='DAYS',
+                        help="replay the last DAYS of activity history through the idle rules in virtual time and exit")
+    parser.add_argument('--synthetic', action='store_true',
+                        help="with --replay, use randomly generated activity instead of the history")
+    parser.add_argument('--collector', type=int, metavar='PORT',
+                        help="collect state reports from other instances on PORT (0 picks a free port)")
+    parser.add_argument('--collector-bind', default='127.0.0.1', metavar='ADDRESS',
+                        help="with --collector, the address to listen on; reports are not authenticated, "
+                             "so only use 0.0.0.0 on a trusted network (default 127.0.0.1)")
+    add_one_shot_commands(parser)
+    args = parser.parse_args(argv)
+    STARTUP.record('imports', time.perf_counter() - _STARTED)
+    
+    if args.command:
+        return run_one_shot(args)
+    
+    if args.history is not None:
+        history = open_history(load_config(CONFIG_FILE).get('history_file'))
+        if history:
+            print(history_report(history, args.history))
+            history.close()
+        return
+    
+    if args.replay is not None:
+        config = load_config(CONFIG_FILE)
+        if args.synthetic:
+            active = synthetic_activity(args.replay * 24)
+        else:
+            history = open_history(config.get('history_file'))
+            if not history:
+                return
+            end = time.time()
+            active = recorded_activity(history, end - args.replay * 86400, end)
+            history.close()
+        replay = IdleReplay(compile_idle_rules(config), active).run(args.replay * 86400)
+        print(replay.describe())
+        return
+    
+    if args.collector is not None:
+        import asyncio
+        try:
+            asyncio.run(run_collector(args.collector, args.collector_bind))
+        except KeyboardInterrupt:
+            pass
+        return
+    
+    # Only one instance may run; later launches hand over to it and exit
+    control = None
+    port = load_config(CONFIG_FILE).get('control_port')
+    if port:
+        port = session_port(port)
+        control = ControlServer(port)
+        if not control.bind():
+            try:
+                reply = control_request(port, {'cmd': 'launch', 'argv': list(sys.argv[1:] if argv is None else argv)})
+                if not reply.get('ok'):
+                    raise ValueError(reply.get('error'))
+                print("Already running; handed over to the running instance")
+                return
+            except (OSError, ValueError, AttributeError) as e:
+                print(f"Control port {port} is in use but no instance of this user answered ({e}), "
+                      "continuing without it")
+                control = None
+    
+    if args.daemon:
+        daemon = IdleDaemon(CONFIG_FILE, control)
+        daemon.show_startup_profile = args.startup_profile
+        daemon.run()
+        return
+    
+    with STARTUP.phase('imports'):
+        load_tk()
     try:
-        root = tk.Tk()
-        app = SystemUtilitiesApp(root)
+        with STARTUP.phase('ui build'):
+            root = tk.Tk()
+        SystemUtilitiesApp(root, control)
+        if args.startup_profile:
+            print(STARTUP.report(), flush=True)
         root.mainloop()
     except Exception as e:
         messagebox.showerror("Fatal Error", f"Application failed to start:\n{str(e)}")
         sys.exit(1)
+
+
+if __name__ == "__main__":
+    sys.exit(main())